@@ -1,17 +1,79 @@
 import os
 import sys
+import time
 import getopt
-from fwmaker import FirmwareMaker
+import fwdefaults
+from fwdefaults import str2number
+from fastcopy import COPY_AUTO, COPY_BUFFERED, COPY_METHODS, allocated_size
+
+
+# Build modules (fwmaker, cache, compress, watch and server) are imported once options need them, help and
+# option parsing only use fwdefaults, start up stays short
+def build_cache(directory, max_size):
+    from fwcache import BuildCache
+    return BuildCache(directory, fwdefaults.DEF_CACHE_SIZE if max_size is None else max_size)
 
 
 def usage():
     print "\n{0:s}\n".format(os.path.basename(sys.argv[0]))
     print "\t-h\tshow this help menu"
     print "\t-v\toutput verbose message"
-    print "\t-o\tspecify output file name, otherwise using default name:{0:s}".format(FirmwareMaker.DEF_OUTPUT_FILE)
-    print "\t-c\tspecify settings file, otherwise using default settings:{0:s}".format(FirmwareMaker.DEF_SETTING_PATH)
-    print "\t-e\tgenerate essential settings include {0:s}".format(FirmwareMaker.ESSENTIAL_FILE_LIST)
-    print "\t-d\tgenerate default settings include {0:s}".format(FirmwareMaker.DEFAULT_FILE_LIST)
+    print "\t-o\tspecify output file name, otherwise using default name:{0:s}".format(fwdefaults.DEF_OUTPUT_FILE)
+    print "\t-b\tspecify copy buffer size, default:{0:d}".format(fwdefaults.DEF_BUFFER_SIZE)
+    print "\t-z\tusing kernel zero-copy (reflink/copy_file_range/sendfile) place components if possible"
+    print "\t--read-ahead=\tprefetch components on a reader thread with specified memory budget, " \
+          "overlap reading, hashing and writing (buffered copy only)"
+    print "\t--copy=\tspecify copy method: {0:s}, default:{1:s}".format(COPY_METHODS + [COPY_AUTO], COPY_BUFFERED)
+    print "\t--compress=\talso write compressed firmware (firmware.<format>) while making, block parallel (-j), " \
+          "format: {0:s} (xz needs backports.lzma)".format(fwdefaults.COMPRESS_FORMATS)
+    print "\t-s\tgenerate sparse firmware, gaps between components are file system holes"
+    print "\t-f\tspecify gaps fill byte, NAND erased state is 0xff, default:0x{0:02x}".format(fwdefaults.DEF_FILL_BYTE)
+    print "\t-p\temit NAND page map (firmware{0:s}) which lists erased pages".format(fwdefaults.PAGE_MAP_SUFFIX)
+    print "\t--page-size=\tspecify NAND page size, default:{0:d}".format(fwdefaults.DEF_PAGE_SIZE)
+    print "\t--block-size=\tspecify NAND erase block size, default:{0:d}".format(fwdefaults.DEF_BLOCK_SIZE)
+    print "\t--align\tcheck partition offset is aligned to erase block size (--block-size)"
+    print "\t--flash-size=\tcheck partitions are inside flash"
+    print "\t-i\tincremental build, only rewrite changed partitions (firmware{0:s})".format(fwdefaults.MANIFEST_SUFFIX)
+    print "\t-m\twrite manifest (firmware{0:s}) with firmware md5/sha256, each partition crc32/sha256".\
+        format(fwdefaults.MANIFEST_SUFFIX)
+    print "\t--cache\tusing build cache, default cache directory:{0:s}".format(fwdefaults.DEF_CACHE_DIR)
+    print "\t--cache-dir=\tusing build cache in specified directory"
+    print "\t--cache-size=\tspecify max build cache size, default:{0:d}".format(fwdefaults.DEF_CACHE_SIZE)
+    print "\t--cache-stats\tshow build cache statistics"
+    print "\t--batch=\tbatch mode, make firmware for each settings file (glob pattern supported, repeatable), " \
+          "-o specify output directory"
+    print "\t--verify\tverify existing firmware (-o) against settings and component files without rebuilding"
+    print "\t--extract=\textract partitions of existing firmware (-o) to specified directory by settings"
+    print "\t--split=\tinstead of firmware, write each partition and flash plan ({0:s}/{1:s}) to specified directory, " \
+          "unchanged partitions since previous plan are skipped".\
+        format(fwdefaults.FLASH_PLAN_FILE, fwdefaults.FLASH_SCRIPT_FILE)
+    print "\t--since=\tspecify previous flash plan, default is the plan in --split directory"
+    print "\t--diff=\tgenerate block delta file from source firmware (--source) to firmware (-o), " \
+          "compared partition by partition"
+    print "\t--apply=\tapply delta file to source firmware (--source), write firmware (-o)"
+    print "\t--source=\tspecify source (old) firmware of --diff and --apply"
+    print "\t--source-conf=\tspecify source firmware settings of --diff, default is the same as -c"
+    print "\t--watch\tmake firmware, then watch component files and patch changed partitions in place, Ctrl-C to stop"
+    print "\t--poll\twatch component files by stat polling instead of inotify"
+    print "\t--serve=\trun local build server on specified address (host:port or unix:path), firmware is written to " \
+          "-o directory as <name>-<md5>.bin, -j workers, build cache (--cache-dir) is always used"
+    print "\t--server=\tbuild firmware on local build server (host:port or unix:path), see --serve"
+    print "\t--stats\tshow duration, bytes and syscall counts of each stage and partition"
+    print "\t--stats-json=\twrite stages and partitions statistics to specified json file"
+    print "\t--pack=\tcompute a compact layout aligned to erase block size (--block-size), write it to specified " \
+          "settings file"
+    print "\t--headroom=\tspecify --pack growth headroom in percent of component size, default:{0:d}".\
+        format(fwdefaults.DEF_HEADROOM)
+    print "\t--pin=\tspecify --pack partitions keep current offset (comma separated, repeatable), " \
+          "{0:s} is always at 0".format(fwdefaults.ESSENTIAL_FILE_LIST[0])
+    print "\t--simg\twrite firmware (-o) as Android sparse image (simg), raw firmware is not generated"
+    print "\t--dont-care\tgaps of sparse image are DONT_CARE chunks, flasher leaves them untouched"
+    print "\t--expand=\texpand Android sparse image to raw firmware (-o)"
+    print "\t--trim\ttrim trailing fill bytes (-f) of extracted partitions, or erased bytes (0xff) of split partitions"
+    print "\t-j\tspecify batch mode or verify worker count, default is cpu count"
+    print "\t-c\tspecify settings file, otherwise using default settings:{0:s}".format(fwdefaults.DEF_SETTING_PATH)
+    print "\t-e\tgenerate essential settings include {0:s}".format(fwdefaults.ESSENTIAL_FILE_LIST)
+    print "\t-d\tgenerate default settings include {0:s}".format(fwdefaults.DEFAULT_FILE_LIST)
 
 
 if __name__ == '__main__':
@@ -20,12 +82,64 @@ if __name__ == '__main__':
 
         # Default args setting
         verbose = False
-        conf = FirmwareMaker.DEF_SETTING_PATH
-        output = FirmwareMaker.DEF_OUTPUT_FILE
+        conf = fwdefaults.DEF_SETTING_PATH
+        output = fwdefaults.DEF_OUTPUT_FILE
+        buffer_size = fwdefaults.DEF_BUFFER_SIZE
+        copy_method = COPY_BUFFERED
+        read_ahead = 0
+        compress = None
+        sparse = False
+        page_map = False
+        incremental = False
+        align = False
+        flash_size = 0
+        manifest = False
+        cache = False
+        cache_dir = None
+        cache_stats = False
+        cache_size = None
+        batch = list()
+        verify = False
+        extract = None
+        trim = False
+        split = None
+        since = None
+        diff = None
+        apply_delta = None
+        source = None
+        source_conf = None
+        simg = False
+        dont_care = False
+        expand = None
+        pack = None
+        watch = False
+        watch_method = None
+        serve = None
+        server = None
+        show_stats = False
+        stats_json = None
+        headroom = fwdefaults.DEF_HEADROOM
+        pinned = list()
+        workers = None
+        output_dir = "."
+        fill_byte = fwdefaults.DEF_FILL_BYTE
+        page_size = fwdefaults.DEF_PAGE_SIZE
+        block_size = fwdefaults.DEF_BLOCK_SIZE
 
         # Resolve arguments
-        opts, args = getopt.getopt(sys.argv[1:], "ho:c:edv", ["help", "output=", "conf=",
-                                                              "essential", "default", "verbose"])
+        opts, args = getopt.getopt(sys.argv[1:], "ho:c:b:zsf:pimj:edv", ["help", "output=", "conf=", "buffer=",
+                                                                      "zero-copy", "copy=", "read-ahead=", "compress=",
+                                                                      "sparse", "fill=", "pagemap", "page-size=",
+                                                                      "block-size=", "align", "flash-size=",
+                                                                      "incremental", "manifest", "cache", "cache-dir=",
+                                                                      "cache-size=", "cache-stats", "batch=", "verify",
+                                                                      "extract=", "trim", "split=", "since=",
+                                                                      "diff=", "apply=", "source=", "source-conf=",
+                                                                      "simg", "dont-care", "expand=",
+                                                                      "pack=", "headroom=", "pin=",
+                                                                      "stats", "stats-json=", "watch", "poll",
+                                                                      "serve=", "server=",
+                                                                      "jobs=", "essential", "default", "verbose"])
         # print opts
 
         for option, argument in opts:
@@ -34,17 +148,124 @@ if __name__ == '__main__':
                 sys.exit()
             elif option in ("-o", "--output") and len(argument):
                 output = argument
+                output_dir = argument
             elif option in ("-c", "--conf") and len(argument):
                 if os.path.isfile(argument):
                     conf = argument
                 else:
                     print "Configure file:{0:s} is not exist!".format(argument)
                     sys.exit()
+            elif option in ("-b", "--buffer") and len(argument):
+                buffer_size = str2number(argument)
+                if buffer_size <= 0:
+                    print "Invalid buffer size:{0:s}".format(argument)
+                    sys.exit()
+            elif option in ("-z", "--zero-copy"):
+                copy_method = COPY_AUTO
+            elif option == "--copy" and len(argument):
+                if argument not in COPY_METHODS + [COPY_AUTO]:
+                    print "Unknown copy method:{0:s}".format(argument)
+                    sys.exit()
+                copy_method = argument
+            elif option == "--read-ahead" and len(argument):
+                read_ahead = str2number(argument)
+                if read_ahead <= 0:
+                    print "Invalid read ahead size:{0:s}".format(argument)
+                    sys.exit()
+            elif option == "--compress" and len(argument):
+                from fwcompress import available_formats
+                if argument not in available_formats():
+                    print "Unsupported compress format:{0:s}".format(argument)
+                    sys.exit()
+                compress = argument
+            elif option in ("-s", "--sparse"):
+                sparse = True
+            elif option in ("-f", "--fill") and len(argument):
+                fill_byte = str2number(argument)
+                if not 0 <= fill_byte <= 0xff:
+                    print "Invalid fill byte:{0:s}".format(argument)
+                    sys.exit()
+            elif option in ("-p", "--pagemap"):
+                page_map = True
+            elif option in ("--page-size", "--block-size") and len(argument):
+                if str2number(argument) <= 0:
+                    print "Invalid {0:s}:{1:s}".format(option, argument)
+                    sys.exit()
+                if option == "--page-size":
+                    page_size = str2number(argument)
+                else:
+                    block_size = str2number(argument)
+            elif option == "--align":
+                align = True
+            elif option == "--flash-size" and len(argument):
+                flash_size = str2number(argument)
+            elif option in ("-i", "--incremental"):
+                incremental = True
+            elif option in ("-m", "--manifest"):
+                manifest = True
+            elif option == "--cache":
+                cache = True
+            elif option == "--cache-dir" and len(argument):
+                cache = True
+                cache_dir = argument
+            elif option == "--cache-size" and len(argument):
+                cache_size = str2number(argument)
+            elif option == "--cache-stats":
+                cache_stats = True
+            elif option == "--batch" and len(argument):
+                batch.append(argument)
+            elif option == "--verify":
+                verify = True
+            elif option == "--extract" and len(argument):
+                extract = argument
+            elif option == "--split" and len(argument):
+                split = argument
+            elif option == "--since" and len(argument):
+                since = argument
+            elif option == "--diff" and len(argument):
+                diff = argument
+            elif option == "--apply" and len(argument):
+                apply_delta = argument
+            elif option == "--source" and len(argument):
+                source = argument
+            elif option == "--source-conf" and len(argument):
+                source_conf = argument
+            elif option == "--watch":
+                watch = True
+            elif option == "--poll":
+                from fwwatch import WATCH_POLL
+                watch_method = WATCH_POLL
+            elif option == "--serve" and len(argument):
+                serve = argument
+            elif option == "--server" and len(argument):
+                server = argument
+            elif option == "--stats":
+                show_stats = True
+            elif option == "--stats-json" and len(argument):
+                stats_json = argument
+            elif option == "--pack" and len(argument):
+                pack = argument
+            elif option == "--headroom" and len(argument):
+                headroom = str2number(argument)
+            elif option == "--pin" and len(argument):
+                pinned.extend(name.strip() for name in argument.split(","))
+            elif option == "--simg":
+                simg = True
+            elif option == "--dont-care":
+                dont_care = True
+            elif option == "--expand" and len(argument):
+                expand = argument
+            elif option == "--trim":
+                trim = True
+            elif option in ("-j", "--jobs") and len(argument):
+                workers = str2number(argument)
             elif option in ("-e", "--essential"):
-                FirmwareMaker.generate_def_configure(FirmwareMaker.ESSENTIAL_FILE_LIST)
+                from fwmaker import FirmwareMaker
+                FirmwareMaker.generate_def_configure(fwdefaults.ESSENTIAL_FILE_LIST)
                 sys.exit()
             elif option in ("-d", "--default"):
-                FirmwareMaker.generate_def_configure(FirmwareMaker.DEFAULT_FILE_LIST)
+                from fwmaker import FirmwareMaker
+                FirmwareMaker.generate_def_configure(fwdefaults.DEFAULT_FILE_LIST)
                 sys.exit()
             elif option in ("-v", "--verbose"):
                 verbose = True
@@ -52,30 +273,243 @@ if __name__ == '__main__':
                 usage()
                 sys.exit()
 
+        from fwmaker import FirmwareMaker, BuildStats, NULL_STATS
+
+        if cache_stats:
+            for key, value in sorted(build_cache(cache_dir, cache_size).stats().items()):
+                print "{0:s}:\t{1:d}".format(key, value)
+            sys.exit()
+
+        if batch:
+            ret, summary = FirmwareMaker.make_batch(batch, output_dir, workers, verbose,
+                                                    buffer_size=buffer_size, copy_method=copy_method,
+                                                    sparse=sparse, fill_byte=fill_byte,
+                                                    page_size=page_size if page_map else 0, block_size=block_size,
+                                                    incremental=incremental, manifest=manifest,
+                                                    read_ahead=read_ahead, compress=compress, compress_workers=1,
+                                                    cache=build_cache(cache_dir, cache_size) if cache else None)
+
+            failed = [item for item in summary if not item.get("result")]
+            print "Batch: {0:d} success, {1:d} failed, summary: {2:s}".\
+                format(len(summary) - len(failed), len(failed), os.path.join(output_dir, FirmwareMaker.BATCH_SUMMARY_FILE))
+            for item in failed:
+                print "Failed: {0:s}, {1:s}".format(item.get("conf"), item.get("error"))
+
+            sys.exit(0 if ret else 1)
+
+        # Build server, settings is sent by clients
+        if serve:
+            from fwserver import BuildServer
+            build_server = BuildServer(serve, output_dir, workers, cache=build_cache(cache_dir, cache_size),
+                                       verbose=verbose)
+            print "Serving on {0:s}, output directory: {1:s}, workers: {2:d}, Ctrl-C to stop".\
+                format(serve, build_server.output_dir, build_server.workers)
+
+            try:
+                build_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                build_server.close()
+
+            sys.exit()
+
+        if (diff or apply_delta) and not source:
+            print "Source firmware is not specified (--source)"
+            sys.exit(1)
+
+        # Apply delta, settings is not required
+        if apply_delta:
+            ret, err_or_md5 = FirmwareMaker.apply_delta(source, apply_delta, output)
+            if not ret:
+                print err_or_md5
+                sys.exit(1)
+
+            print "Success, {0:s} + {1:s} ===> {2:s}, md5: {3:s}".format(source, apply_delta, output, err_or_md5)
+            sys.exit()
+
+        # Expand sparse image, settings is not required
+        if expand:
+            ret, err_or_size = FirmwareMaker.expand_sparse_image(expand, output)
+            if not ret:
+                print err_or_size
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, size: {2:d}".format(expand, output, err_or_size)
+            sys.exit()
+
         if verbose:
             print "Settings:\t", conf
             print "Firmware:\t", output
 
+        stats = BuildStats() if show_stats or stats_json else NULL_STATS
+
         # Load setting
-        ret, settings = FirmwareMaker.load_configure(conf)
+        with stats.stage("load"):
+            ret, settings = FirmwareMaker.load_configure(conf)
         if not ret:
             print "Load settings file:{0:s} error!".format(conf)
             sys.exit()
 
+        # Extract partitions, component files are not required
+        if extract:
+            ret, err_or_extracted = FirmwareMaker.extract_firmware(settings, output, extract, None, trim, fill_byte,
+                                                                   copy_method, verbose, buffer_size)
+            if not ret:
+                print err_or_extracted
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, partitions: {2:d}".format(output, extract, len(err_or_extracted))
+            sys.exit()
+
+        # Generate delta, component files are not required
+        if diff:
+            source_settings = None
+            if source_conf:
+                ret, source_settings = FirmwareMaker.load_configure(source_conf)
+                if not ret:
+                    print "Load settings file:{0:s} error!".format(source_conf)
+                    sys.exit(1)
+
+            ret, err_or_stats = FirmwareMaker.make_delta(source, output, diff, source_settings, settings,
+                                                         verbose=verbose)
+            if not ret:
+                print err_or_stats
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, delta: {2:d} bytes, copy: {3:d} bytes, literal: {4:d} bytes".\
+                format(output, diff, err_or_stats.get("delta_size"), err_or_stats.get("copy_bytes"),
+                       err_or_stats.get("literal_bytes"))
+            sys.exit()
+
+        # Pack layout, component files must exist but may exceed current reserved size
+        if pack:
+            ret, err_or_plan = FirmwareMaker.pack_layout(settings, block_size, headroom, pinned, flash_size, pack,
+                                                         verbose)
+            if not ret:
+                print err_or_plan
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, reserved: {2:d} bytes, previous: {3:d} bytes, saved: {4:d} bytes, " \
+                  "firmware: {5:d} bytes, previous: {6:d} bytes".\
+                format(conf, pack, err_or_plan.get("reserved_size"), err_or_plan.get("previous_reserved_size"),
+                       err_or_plan.get("saved_bytes"), err_or_plan.get("image_size"),
+                       err_or_plan.get("previous_image_size"))
+            sys.exit()
+
+        # Build on server, settings is checked by server
+        if server:
+            from fwserver import build_remote
+            ret, err_or_response = build_remote(server, settings, output, fill_byte=fill_byte, sparse=sparse,
+                                                copy_method=copy_method, buffer_size=buffer_size)
+            if not ret:
+                print "Generate firmware error:{0:s}".format(err_or_response)
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, md5: {2:s}{3:s}".format(conf, output, err_or_response.get("md5"),
+                                                                    ", cached" if err_or_response.get("cached") else "")
+            if verbose:
+                for name, digest in sorted(err_or_response.get("components").items()):
+                    print "Component:{0:s}\tsha256: {1:s}".format(name, digest)
+            sys.exit()
+
         # Check setting
-        ret, err = FirmwareMaker.check_configure(settings, verbose)
+        with stats.stage("check"):
+            ret, err = FirmwareMaker.check_configure(settings, verbose, block_size if align else 0, flash_size)
         if not ret:
             print "Invalid settings:{0:s}".format(conf)
             sys.exit()
 
+        # Verify firmware
+        if verify:
+            ret, errors = FirmwareMaker.verify_firmware(settings, output, fill_byte, workers, verbose, buffer_size)
+            for error in errors:
+                print error
+
+            print "Verify {0:s}, {1:s} <=== {2:s}".format("success" if ret else "failed", output, conf)
+            sys.exit(0 if ret else 1)
+
+        # Watch component files, rebuild until interrupted
+        if watch:
+            import threading
+
+            def report_patch(report):
+                print "{0:s} changed: {1:s}, patched: {2:s}, {3:.1f}ms".\
+                    format(time.strftime("%H:%M:%S"), ", ".join(report.get("changed")),
+                           ", ".join(report.get("patched")) or "none", report.get("time") * 1000)
+                for error in report.get("errors"):
+                    print error
+
+            # Watch runs on a thread, so Ctrl-C never interrupts a patch
+            stop = threading.Event()
+            result = list()
+            watcher = threading.Thread(target=lambda: result.extend(FirmwareMaker.watch_firmware(
+                settings, output, fill_byte, buffer_size, copy_method, method=watch_method,
+                callback=report_patch, stop=stop, verbose=verbose)))
+            watcher.start()
+
+            print "Watching {0:s} ===> {1:s}, Ctrl-C to stop".format(conf, output)
+            try:
+                while watcher.is_alive():
+                    watcher.join(0.5)
+            except KeyboardInterrupt:
+                stop.set()
+                watcher.join()
+
+            if result and not result[0]:
+                print result[1]
+                sys.exit(1)
+
+            sys.exit()
+
+        # Make split output and flash plan
+        if split:
+            ret, err_or_plan = FirmwareMaker.make_flash_plan(settings, split, since, fill_byte, trim,
+                                                             copy_method, verbose, buffer_size)
+            if not ret:
+                print err_or_plan
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, flash: {2:d} bytes, erase: {3:d} bytes, skipped: {4:d} bytes, " \
+                  "firmware: {5:d} bytes".format(conf, split, err_or_plan.get("flash_bytes"),
+                                                 err_or_plan.get("erase_bytes"), err_or_plan.get("skipped_bytes"),
+                                                 err_or_plan.get("image_bytes"))
+            sys.exit()
+
+        # Make sparse image
+        if simg:
+            ret, err_or_md5 = FirmwareMaker.make_sparse_image(settings, output, fill_byte, dont_care,
+                                                              verbose=verbose, buffer_size=buffer_size)
+            if not ret:
+                print err_or_md5
+                sys.exit(1)
+
+            print "Success, {0:s} ===> {1:s}, raw md5: {2:s}".format(conf, output, err_or_md5)
+            sys.exit()
+
         # Make firmware
-        ret, err_or_md5 = FirmwareMaker.make_firmware(settings, output, verbose)
+        ret, err_or_md5 = FirmwareMaker.make_firmware(settings, output, verbose, buffer_size,
+                                                      copy_method, sparse, fill_byte,
+                                                      page_size if page_map else 0, block_size, incremental,
+                                                      build_cache(cache_dir, cache_size) if cache else None, manifest,
+                                                      read_ahead=read_ahead, compress=compress,
+                                                      compress_workers=workers, stats=stats)
+        if show_stats:
+            print "\n".join(stats.report())
+
+        if stats_json:
+            stats.dump(stats_json)
+
         if not ret:
             print "Generate firmware error:{0:s}".format(err_or_md5)
             sys.exit()
 
         print "Success, {0:s} ===> {1:s}, md5: {2:s}".format(conf, output, err_or_md5)
 
+        if sparse:
+            logical, allocated = allocated_size(output)
+            print "Logical size: {0:d}, allocated size: {1:d}".format(logical, allocated)
+
     except getopt.GetoptError, error:
 
         print "Error:", error
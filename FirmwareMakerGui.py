@@ -3,29 +3,84 @@
 import os
 import sys
 import json
-import icon_rc
-from PySide.QtGui import *
-from PySide.QtCore import *
-from fwmaker import FirmwareMaker
+import time
+from PySide.QtCore import Qt, QThread, QTimer, Signal
+from PySide.QtGui import QApplication, QComboBox, QFileDialog, QGridLayout, QGroupBox, QHBoxLayout, QIcon, QLabel, \
+    QLayout, QLineEdit, QMessageBox, QProgressDialog, QPushButton, QSpinBox, QSplitter, QVBoxLayout, QWidget
+import fwdefaults
 from PyAppFramework.gui.container import ComponentManager
 
 
+class FirmwareBuildWorker(QThread):
+    """Make firmware in background thread, keep ui responsive"""
+
+    # name, partition done, partition total, firmware done, firmware total
+    progressUpdated = Signal(object, object, object, object, object)
+
+    # result, err_or_md5
+    buildFinished = Signal(bool, object)
+
+    # Min interval between two progress signals (seconds)
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, layout, output, parent=None):
+        super(FirmwareBuildWorker, self).__init__(parent)
+        self.layout = layout
+        self.output = output
+        self.cancelled = False
+        self.last_report = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __progress(self, name, done, total, image_done, image_total):
+        now = time.time()
+        if now - self.last_report >= self.PROGRESS_INTERVAL or image_done == image_total:
+            self.last_report = now
+            self.progressUpdated.emit(name, done, total, image_done, image_total)
+
+        return not self.cancelled
+
+    def run(self):
+        from fwmaker import FirmwareMaker
+        result, err_or_md5 = FirmwareMaker.make_firmware(self.layout, self.output, progress=self.__progress)
+        self.buildFinished.emit(result, err_or_md5)
+
+
 class FirmwareMakerGui(QWidget):
 
     SINGLE_FILE_MAXSIZE = 100 * 1024
+    PROGRESS_RANGE = 1000
 
     def __init__(self, parent=None):
         super(FirmwareMakerGui, self).__init__(parent)
-        self.fwmaker = FirmwareMaker()
+        self.worker = None
+        self.progress = None
+        self.build_start = 0.0
+        self.build_configure = None
 
         self.components = list()
         self.__init_ui()
-        self.__init_data()
         self.__init_signal_slots()
 
+        # Runs once event loop starts, after window is shown and painted
+        QTimer.singleShot(0, self.__init_deferred)
+
+    @property
+    def fwmaker(self):
+        # fwmaker (json, hashlib, mmap, threading ...) is imported on first use, not before window is shown
+        from fwmaker import FirmwareMaker
+        return FirmwareMaker
+
+    def __init_deferred(self):
+        # Registers :/icon resources
+        import icon_rc
+        self.setWindowIcon(QIcon(":/icon/icon.ico"))
+        self.__init_data()
+
     def __init_ui(self):
         self.component_list = QComboBox()
-        self.component_list.addItems(self.fwmaker.DEFAULT_FILE_LIST)
+        self.component_list.addItems(fwdefaults.DEFAULT_FILE_LIST)
         self.add = QPushButton("Add")
         self.load = QPushButton("Load")
         self.store = QPushButton("Save as")
@@ -60,18 +115,17 @@ class FirmwareMakerGui(QWidget):
         self.def_height = 120
         self.setFixedSize(self.def_width, self.def_height)
         self.setWindowTitle("AT91 FirmwareMaker")
-        self.setWindowIcon(QIcon(":/icon/icon.ico"))
 
     def __init_data(self):
         # Load configure file
-        result, configure = self.fwmaker.load_configure(self.fwmaker.DEF_SETTING_PATH)
+        result, configure = self.fwmaker.load_configure(fwdefaults.DEF_SETTING_PATH)
         if not result:
             return
 
         # Check configure file
         result, error = self.fwmaker.check_configure(configure)
         if not result:
-            print "Load default setting: {0:s}, error: {1:s}".format(self.fwmaker.DEF_SETTING_PATH, error)
+            print "Load default setting: {0:s}, error: {1:s}".format(fwdefaults.DEF_SETTING_PATH, error)
             return
 
         # Sync ui
@@ -99,12 +153,13 @@ class FirmwareMakerGui(QWidget):
                 self.component_list.removeItem(0)
 
             self.components = list()
-            self.component_list.addItems(self.fwmaker.DEFAULT_FILE_LIST)
+            self.component_list.addItems(fwdefaults.DEFAULT_FILE_LIST)
 
             # According configure add new elements
-            for component in configure:
-                name = component.keys()[0].encode("utf-8")
-                setting = component.get(name)
+            from fwmaker import Layout
+            for partition in Layout.compile(configure):
+                name = partition.name.encode("utf-8")
+                setting = {"path": partition.path, "size": partition.size, "offset": partition.offset}
                 for idx in range(self.component_list.count()):
                     if self.component_list.itemText(idx) == name:
                         self.component_list.setCurrentIndex(idx)
@@ -129,7 +184,7 @@ class FirmwareMakerGui(QWidget):
 
         self.add.setEnabled(self.component_list.count())
         self.component_list.setEnabled(self.component_list.count())
-        self.generate.setEnabled(self.component_list.count() != len(self.fwmaker.DEFAULT_FILE_LIST))
+        self.generate.setEnabled(self.component_list.count() != len(fwdefaults.DEFAULT_FILE_LIST))
         self.setFixedSize(self.def_width, self.def_height + 40 * (6 - self.component_list.count()))
 
     def __get_component_setting(self, component):
@@ -158,8 +213,8 @@ class FirmwareMakerGui(QWidget):
             return False
 
         if "size" in setting.keys() and "offset" in setting.keys() and "path" in setting.keys():
-            setting["size"] = self.fwmaker.str2number(setting.get("size")) / 1024
-            setting["offset"] = self.fwmaker.str2number(setting.get("offset")) / 1024
+            setting["size"] = fwdefaults.str2number(setting.get("size")) / 1024
+            setting["offset"] = fwdefaults.str2number(setting.get("offset")) / 1024
         else:
             return False
 
@@ -324,19 +379,63 @@ class FirmwareMakerGui(QWidget):
         if len(output) == 0:
             return
 
-        # Start make firmware
-        result, err_or_md5 = self.fwmaker.make_firmware(configure, output)
+        # Start make firmware in background thread
+        from fwmaker import Layout
+        self.build_configure = configure
+        self.worker = FirmwareBuildWorker(Layout.compile(configure), output, self)
+        self.worker.progressUpdated.connect(self.slot_update_progress)
+        self.worker.buildFinished.connect(self.slot_build_finished)
+
+        self.progress = QProgressDialog(self.tr("Generating firmware..."), self.tr("Cancel"),
+                                        0, self.PROGRESS_RANGE, self)
+        self.progress.setWindowTitle(self.tr("Generate"))
+        self.progress.setWindowModality(Qt.WindowModal)
+        self.progress.setMinimumDuration(0)
+        self.progress.setAutoClose(False)
+        self.progress.setAutoReset(False)
+        self.progress.canceled.connect(self.worker.cancel)
+
+        self.generate.setDisabled(True)
+        self.build_start = time.time()
+        self.worker.start()
+
+    def slot_update_progress(self, name, done, total, image_done, image_total):
+        if not isinstance(self.progress, QProgressDialog):
+            return
+
+        elapsed = max(time.time() - self.build_start, 0.001)
+        self.progress.setValue(int(image_done * self.PROGRESS_RANGE / max(image_total, 1)))
+        self.progress.setLabelText(self.tr("Writing {0:s}: {1:d}K / {2:d}K\n{3:.1f} MB/s".
+                                           format(name, done / 1024, total / 1024, image_done / elapsed / 1048576)))
+
+    def slot_build_finished(self, result, err_or_md5):
+        self.worker.wait()
+        self.worker = None
+        self.generate.setEnabled(True)
+
+        if isinstance(self.progress, QProgressDialog):
+            self.progress.canceled.disconnect()
+            self.progress.close()
+            self.progress = None
 
         if not result:
             QMessageBox.critical(self, self.tr("Error"), self.tr(err_or_md5))
             return
         else:
-            with open(self.fwmaker.DEF_SETTING_PATH, "wb") as fp:
-                    json.dump(configure, fp, indent=4)
+            with open(fwdefaults.DEF_SETTING_PATH, "wb") as fp:
+                    json.dump(self.build_configure, fp, indent=4)
 
             QMessageBox.information(self, self.tr("Success"),
                                     self.tr("Firmware generate success!\nMd5: {0:s}".format(err_or_md5)))
 
+    def closeEvent(self, event):
+        # Cancel running build, partial firmware is removed by worker
+        if isinstance(self.worker, FirmwareBuildWorker):
+            self.worker.cancel()
+            self.worker.wait()
+
+        event.accept()
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Compare component copy methods of FirmwareMaker.make_firmware
+
+Usage: python benchmark/bench_copy.py [-s image size] [-r repeat] [-d work directory]
+"""
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fwmaker import FirmwareMaker
+from fastcopy import COPY_AUTO, COPY_METHODS, available_methods
+
+
+def generate_components(directory, image_size):
+    """Generate bootstrap, kernel and rootfs with random data, layout likes README example
+
+    :param directory: components directory
+    :param image_size: firmware image size
+    :return: settings
+    """
+    layout = (("bootstrap", 0, 16 * 1024),
+              ("kernel", image_size / 8, image_size / 4),
+              ("rootfs", image_size / 2, image_size / 2))
+
+    settings = list()
+    for name, offset, size in layout:
+        path = os.path.join(directory, "{0:s}.bin".format(name))
+        with open(path, "wb") as fp:
+            remain = size - 1024
+            chunk = os.urandom(1024 * 1024)
+            while remain > 0:
+                fp.write(chunk[:remain])
+                remain -= len(chunk)
+
+        settings.append(FirmwareMaker.generate_configure(name, path, size, offset))
+
+    return settings
+
+
+def drop_output(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    repeat = 3
+    directory = None
+    image_size = 256 * 1024 * 1024
+
+    opts, args = getopt.getopt(sys.argv[1:], "s:r:d:", ["size=", "repeat=", "dir="])
+    for option, argument in opts:
+        if option in ("-s", "--size"):
+            image_size = FirmwareMaker.str2number(argument)
+        elif option in ("-r", "--repeat"):
+            repeat = int(argument)
+        elif option in ("-d", "--dir"):
+            directory = argument
+
+    work_dir = tempfile.mkdtemp(dir=directory)
+
+    try:
+
+        settings = generate_components(work_dir, image_size)
+        output = os.path.join(work_dir, "firmware.bin")
+        print "Image size: {0:d}MB, repeat: {1:d}, directory: {2:s}".format(image_size >> 20, repeat, work_dir)
+        print "Available methods: {0:s}".format(available_methods())
+
+        md5 = None
+        for method in COPY_METHODS + [COPY_AUTO]:
+            best = None
+            for _ in range(repeat):
+                drop_output(output)
+                start = time.time()
+                ret, err_or_md5 = FirmwareMaker.make_firmware(settings, output, copy_method=method)
+                elapsed = time.time() - start
+                if not ret:
+                    print err_or_md5
+                    sys.exit(1)
+
+                best = elapsed if best is None else min(best, elapsed)
+
+            # All methods must generate identical firmware
+            if md5 is not None and md5 != err_or_md5:
+                print "{0:s} md5 mismatch: {1:s} != {2:s}".format(method, err_or_md5, md5)
+                sys.exit(1)
+
+            md5 = err_or_md5
+            print "{0:16s}{1:8.3f}s\t{2:8.1f}MB/s".format(method, best, image_size / best / 1024 / 1024)
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Measure FirmwareMaker.make_delta/apply_delta delta size and throughput
+
+Old firmware is bootstrap, kernel and rootfs with random data, new firmware simulates typical changes:
+
+    kernel-patch    a few bytes inserted and removed in kernel, data after them is shifted
+    rootfs-files    some rootfs blocks rewritten
+    kernel-rebuild  compressed kernel fully changed (worst case, rolling hash scans every byte)
+
+Usage: python benchmark/bench_delta.py [-s image size] [-r repeat] [-b block size] [-d work directory]
+"""
+
+import os
+import sys
+import time
+import getopt
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fwmaker import FirmwareMaker
+from fwdelta import DEF_BLOCK_SIZE
+
+
+def random_data(size):
+    return os.urandom(size)
+
+
+def write_components(directory, suffix, components):
+    settings = list()
+    for name, offset, size, data in components:
+        path = os.path.join(directory, "{0:s}{1:s}.bin".format(name, suffix))
+        with open(path, "wb") as fp:
+            fp.write(data)
+
+        settings.append(FirmwareMaker.generate_configure(name, path, size, offset))
+
+    return settings
+
+
+def kernel_patch(kernel, rootfs):
+    data = bytearray(kernel)
+    for _ in range(8):
+        position = random.randint(0, len(data) - 4096)
+        if random.randint(0, 1):
+            data[position:position] = os.urandom(random.randint(1, 256))
+        else:
+            del data[position:position + random.randint(1, 256)]
+
+    return str(data), rootfs
+
+
+def rootfs_files(kernel, rootfs):
+    data = bytearray(rootfs)
+    for _ in range(16):
+        position = random.randint(0, len(data) - 65536)
+        data[position:position + 65536] = os.urandom(65536)
+
+    return kernel, str(data)
+
+
+def kernel_rebuild(kernel, rootfs):
+    return random_data(len(kernel)), rootfs
+
+
+if __name__ == '__main__':
+    repeat = 3
+    directory = None
+    image_size = 64 * 1024 * 1024
+    block_size = DEF_BLOCK_SIZE
+
+    opts, args = getopt.getopt(sys.argv[1:], "s:r:b:d:", ["size=", "repeat=", "block=", "dir="])
+    for option, argument in opts:
+        if option in ("-s", "--size"):
+            image_size = FirmwareMaker.str2number(argument)
+        elif option in ("-r", "--repeat"):
+            repeat = int(argument)
+        elif option in ("-b", "--block"):
+            block_size = FirmwareMaker.str2number(argument)
+        elif option in ("-d", "--dir"):
+            directory = argument
+
+    work_dir = tempfile.mkdtemp(dir=directory)
+
+    try:
+
+        layout = (("bootstrap", 0, 16 * 1024), ("kernel", image_size / 8, image_size / 4),
+                  ("rootfs", image_size / 2, image_size / 2))
+        bootstrap = random_data(9000)
+        kernel = random_data(layout[1][2] * 3 / 4)
+        rootfs = random_data(layout[2][2] * 3 / 4)
+
+        old_settings = write_components(work_dir, "-old", [layout[0] + (bootstrap,), layout[1] + (kernel,),
+                                                           layout[2] + (rootfs,)])
+        old = os.path.join(work_dir, "old.bin")
+        new = os.path.join(work_dir, "new.bin")
+        delta = os.path.join(work_dir, "firmware.delta")
+        output = os.path.join(work_dir, "output.bin")
+        FirmwareMaker.make_firmware(old_settings, old)
+
+        print "Image size: {0:d}MB, block size: {1:d}, repeat: {2:d}".format(image_size >> 20, block_size, repeat)
+        print "{0:16s}{1:>12s}{2:>10s}{3:>14s}{4:>14s}".format("change", "delta", "ratio", "generate", "apply")
+
+        for change in (kernel_patch, rootfs_files, kernel_rebuild):
+            new_kernel, new_rootfs = change(kernel, rootfs)
+            new_settings = write_components(work_dir, "-new", [layout[0] + (bootstrap,), layout[1] + (new_kernel,),
+                                                               layout[2] + (new_rootfs,)])
+            ret, md5 = FirmwareMaker.make_firmware(new_settings, new)
+
+            generate = apply = None
+            stats = None
+            for _ in range(repeat):
+                start = time.time()
+                ret, stats = FirmwareMaker.make_delta(old, new, delta, old_settings, new_settings, block_size)
+                generated = time.time()
+                ret, err_or_md5 = FirmwareMaker.apply_delta(old, delta, output)
+                finished = time.time()
+
+                if not ret or err_or_md5 != md5:
+                    print "Error: apply delta failed, {0:s}".format(err_or_md5)
+                    sys.exit(1)
+
+                generate = min(generate or generated - start, generated - start)
+                apply = min(apply or finished - generated, finished - generated)
+
+            size = os.path.getsize(new)
+            print "{0:16s}{1:11d}K{2:9.2f}%{3:9.1f}MB/s{4:9.1f}MB/s".\
+                format(change.__name__.replace("_", "-"), stats.get("delta_size") >> 10,
+                       stats.get("delta_size") * 100.0 / size, size / generate / 1024 / 1024,
+                       size / apply / 1024 / 1024)
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
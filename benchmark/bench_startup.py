@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Measure cold start of the command line and GUI tools
+
+Every run is a fresh interpreter process, like the PyInstaller executables started on a factory PC:
+
+    python      python -c pass, interpreter start alone
+    help        FirmwareMaker.py -h
+    default     FirmwareMaker.py -d, settings file is generated in work directory
+    verify      FirmwareMaker.py --verify of a small firmware (3 components)
+    build       FirmwareMaker.py of the same small firmware
+    gui         import FirmwareMakerGui (skipped if PySide is not installed)
+
+Sources are compiled before measuring, so module loading is measured instead of compiling (PyInstaller
+bundles byte code too). Best and median wall time of repeat runs are reported.
+
+With -t each case runs once more with __import__ hooked, modules are listed by self time (loading the
+module minus its nested imports) with cumulative time, the top entries show what a command pays for.
+
+Usage: python benchmark/bench_startup.py [-r repeat] [-c case list] [-t top modules] [-d work directory]
+        [-o result json]
+
+Example: python benchmark/bench_startup.py -r 20 -t 10 -o startup.json
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, "FirmwareMaker.py")
+GUI = "FirmwareMakerGui"
+CASES = ("python", "help", "default", "verify", "build", "gui")
+COMPONENT_SIZE = 64 * 1024
+
+
+def trace_imports(target, args, path):
+    """Run script (or import module) in this process with __import__ hooked, write import records to path
+
+    :param target: script path, or module name
+    :param args: script arguments
+    :param path: json output path, {"total", "modules", "imports": {name: [cumulative, self]}}
+    :return: None
+    """
+    import runpy
+    import __builtin__
+
+    original = __builtin__.__import__
+    nested = list()
+    records = dict()
+
+    def hooked_import(name, *args, **kwargs):
+        before = len(sys.modules)
+        start = time.time()
+        nested.append(0.0)
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            child = nested.pop()
+            elapsed = time.time() - start
+            if nested:
+                nested[-1] += elapsed
+
+            # Already loaded modules cost nothing worth reporting
+            if len(sys.modules) != before:
+                cumulative, own = records.get(name, (0.0, 0.0))
+                records[name] = (cumulative + elapsed, own + elapsed - child)
+
+    start = time.time()
+    __builtin__.__import__ = hooked_import
+    try:
+        if target.endswith(".py"):
+            sys.argv = [target] + args
+            sys.path[0] = os.path.dirname(target)
+            runpy.run_path(target, run_name="__main__")
+        else:
+            sys.path.insert(0, ROOT)
+            __import__(target)
+    except SystemExit:
+        pass
+    finally:
+        __builtin__.__import__ = original
+
+    import json
+    with open(path, "w") as fp:
+        json.dump({"total": time.time() - start, "imports": records,
+                   "modules": len([module for module in sys.modules.values() if module is not None])}, fp)
+
+
+def prepare(directory):
+    """Generate components, settings file and firmware used by verify and build cases
+
+    :return: settings file path, firmware path
+    """
+    sys.path.insert(0, ROOT)
+    from fwmaker import FirmwareMaker
+
+    settings = list()
+    for index, name in enumerate(FirmwareMaker.ESSENTIAL_FILE_LIST):
+        path = os.path.join(directory, "{0:s}.bin".format(name))
+        with open(path, "wb") as fp:
+            fp.write(os.urandom(COMPONENT_SIZE))
+
+        settings.append(FirmwareMaker.generate_configure(name, path, COMPONENT_SIZE * 2, index * COMPONENT_SIZE * 2))
+
+    conf = os.path.join(directory, "bench.json")
+    with open(conf, "w") as fp:
+        json.dump(settings, fp, indent=4)
+
+    firmware = os.path.join(directory, "verify.bin")
+    ret, err_or_md5 = FirmwareMaker.make_firmware(FirmwareMaker.load_configure(conf)[1], firmware)
+    if not ret:
+        raise ValueError(err_or_md5)
+
+    return conf, firmware
+
+
+def case_commands(directory, conf, firmware):
+    """Get case commands
+
+    :return: {case: (interpreter arguments, trace target, trace arguments)}
+    """
+    commands = {
+        "python": (["-c", "pass"], None, None),
+        "help": ([CLI, "-h"], CLI, ["-h"]),
+        "default": ([CLI, "-d"], CLI, ["-d"]),
+        "verify": ([CLI, "--verify", "-c", conf, "-o", firmware], CLI, ["--verify", "-c", conf, "-o", firmware]),
+        "build": ([CLI, "-c", conf, "-o", os.path.join(directory, "build.bin")], CLI,
+                  ["-c", conf, "-o", os.path.join(directory, "build.bin")]),
+    }
+
+    try:
+        imp.find_module("PySide")
+        commands["gui"] = (["-c", "import sys; sys.path.insert(0, {0!r}); import {1:s}".format(ROOT, GUI)], GUI, [])
+    except ImportError:
+        pass
+
+    return commands
+
+
+def run(arguments, directory):
+    """Run interpreter with arguments in directory
+
+    :return: wall time, raise ValueError if command failed
+    """
+    with open(os.devnull, "w") as null:
+        start = time.time()
+        code = subprocess.call([sys.executable] + arguments, cwd=directory, stdout=null, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+
+    if code:
+        raise ValueError("{0:s} exit code: {1:d}".format(" ".join(arguments), code))
+
+    return elapsed
+
+
+if __name__ == '__main__':
+    # Child process of import breakdown
+    if len(sys.argv) > 2 and sys.argv[1].startswith("--trace="):
+        trace_imports(sys.argv[2], sys.argv[3:], sys.argv[1][len("--trace="):])
+        sys.exit()
+
+    # Not imported at module top, the tracing child above must not have them loaded before the traced script
+    import imp
+    import json
+    import getopt
+    import shutil
+    import tempfile
+    import compileall
+    import subprocess
+
+    repeat = 10
+    top = 0
+    directory = None
+    result_path = None
+    cases = list(CASES)
+
+    opts, args = getopt.getopt(sys.argv[1:], "r:c:t:d:o:", ["repeat=", "case=", "top=", "dir=", "output="])
+    for option, argument in opts:
+        if option in ("-r", "--repeat"):
+            repeat = int(argument)
+        elif option in ("-c", "--case"):
+            cases = [case for case in argument.split(",") if case in CASES]
+        elif option in ("-t", "--top"):
+            top = int(argument)
+        elif option in ("-d", "--dir"):
+            directory = argument
+        elif option in ("-o", "--output"):
+            result_path = argument
+
+    compileall.compile_dir(ROOT, maxlevels=0, quiet=True)
+    work_dir = tempfile.mkdtemp(dir=directory)
+    results = dict()
+
+    try:
+
+        commands = case_commands(work_dir, *prepare(work_dir))
+        print "{0:10s}{1:>10s}{2:>10s}{3:>10s}".format("case", "best", "median", "modules")
+
+        for case in cases:
+            if case not in commands:
+                results[case] = {"skipped": "PySide is not installed"}
+                print "{0:10s}skipped, PySide is not installed".format(case)
+                continue
+
+            arguments, target, target_args = commands.get(case)
+            try:
+                times = sorted(run(arguments, work_dir) for _ in range(repeat))
+            except ValueError, e:
+                results[case] = {"error": "{0:s}".format(e)}
+                print "{0:10s}error: {1:s}".format(case, e)
+                continue
+
+            result = {"best": times[0], "median": times[len(times) // 2], "times": times}
+            if target:
+                trace = os.path.join(work_dir, "trace.json")
+                run(["-B", os.path.abspath(__file__), "--trace=" + trace, target] + target_args, work_dir)
+                with open(trace) as fp:
+                    result.update(json.load(fp))
+
+            results[case] = result
+            print "{0:10s}{1:8.1f}ms{2:8.1f}ms{3:>10s}".format(case, result.get("best") * 1000,
+                                                              result.get("median") * 1000,
+                                                              str(result.get("modules", "-")))
+
+        for case in cases:
+            imports = results.get(case, {}).get("imports")
+            if not top or not imports:
+                continue
+
+            print "\n{0:s}: {1:.1f}ms in hooked run, {2:d} modules".\
+                format(case, results[case].get("total") * 1000, results[case].get("modules"))
+            print "{0:32s}{1:>10s}{2:>12s}".format("module", "self", "cumulative")
+            for name, (cumulative, own) in sorted(imports.items(), key=lambda item: -item[1][1])[:top]:
+                print "{0:32s}{1:8.2f}ms{2:10.2f}ms".format(name, own * 1000, cumulative * 1000)
+
+        if result_path:
+            with open(result_path, "w") as fp:
+                json.dump({"python": sys.version.split()[0], "platform": sys.platform, "repeat": repeat,
+                           "results": results}, fp, indent=4, sort_keys=True)
+
+        if any("error" in result for result in results.values()):
+            sys.exit(1)
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
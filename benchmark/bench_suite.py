@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the firmware assembly path with synthetic components
+
+Each case generates components and settings file for an image size, layout and partition count:
+
+    dense   components fill their reserved regions, partitions are back to back
+    sparse  components use 1/8 of their reserved regions, image is mostly gaps
+
+Stages are timed separately, best of repeat runs:
+
+    load        FirmwareMaker.load_configure (json parse, str2number, compile)
+    check       FirmwareMaker.check_configure (stat every component)
+    assemble    FirmwareMaker.make_firmware (includes inline md5)
+    hash        FirmwareMaker.hash_file of the output (final md5 pass alone)
+
+Every case runs in a child process, so peak RSS (ru_maxrss) belongs to the case. Syscall counts and bytes
+come from /proc/self/io (Linux only, otherwise they are not reported). Results are written as json,
+with --baseline a stored result is compared and stages slower than threshold are reported as regressions.
+
+Usage: python benchmark/bench_suite.py [-s image size list] [-n partition count list] [-l layout list]
+        [-r repeat] [-b buffer size] [-d work directory] [-o result json] [--baseline=json] [--threshold=percent]
+
+Example: python benchmark/bench_suite.py -s 1M,64M,1024M -n 3,1000 -o result.json
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import getopt
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fwmaker import FirmwareMaker
+
+LAYOUTS = {"dense": 1.0, "sparse": 0.125}
+STAGES = ("load", "check", "assemble", "hash")
+PATTERN_SIZE = 1024 * 1024
+ALIGNMENT = 4096
+
+
+def size2str(size):
+    return "{0:d}M".format(size >> 20) if size >= 1024 * 1024 else "{0:d}K".format(size >> 10)
+
+
+def write_component(path, size, pattern):
+    with open(path, "wb") as fp:
+        while size > 0:
+            fp.write(buffer(pattern, 0, min(size, len(pattern))))
+            size -= len(pattern)
+
+
+def generate_case(directory, image_size, count, layout):
+    """Generate components and settings file, first partitions are named bootstrap, kernel and rootfs
+
+    :param directory: case directory
+    :param image_size: reserved size of all partitions
+    :param count: partition count
+    :param layout: "dense" or "sparse"
+    :return: settings file path
+    """
+    pattern = os.urandom(PATTERN_SIZE)
+    slot = max(image_size // count // ALIGNMENT * ALIGNMENT, ALIGNMENT)
+    length = max(int(slot * LAYOUTS.get(layout)), 1)
+
+    settings = list()
+    for index in range(count):
+        name = FirmwareMaker.ESSENTIAL_FILE_LIST[index] if index < len(FirmwareMaker.ESSENTIAL_FILE_LIST) \
+            else "part{0:d}".format(index)
+        path = os.path.join(directory, "{0:s}.bin".format(name))
+        write_component(path, length, pattern)
+        settings.append(FirmwareMaker.generate_configure(name, path, slot, index * slot))
+
+    conf = os.path.join(directory, "settings.json")
+    with open(conf, "w") as fp:
+        json.dump(settings, fp, indent=4)
+
+    return conf
+
+
+def io_counters():
+    """Get process io counters
+
+    :return: {"syscr", "syscw", "rchar", "wchar"}, None if /proc/self/io is not available
+    """
+    try:
+
+        with open("/proc/self/io") as fp:
+            counters = dict(line.split(":") for line in fp.read().splitlines() if ":" in line)
+            return {key: int(counters.get(key)) for key in ("syscr", "syscw", "rchar", "wchar")}
+
+    except (IOError, ValueError, TypeError):
+        return None
+
+
+def measure(func, *args):
+    """Call func, measure duration and io counters
+
+    :return: func result, {"time", "syscr", "syscw", "rchar", "wchar"}
+    """
+    before = io_counters()
+    start = time.time()
+    result = func(*args)
+    stats = {"time": time.time() - start}
+    after = io_counters()
+    if before and after:
+        stats.update({key: after.get(key) - before.get(key) for key in before})
+
+    return result, stats
+
+
+def run_case(conf, output, repeat, buffer_size, queue):
+    """Run all stages repeat times in child process, best run of each stage is reported"""
+    try:
+
+        best = dict()
+        image_size = None
+        for _ in range(repeat):
+            if os.path.exists(output):
+                os.remove(output)
+
+            (ret, layout), load = measure(FirmwareMaker.load_configure, conf)
+            if not ret:
+                raise ValueError(layout)
+
+            (ret, err), check = measure(FirmwareMaker.check_configure, layout)
+            if not ret:
+                raise ValueError(err)
+
+            (ret, err_or_md5), assemble = measure(FirmwareMaker.make_firmware, layout, output, False, buffer_size)
+            if not ret:
+                raise ValueError(err_or_md5)
+
+            md5, digest = measure(FirmwareMaker.hash_file, output)
+            if md5.hexdigest() != err_or_md5:
+                raise ValueError("md5 mismatch: {0:s} != {1:s}".format(md5.hexdigest(), err_or_md5))
+
+            image_size = os.path.getsize(output)
+            for name, stats in zip(STAGES, (load, check, assemble, digest)):
+                if name not in best or stats.get("time") < best[name].get("time"):
+                    best[name] = stats
+
+        for name in ("assemble", "hash"):
+            best[name]["mbps"] = image_size / max(best[name].get("time"), 1e-9) / 1024 / 1024
+
+        queue.put({"image_size": image_size, "stages": best,
+                   "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})
+
+    except Exception, e:
+        # Any failure (e.g. MemoryError of large cases) must reach parent, it is waiting for a result
+        queue.put({"error": "{0:s}: {1:s}".format(type(e).__name__, e)})
+
+
+def wait_result(process, queue):
+    """Wait for case result, a child killed by signal (e.g. OOM killer) never puts one
+
+    :return: case result
+    """
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            if process.is_alive():
+                continue
+
+        try:
+            return queue.get_nowait()
+        except Queue.Empty:
+            return {"error": "case process exited with code {0}".format(process.exitcode)}
+
+
+def compare(results, baseline, threshold):
+    """Compare stage time with baseline
+
+    :return: regression message list
+    """
+    regressions = list()
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base or "error" in base or "error" in result:
+            continue
+
+        for name in STAGES:
+            old, new = base["stages"][name].get("time"), result["stages"][name].get("time")
+            # Stages shorter than 1ms are noise
+            if max(old, new) > 0.001 and new > old * (1 + threshold / 100.0):
+                regressions.append("{0:s} {1:s}: {2:.2f}ms ===> {3:.2f}ms, +{4:.1f}%".
+                                   format(key, name, old * 1000, new * 1000, (new / old - 1) * 100))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    repeat = 3
+    directory = None
+    result_path = None
+    baseline_path = None
+    threshold = 10
+    buffer_size = FirmwareMaker.DEF_BUFFER_SIZE
+    sizes = [1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+    counts = [3, 100, 1000]
+    layouts = ["dense", "sparse"]
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:n:l:r:b:d:o:", ["help", "size=", "count=", "layout=", "repeat=",
+                                                                     "buffer=", "dir=", "output=", "baseline=",
+                                                                     "threshold="])
+    except getopt.GetoptError, error:
+        print "Error:", error
+        print __doc__
+        sys.exit(2)
+
+    for option, argument in opts:
+        if option in ("-h", "--help"):
+            print __doc__
+            sys.exit()
+        elif option in ("-s", "--size"):
+            sizes = [FirmwareMaker.str2number(size) for size in argument.split(",")]
+        elif option in ("-n", "--count"):
+            counts = [int(count) for count in argument.split(",")]
+        elif option in ("-l", "--layout"):
+            layouts = [layout for layout in argument.split(",") if layout in LAYOUTS]
+        elif option in ("-r", "--repeat"):
+            repeat = int(argument)
+        elif option in ("-b", "--buffer"):
+            buffer_size = FirmwareMaker.str2number(argument)
+        elif option in ("-d", "--dir"):
+            directory = argument
+        elif option in ("-o", "--output"):
+            result_path = argument
+        elif option == "--baseline":
+            baseline_path = argument
+        elif option == "--threshold":
+            threshold = float(argument)
+
+    work_dir = tempfile.mkdtemp(dir=directory)
+    results = dict()
+
+    try:
+
+        print "{0:24s}{1:>10s}{2:>10s}{3:>12s}{4:>12s}{5:>10s}{6:>10s}{7:>10s}".\
+            format("case", "load", "check", "assemble", "hash", "rss", "syscr", "syscw")
+
+        for image_size in sizes:
+            for layout in layouts:
+                for count in counts:
+                    key = "{0:s}-{1:s}-{2:d}".format(size2str(image_size), layout, count)
+                    case_dir = os.path.join(work_dir, key)
+                    os.mkdir(case_dir)
+
+                    conf = generate_case(case_dir, image_size, count, layout)
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process(target=run_case, args=(conf, os.path.join(case_dir, "fw.bin"),
+                                                                             repeat, buffer_size, queue))
+                    process.start()
+                    result = wait_result(process, queue)
+                    process.join()
+                    shutil.rmtree(case_dir, ignore_errors=True)
+
+                    result["case"] = {"image_size": image_size, "layout": layout, "count": count}
+                    results[key] = result
+                    if "error" in result:
+                        print "{0:24s}error: {1:s}".format(key, result.get("error"))
+                        continue
+
+                    stages = result.get("stages")
+                    syscalls = [sum(stats.get(name, 0) for stats in stages.values()) for name in ("syscr", "syscw")]
+                    print "{0:24s}{1:8.2f}ms{2:8.2f}ms{3:7.1f}MB/s{4:7.1f}MB/s{5:8d}MB{6:10d}{7:10d}".\
+                        format(key, stages["load"].get("time") * 1000, stages["check"].get("time") * 1000,
+                               stages["assemble"].get("mbps"), stages["hash"].get("mbps"),
+                               result.get("peak_rss") >> 20, syscalls[0], syscalls[1])
+
+        if result_path:
+            with open(result_path, "w") as fp:
+                json.dump({"python": sys.version.split()[0], "platform": sys.platform, "repeat": repeat,
+                           "buffer_size": buffer_size, "results": results}, fp, indent=4, sort_keys=True)
+
+        if baseline_path:
+            with open(baseline_path) as fp:
+                regressions = compare(results, json.load(fp).get("results", {}), threshold)
+
+            for regression in regressions:
+                print "Regression:", regression
+
+            print "Baseline: {0:s}, {1:d} regressions (threshold {2:.0f}%)".\
+                format(baseline_path, len(regressions), threshold)
+            if regressions:
+                sys.exit(1)
+
+        if any("error" in result for result in results.values()):
+            sys.exit(1)
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Measure FirmwareMaker.validate_layout with large synthetic layouts
+
+Each layout has n partitions listed in random order, half of the runs inject overlaps and oversized
+components, validator must report all of them.
+
+Usage: python benchmark/bench_validate.py [-n partition count list] [-r repeat]
+"""
+
+import os
+import sys
+import time
+import random
+import getopt
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fwmaker import FirmwareMaker, Layout
+
+
+def generate_layout(directory, count, errors=0, block_size=0x20000):
+    """Generate shuffled layout, each partition reserves one erase block, component file is 1K
+
+    :param directory: component file directory
+    :param count: partition count
+    :param errors: inject errors count, each error is an overlap or an oversized component
+    :param block_size: erase block size
+    :return: setting list
+    """
+    small = os.path.join(directory, "small.bin")
+    large = os.path.join(directory, "large.bin")
+    with open(small, "wb") as fp:
+        fp.write("\0" * 1024)
+
+    with open(large, "wb") as fp:
+        fp.write("\0" * (block_size + 1))
+
+    names = FirmwareMaker.ESSENTIAL_FILE_LIST + ["part{0:d}".format(i) for i in range(count)]
+    settings = [FirmwareMaker.generate_configure(str(name), small, block_size, index * block_size)
+                for index, name in enumerate(names[:count])]
+
+    for index in random.sample(range(count - 1), errors):
+        name = settings[index].keys()[0]
+        if index % 2:
+            settings[index][name]["size"] = "0x{0:x}".format(block_size * 2)
+        else:
+            settings[index][name]["path"] = large
+
+    random.shuffle(settings)
+    return settings
+
+
+if __name__ == '__main__':
+    repeat = 3
+    counts = [100, 1000, 10000]
+
+    opts, args = getopt.getopt(sys.argv[1:], "n:r:", ["count=", "repeat="])
+    for option, argument in opts:
+        if option in ("-n", "--count"):
+            counts = [int(count) for count in argument.split(",")]
+        elif option in ("-r", "--repeat"):
+            repeat = int(argument)
+
+    work_dir = tempfile.mkdtemp()
+
+    try:
+
+        print "{0:>10s}{1:>10s}{2:>12s}{3:>12s}{4:>12s}".format("count", "errors", "compile", "validate", "reported")
+        for count in counts:
+            for errors in (0, count / 100 or 1):
+                settings = generate_layout(work_dir, count, errors)
+
+                compile_time = validate_time = None
+                reported = 0
+                for _ in range(repeat):
+                    start = time.time()
+                    layout = Layout.compile(settings)
+                    compiled = time.time()
+                    reported = len(FirmwareMaker.validate_layout(layout, block_size=0x20000))
+                    finished = time.time()
+
+                    compile_time = min(compile_time or compiled - start, compiled - start)
+                    validate_time = min(validate_time or finished - compiled, finished - compiled)
+
+                if reported != errors:
+                    print "Error: {0:d} errors injected, {1:d} reported".format(errors, reported)
+                    sys.exit(1)
+
+                print "{0:10d}{1:10d}{2:11.2f}ms{3:11.2f}ms{4:12d}".\
+                    format(count, errors, compile_time * 1000, validate_time * 1000, reported)
+
+    finally:
+
+        shutil.rmtree(work_dir, ignore_errors=True)
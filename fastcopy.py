@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""Kernel side file copy and sparse file helpers
+
+Python 2 doesn't provide os.copy_file_range, os.sendfile and fallocate, so they are called through ctypes,
+reflink clone is done with FICLONERANGE ioctl. All of them are Linux only, on other platforms
+copy_range always returns 0 and caller should fallback to user space copy, punch_hole does nothing
+and data_extents treat the whole file as data.
+
+ctypes and libc are loaded on first use (find_library may run ldconfig), importing this module is cheap.
+"""
+
+import os
+import sys
+import errno
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ['COPY_BUFFERED', 'COPY_SENDFILE', 'COPY_FILE_RANGE', 'COPY_REFLINK', 'COPY_AUTO', 'COPY_METHODS',
+           'available_methods', 'copy_range', 'punch_hole', 'data_extents', 'allocated_size', 'copy_file']
+
+COPY_AUTO = "auto"
+COPY_REFLINK = "reflink"
+COPY_SENDFILE = "sendfile"
+COPY_BUFFERED = "buffered"
+COPY_FILE_RANGE = "copy_file_range"
+
+# Fallback chain, each method fallback to the next one when it is not supported
+COPY_METHODS = [COPY_REFLINK, COPY_FILE_RANGE, COPY_SENDFILE, COPY_BUFFERED]
+
+# linux/fs.h: _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940d
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Python 2 os module doesn't define SEEK_DATA and SEEK_HOLE
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# Errors mean method is not supported by kernel or file system, not a real io error
+UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                      errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY)
+
+# Max bytes per kernel call, keep it below 2G to avoid 32bit ssize_t overflow
+MAX_CHUNK_SIZE = 0x40000000
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+
+    for name, argtypes in (("copy_file_range", [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                                ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                                ctypes.c_size_t, ctypes.c_uint]),
+                           ("sendfile64", [ctypes.c_int, ctypes.c_int,
+                                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]),
+                           ("fallocate64", [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64])):
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int if name == "fallocate64" else ctypes.c_ssize_t
+
+    return libc
+
+
+_libc = None
+
+
+def _get_libc():
+    """Get libc with kernel copy functions prototyped, None if not available"""
+    global _libc
+    if _libc is None:
+        _libc = _load_libc() or False
+
+    return _libc or None
+
+
+def available_methods():
+    """Get copy methods supported on this platform
+
+    :return: method list in fallback order
+    """
+    methods = list()
+    if fcntl is not None and sys.platform.startswith("linux"):
+        methods.append(COPY_REFLINK)
+
+    libc = _get_libc()
+    if libc is not None and hasattr(libc, "copy_file_range"):
+        methods.append(COPY_FILE_RANGE)
+
+    if libc is not None and hasattr(libc, "sendfile64"):
+        methods.append(COPY_SENDFILE)
+
+    methods.append(COPY_BUFFERED)
+    return methods
+
+
+def _reflink(src_fd, src_offset, dst_fd, dst_offset, length):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return 0
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("=qQQQ", src_fd, src_offset, length, dst_offset))
+    except IOError, e:
+        if e.errno in UNSUPPORTED_ERRORS:
+            return 0
+        raise
+
+    return length
+
+
+def _copy_file_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    libc = _get_libc()
+    if libc is None or not hasattr(libc, "copy_file_range"):
+        return 0
+
+    import ctypes
+
+    copied = 0
+    off_in = ctypes.c_int64(src_offset)
+    off_out = ctypes.c_int64(dst_offset)
+
+    while copied < length:
+        ret = libc.copy_file_range(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+                                   min(length - copied, MAX_CHUNK_SIZE), 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+
+            if err in UNSUPPORTED_ERRORS and copied == 0:
+                return 0
+
+            raise OSError(err, os.strerror(err))
+
+        # Source EOF
+        if ret == 0:
+            break
+
+        copied += ret
+
+    return copied
+
+
+def _sendfile(src_fd, src_offset, dst_fd, dst_offset, length):
+    libc = _get_libc()
+    if libc is None or not hasattr(libc, "sendfile64"):
+        return 0
+
+    import ctypes
+
+    copied = 0
+    offset = ctypes.c_int64(src_offset)
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+
+    while copied < length:
+        ret = libc.sendfile64(dst_fd, src_fd, ctypes.byref(offset), min(length - copied, MAX_CHUNK_SIZE))
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+
+            if err in UNSUPPORTED_ERRORS and copied == 0:
+                return 0
+
+            raise OSError(err, os.strerror(err))
+
+        if ret == 0:
+            break
+
+        copied += ret
+
+    return copied
+
+
+_METHOD_HANDLES = {
+    COPY_REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    COPY_SENDFILE: _sendfile,
+}
+
+
+def copy_range(src_fd, dst_fd, dst_offset, length, method=COPY_AUTO, src_offset=0):
+    """Copy length bytes of src_fd to dst_fd at dst_offset without passing data through user space
+
+    Starting from method, try each kernel copy method in COPY_METHODS order until one succeed,
+    COPY_AUTO starts from the first one (reflink)
+
+    :param src_fd: source file descriptor
+    :param dst_fd: destination file descriptor
+    :param dst_offset: destination file offset
+    :param length: bytes to copy
+    :param method: first copy method to try
+    :param src_offset: source file offset
+    :return: (method, copied), if copied < length remain data should be copied in user space
+    """
+    if method == COPY_AUTO:
+        method = COPY_METHODS[0]
+
+    if method not in COPY_METHODS:
+        raise ValueError("Unknown copy method:{0:s}".format(method))
+
+    copied = 0
+    used = COPY_BUFFERED
+    for name in COPY_METHODS[COPY_METHODS.index(method):]:
+        if name == COPY_BUFFERED or copied >= length:
+            break
+
+        ret = _METHOD_HANDLES.get(name)(src_fd, src_offset + copied, dst_fd, dst_offset + copied, length - copied)
+        if ret:
+            used = name if not copied else used
+            copied += ret
+
+    return used, copied
+
+
+def punch_hole(fd, offset, length):
+    """Deallocate file region, file size is not changed and region reads as zeros
+
+    :param fd: file descriptor (opened for writing)
+    :param offset: region offset
+    :param length: region length
+    :return: success return True, not supported return False
+    """
+    libc = _get_libc()
+    if length <= 0 or libc is None or not hasattr(libc, "fallocate64"):
+        return False
+
+    import ctypes
+    while libc.fallocate64(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+
+        if err in UNSUPPORTED_ERRORS:
+            return False
+
+        raise OSError(err, os.strerror(err))
+
+    return True
+
+
+def data_extents(fd, start=0, end=None):
+    """Iterate file data regions with SEEK_DATA/SEEK_HOLE, regions between them are holes (zeros)
+
+    When file system doesn't support SEEK_DATA the whole range is reported as one data region.
+    File position of fd is changed.
+
+    :param fd: file descriptor
+    :param start: range start offset
+    :param end: range end offset, None means file size
+    :return: generator of (offset, length)
+    """
+    end = os.fstat(fd).st_size if end is None else end
+    if not sys.platform.startswith("linux"):
+        if end > start:
+            yield start, end - start
+        return
+
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            # No more data after offset
+            if e.errno == errno.ENXIO:
+                return
+
+            if e.errno in UNSUPPORTED_ERRORS:
+                yield offset, end - offset
+                return
+
+            raise
+
+        if data >= end:
+            return
+
+        hole = min(os.lseek(fd, data, SEEK_HOLE), end)
+        yield data, hole - data
+        offset = hole
+
+
+def allocated_size(path):
+    """Get file logical size and disk allocated size
+
+    :param path: file path
+    :return: (logical size, allocated size)
+    """
+    st = os.stat(path)
+    blocks = getattr(st, "st_blocks", None)
+    return st.st_size, st.st_size if blocks is None else blocks * 512
+
+
+def copy_file(src, dst, buffer_size=COPY_BUFFER_SIZE):
+    """Clone file (reflink), or copy it where clone is not supported, holes of sparse file are kept holes
+
+    :param src: source file path
+    :param dst: destination file path, created or truncated
+    :param buffer_size: copy buffer size
+    :return: None
+    """
+    with open(src, "rb") as fp, open(dst, "wb") as fw:
+        size = os.fstat(fp.fileno()).st_size
+        # Only clone, other kernel copies fill holes
+        if size and _reflink(fp.fileno(), 0, fw.fileno(), 0, size) == size:
+            return
+
+        for offset, length in list(data_extents(fp.fileno())):
+            fp.seek(offset, os.SEEK_SET)
+            fw.seek(offset, os.SEEK_SET)
+            while length > 0:
+                data = fp.read(min(length, buffer_size))
+                if not data:
+                    break
+
+                fw.write(data)
+                length -= len(data)
+
+        fw.truncate(size)
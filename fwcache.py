@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""Content addressed firmware build cache
+
+Firmware is keyed by normalized layout (name, offset, reserved size in offset order), build options
+which change firmware content (fill byte) and each component sha256 digest, component path is not a
+part of the key. Component digests are cached by (device, inode, mtime, size), so unchanged files are
+not hashed again. Cached firmware is cloned (reflink) to output, or copied where clone is not supported,
+output is a plain writable file owned by the caller, never linked to a cache object. An instance could be
+shared by threads (e.g. build server workers), statistics are updated under a file lock, so batch worker
+processes don't lose counts either (except where fcntl is not available).
+
+Cache directory layout:
+
+    objects/<key>.bin       cached firmware, read only
+    objects/<key>.json      cached firmware md5 and size
+    digests.json            component digest cache
+    stats.json              hit and miss statistics
+    stats.lock              lock file of stats.json
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import fwdefaults
+from fastcopy import copy_file
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ['BuildCache']
+
+
+class BuildCache(object):
+
+    DEF_MAX_SIZE = fwdefaults.DEF_CACHE_SIZE
+    DEF_CACHE_DIR = fwdefaults.DEF_CACHE_DIR
+    CACHE_DIR_ENV = "FWMAKER_CACHE"
+    HASH_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, directory=None, max_size=DEF_MAX_SIZE):
+        """Build cache
+
+        :param directory: cache directory, default is $FWMAKER_CACHE or ~/.cache/at91fwmaker
+        :param max_size: max size of cached firmware, least recently used firmware is evicted when exceed
+        :return:
+        """
+        self.directory = directory or os.environ.get(self.CACHE_DIR_ENV) or self.DEF_CACHE_DIR
+        self.objects = os.path.join(self.directory, "objects")
+        self.max_size = max_size
+        self.digests = None
+        self.digests_dirty = False
+        self.lock = threading.RLock()
+
+        # Other processes (batch workers) may create it at the same time
+        try:
+            os.makedirs(self.objects)
+        except OSError:
+            if not os.path.isdir(self.objects):
+                raise
+
+    def __getstate__(self):
+        # Passed to batch worker processes, lock is not picklable
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __load_json(self, name, default):
+        try:
+
+            with open(self.__path(name)) as fp:
+                data = json.load(fp)
+
+            return data if isinstance(data, type(default)) else default
+
+        except (ValueError, IOError):
+            return default
+
+    def __store_json(self, name, data):
+        # Write to temporary file then rename, other build processes never see a partial file
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp)
+
+        os.chmod(temp, 0644)
+        os.rename(temp, self.__path(name))
+
+    def __update_stats(self, **steps):
+        # Load and store of other threads and processes are serialized by the lock file
+        with self.lock, open(self.__path("stats.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            stats = self.__load_json("stats.json", dict())
+            for key, step in steps.items():
+                stats[key] = stats.get(key, 0) + step
+            self.__store_json("stats.json", stats)
+
+    def file_digest(self, path, st=None):
+        """Get file sha256 digest, reuse cached digest if file (device, inode, mtime, size) is not changed
+
+        :param path: file path
+        :param st: file stat result if already known
+        :return: sha256 hex digest
+        """
+        with self.lock:
+            if self.digests is None:
+                self.digests = self.__load_json("digests.json", dict())
+
+        path = os.path.abspath(path)
+        st = os.stat(path) if st is None else st
+        signature = [st.st_dev, st.st_ino, st.st_mtime, st.st_size]
+
+        cached = self.digests.get(path)
+        if cached and cached[:4] == signature:
+            return cached[4]
+
+        digest = hashlib.sha256()
+        buf = bytearray(self.HASH_BUFFER_SIZE)
+        with open(path, "rb") as fp:
+            while True:
+                length = fp.readinto(buf)
+                if not length:
+                    break
+                digest.update(buffer(buf, 0, length))
+
+        with self.lock:
+            self.digests[path] = signature + [digest.hexdigest()]
+            self.digests_dirty = True
+
+        return digest.hexdigest()
+
+    def flush(self):
+        """Write component digest cache to disk
+
+        :return: None
+        """
+        with self.lock:
+            if self.digests_dirty:
+                # Merge with digests stored by other processes
+                digests = self.__load_json("digests.json", dict())
+                digests.update(self.digests)
+                self.__store_json("digests.json", digests)
+                self.digests_dirty = False
+
+    def build_key(self, layout, fill_byte=0, sparse=False):
+        """Get firmware cache key
+
+        :param layout: fwmaker.Layout or partitions sorted by offset
+        :param fill_byte: gaps fill byte
+        :param sparse: sparse firmware, cached separately because a cache hit is cloned to output as it is
+        :return: cache key (sha256 hex digest)
+        """
+        partitions = layout.by_offset() if hasattr(layout, "by_offset") else layout
+        normalized = [[partition.name, partition.offset, partition.size,
+                       self.file_digest(partition.path, partition.stat)] +
+                      (["decompress"] if getattr(partition, "decompress", False) else []) for partition in partitions]
+        key = {"layout": normalized, "fill": fill_byte}
+        if sparse:
+            key["sparse"] = True
+
+        return hashlib.sha256(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def lookup(self, key, output):
+        """Lookup firmware in cache, if hit clone (or copy) it to output, existing output is replaced
+
+        :param key: cache key
+        :param output: firmware output path
+        :return: hit return firmware md5, otherwise None
+        """
+        image = os.path.join(self.objects, key + ".bin")
+        meta = self.__load_json(os.path.join("objects", key + ".json"), dict())
+
+        if not os.path.isfile(image) or not meta.get("md5"):
+            self.__update_stats(misses=1)
+            return None
+
+        # Output may be read only or linked to another file (e.g. by an older cache version)
+        if os.path.lexists(output):
+            os.remove(output)
+
+        copy_file(image, output, self.HASH_BUFFER_SIZE)
+
+        # Access time is tracked by mtime of metadata, atime may be disabled by mount options
+        os.utime(self.__path(os.path.join("objects", key + ".json")), None)
+        self.__update_stats(hits=1, saved_bytes=meta.get("size", 0))
+        return meta.get("md5")
+
+    def store(self, key, output, md5):
+        """Store firmware into cache
+
+        :param key: cache key
+        :param output: firmware path
+        :param md5: firmware md5
+        :return: None
+        """
+        image = os.path.join(self.objects, key + ".bin")
+        fd, temp = tempfile.mkstemp(dir=self.objects)
+        os.close(fd)
+        copy_file(output, temp, self.HASH_BUFFER_SIZE)
+        os.chmod(temp, 0444)
+        os.rename(temp, image)
+
+        self.__store_json(os.path.join("objects", key + ".json"), {"md5": md5, "size": os.path.getsize(image)})
+        self.evict()
+
+    def entries(self):
+        """Get cached firmware entries
+
+        :return: [(last access time, size, key)] least recently used first
+        """
+        entries = list()
+        for name in os.listdir(self.objects):
+            key, ext = os.path.splitext(name)
+            meta = os.path.join(self.objects, key + ".json")
+            if ext != ".bin" or not os.path.isfile(meta):
+                continue
+
+            entries.append((os.path.getmtime(meta), os.path.getsize(os.path.join(self.objects, name)), key))
+
+        return sorted(entries)
+
+    def evict(self, max_size=None):
+        """Evict least recently used firmware until cache size is less than max_size
+
+        :param max_size: max cache size, default is self.max_size
+        :return: evicted bytes
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for _, size, key in entries:
+            if total - evicted <= max_size:
+                break
+
+            for ext in (".json", ".bin"):
+                path = os.path.join(self.objects, key + ext)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+            evicted += size
+
+        if evicted:
+            self.__update_stats(evicted_bytes=evicted)
+
+        return evicted
+
+    def stats(self):
+        """Get cache statistics
+
+        :return: {"hits", "misses", "saved_bytes", "evicted_bytes", "entries", "size"}
+        """
+        stats = {"hits": 0, "misses": 0, "saved_bytes": 0, "evicted_bytes": 0}
+        stats.update(self.__load_json("stats.json", dict()))
+        entries = self.entries()
+        stats["entries"] = len(entries)
+        stats["size"] = sum(size for _, size, _ in entries)
+        return stats
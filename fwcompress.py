@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""Block parallel compressed firmware output
+
+Image stream is cut into fixed size blocks, each block is compressed to an independent member (gzip member,
+bzip2 stream or xz stream) in a process pool, members are written in order. Concatenated members are a
+standard file, gzip/bzip2/xz command line tools decompress it as a whole. Block index is written to
+<compressed file>.index.json, so any range could be read by decompressing only the members covering it.
+Blocks filled with a single byte (gaps, padding) are compressed only once and reused.
+
+Compressed component inputs are read through DecompressReader, their size is taken from the container
+if recorded, see uncompressed_size.
+
+Python 2 has no lzma module, xz is only available if backports.lzma is installed.
+"""
+
+import os
+import bz2
+import zlib
+import json
+import time
+import struct
+import collections
+from fwdefaults import COMPRESS_FORMATS
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+__all__ = ['COMPRESS_GZIP', 'COMPRESS_BZIP2', 'COMPRESS_XZ', 'COMPRESS_FORMATS', 'INDEX_SUFFIX',
+           'available_formats', 'compress_block', 'ParallelCompressor', 'read_range', 'detect_format',
+           'DecompressReader', 'uncompressed_size']
+
+COMPRESS_GZIP, COMPRESS_BZIP2, COMPRESS_XZ = COMPRESS_FORMATS
+MAGICS = ((COMPRESS_GZIP, "\x1f\x8b"), (COMPRESS_BZIP2, "BZh"), (COMPRESS_XZ, "\xfd7zXZ\x00"))
+
+# Corrupt input errors, reported as ValueError
+DECOMPRESS_ERRORS = (zlib.error, IOError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+INDEX_SUFFIX = ".index.json"
+DEF_LEVEL = 6
+DEF_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def available_formats():
+    """Get compress formats supported by this python
+
+    :return: format list
+    """
+    return [fmt for fmt in COMPRESS_FORMATS if fmt != COMPRESS_XZ or lzma is not None]
+
+
+def compress_block(task):
+    """Compress one block to an independent member, running in process pool
+
+    :param task: (format, level, data)
+    :return: compressed member
+    """
+    fmt, level, data = task
+    if fmt == COMPRESS_BZIP2:
+        return bz2.compress(data, max(level, 1))
+
+    if fmt == COMPRESS_XZ:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+    # Raw deflate with gzip header and trailer, header mtime is zero so output is reproducible
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff" + compressor.compress(data) + compressor.flush() + \
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def decompress_block(fmt, data):
+    if fmt == COMPRESS_BZIP2:
+        return bz2.decompress(data)
+
+    if fmt == COMPRESS_XZ:
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ParallelCompressor(object):
+    """Hash like object, compress data passed by update() to path"""
+
+    def __init__(self, path, fmt=COMPRESS_GZIP, level=DEF_LEVEL, block_size=DEF_BLOCK_SIZE, workers=None):
+        """Parallel compressor, process pool is created here, so create it before starting any thread
+
+        :param path: compressed output path
+        :param fmt: compress format, see COMPRESS_FORMATS
+        :param level: compress level
+        :param block_size: uncompressed block size
+        :param workers: process pool size, default is cpu count
+        :return:
+        """
+        if fmt not in available_formats():
+            raise ValueError("Unsupported compress format:{0:s}".format(fmt))
+
+        # Process pool is only needed while compressing, reading compressed components doesn't import it
+        import multiprocessing
+
+        self.path = path
+        self.fmt = fmt
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.block = bytearray()
+        self.pending = collections.deque()
+        self.fills = dict()
+        self.index = list()
+        self.size = 0
+        self.compressed_size = 0
+        self.fill_blocks = 0
+        self.wait_time = 0.0
+        self.fp = open(path, "wb")
+        self.pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+
+    def __write(self, length, member):
+        self.fp.write(member)
+        self.index.append([self.size, length, self.compressed_size, len(member)])
+        self.size += length
+        self.compressed_size += len(member)
+
+    def __drain(self, limit):
+        while len(self.pending) > limit:
+            length, result = self.pending.popleft()
+            start = time.time()
+            member = result if isinstance(result, str) else result.get()
+            self.wait_time += time.time() - start
+            self.__write(length, member)
+
+    def __submit(self, data):
+        # Single byte blocks are compressed once
+        if data and data.count(data[0:1]) == len(data):
+            key = (data[0], len(data))
+            if key not in self.fills:
+                self.fills[key] = compress_block((self.fmt, self.level, str(data)))
+            self.fill_blocks += 1
+            self.pending.append((len(data), self.fills.get(key)))
+        elif self.pool is None:
+            self.pending.append((len(data), compress_block((self.fmt, self.level, str(data)))))
+        else:
+            result = self.pool.apply_async(compress_block, ((self.fmt, self.level, str(data)),))
+            self.pending.append((len(data), result))
+
+        # Bound memory, at most two blocks per worker are in flight
+        self.__drain(self.workers * 2)
+
+    def update(self, data):
+        self.block.extend(data)
+        while len(self.block) >= self.block_size:
+            self.__submit(self.block[:self.block_size])
+            del self.block[:self.block_size]
+
+    def close(self):
+        """Compress remain data, write block index
+
+        :return: {"format", "size", "compressed_size", "blocks", "fill_blocks", "wait_time"}
+        """
+        try:
+
+            if self.block or not self.index and not self.pending:
+                self.__submit(self.block)
+                self.block = bytearray()
+
+            self.__drain(0)
+
+        finally:
+
+            self.fp.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+        with open(self.path + INDEX_SUFFIX, "w") as fp:
+            json.dump({"format": self.fmt, "size": self.size, "block_size": self.block_size,
+                       "blocks": self.index}, fp)
+
+        return {"format": self.fmt, "size": self.size, "compressed_size": self.compressed_size,
+                "blocks": len(self.index), "fill_blocks": self.fill_blocks, "wait_time": self.wait_time}
+
+    def abort(self):
+        """Stop compressing and remove output
+
+        :return: None
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+        self.fp.close()
+        for path in (self.path, self.path + INDEX_SUFFIX):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def read_range(path, offset, length):
+    """Read uncompressed range of a compressed image, only members covering the range are decompressed
+
+    :param path: compressed image path
+    :param offset: uncompressed offset
+    :param length: bytes to read
+    :return: data, may be shorter than length at end of image, raise ValueError if a member is corrupt
+    """
+    with open(path + INDEX_SUFFIX) as fp:
+        index = json.load(fp)
+
+    data = list()
+    with open(path, "rb") as fp:
+        for start, size, position, compressed in index.get("blocks"):
+            if start + size <= offset or start >= offset + length:
+                continue
+
+            fp.seek(position, os.SEEK_SET)
+            try:
+                block = decompress_block(index.get("format"), fp.read(compressed))
+            except DECOMPRESS_ERRORS, e:
+                raise ValueError("{0:s}: decompress error at 0x{1:x}, {2:s}".format(path, position, e))
+            data.append(block[max(offset - start, 0):offset + length - start])
+
+    return "".join(data)
+
+
+def detect_format(path):
+    """Detect compress format by magic
+
+    :param path: file path
+    :return: format or None if file is not compressed
+    """
+    with open(path, "rb") as fp:
+        head = fp.read(6)
+
+    for fmt, magic in MAGICS:
+        if head.startswith(magic):
+            return fmt
+
+    return None
+
+
+def _decompressor(fmt):
+    if fmt == COMPRESS_GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if fmt == COMPRESS_BZIP2:
+        return bz2.BZ2Decompressor()
+
+    if fmt == COMPRESS_XZ and lzma is not None:
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+    raise ValueError("Unsupported compress format:{0}".format(fmt))
+
+
+class DecompressReader(object):
+    """Read only file like object of decompressed data, concatenated members (streams) are supported
+
+    Compressed data is read CHUNK_SIZE a time, so memory usage is bounded by one chunk decompressed output.
+    Corrupt or truncated input (file ends inside a member) raises ValueError
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, path, fmt=None):
+        self.fmt = fmt or detect_format(path)
+        if self.fmt is None:
+            raise ValueError("{0:s}: unknown compress format".format(path))
+
+        self.decompressor = _decompressor(self.fmt)
+        self.started = False
+        self.fp = open(path, "rb")
+        self.unused = ""
+        self.pending = ""
+        self.pending_offset = 0
+        self.position = 0
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __member_end(self):
+        """Check current member is complete, only called at input EOF"""
+        if hasattr(self.decompressor, "eof"):
+            return self.decompressor.eof
+
+        # Python 2 zlib keeps data after member end as unused data, bz2 refuses it
+        try:
+            self.decompressor.decompress("\0")
+        except EOFError:
+            return True
+        except DECOMPRESS_ERRORS:
+            return False
+
+        return bool(self.decompressor.unused_data)
+
+    def __fill(self):
+        while self.pending_offset >= len(self.pending) and not self.eof:
+            data, self.unused = self.unused or self.fp.read(self.CHUNK_SIZE), ""
+            if not data:
+                if self.started and not self.__member_end():
+                    raise ValueError("{0:s}: compressed data is truncated".format(self.fp.name))
+
+                self.eof = True
+                break
+
+            try:
+                self.pending, self.pending_offset = self.decompressor.decompress(data), 0
+                self.started = True
+            except EOFError:
+                # Previous member is end, data belongs to next member
+                self.decompressor, self.unused, self.started = _decompressor(self.fmt), data, False
+                continue
+            except DECOMPRESS_ERRORS, e:
+                raise ValueError("{0:s}: decompress error, {1:s}".format(self.fp.name, e))
+
+            # Member end, xz streams may be followed by zero padding
+            unused = self.decompressor.unused_data
+            if unused:
+                self.decompressor, self.started = _decompressor(self.fmt), False
+                self.unused = unused.lstrip("\0") if self.fmt == COMPRESS_XZ else unused
+
+        return self.pending_offset < len(self.pending)
+
+    def read(self, size=-1):
+        chunks = list()
+        remain = size
+        while (size < 0 or remain > 0) and self.__fill():
+            end = len(self.pending) if size < 0 else min(len(self.pending), self.pending_offset + remain)
+            chunks.append(self.pending[self.pending_offset:end])
+            remain -= end - self.pending_offset
+            self.pending_offset = end
+
+        data = "".join(chunks)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.fp.close()
+
+
+def _varint(data, position):
+    value = shift = 0
+    while True:
+        byte = ord(data[position])
+        value |= (byte & 0x7f) << shift
+        position += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def _xz_size(fp):
+    # Walk xz streams backward by stream footer and index, index records each block uncompressed size
+    end = os.fstat(fp.fileno()).st_size
+    total = 0
+    while end > 0:
+        fp.seek(end - 4, os.SEEK_SET)
+        if fp.read(4) == "\0\0\0\0":
+            end -= 4
+            continue
+
+        fp.seek(end - 12, os.SEEK_SET)
+        footer = fp.read(12)
+        if len(footer) != 12 or footer[10:12] != "YZ":
+            raise ValueError("{0:s}: invalid xz stream footer".format(fp.name))
+
+        index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        fp.seek(end - 12 - index_size, os.SEEK_SET)
+        index = fp.read(index_size)
+        if not index or index[0] != "\0":
+            raise ValueError("{0:s}: invalid xz index".format(fp.name))
+
+        blocks = 0
+        count, position = _varint(index, 1)
+        for _ in range(count):
+            unpadded, position = _varint(index, position)
+            size, position = _varint(index, position)
+            blocks += (unpadded + 3) & ~3
+            total += size
+
+        end -= 12 + blocks + index_size + 12
+
+    return total
+
+
+def uncompressed_size(path, limit=None):
+    """Get uncompressed size of compressed file
+
+    Recorded size is used if container has one: block index written by ParallelCompressor or xz index.
+    Otherwise (bzip2, gzip) data is decompressed and counted, counting stops once limit is exceeded. gzip
+    ISIZE is not used, it only records the last member of a multi member file and wraps at 4G.
+
+    :param path: compressed file path
+    :param limit: stop counting when size exceeds limit
+    :return: uncompressed size, greater than limit means size exceeds limit (may not be the actual size)
+    """
+    try:
+
+        with open(path + INDEX_SUFFIX) as fp:
+            return json.load(fp).get("size")
+
+    except (IOError, ValueError, AttributeError):
+        pass
+
+    fmt = detect_format(path)
+    with open(path, "rb") as fp:
+        if fmt == COMPRESS_XZ:
+            return _xz_size(fp)
+
+    size = 0
+    with DecompressReader(path, fmt) as reader:
+        while limit is None or size <= limit:
+            data = reader.read(DecompressReader.CHUNK_SIZE * 64)
+            if not data:
+                break
+            size += len(data)
+
+    return size
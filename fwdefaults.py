@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Default values shared by fwmaker, fwcache and the command line tool
+
+Only os and types are imported, so help and option parsing don't load the build modules
+(json, hashlib, mmap, threading ...). FirmwareMaker and BuildCache expose them as class attributes.
+"""
+
+import os
+import types
+
+
+__all__ = ['DEF_OUTPUT_FILE', 'DEF_SETTING_PATH', 'DEF_BUFFER_SIZE', 'DEF_FILL_BYTE', 'NAND_FILL_BYTE',
+           'DEF_PAGE_SIZE', 'DEF_BLOCK_SIZE', 'PAGE_MAP_SUFFIX', 'MANIFEST_SUFFIX', 'BATCH_SUMMARY_FILE',
+           'FLASH_PLAN_FILE', 'FLASH_SCRIPT_FILE', 'DEF_HEADROOM', 'ESSENTIAL_FILE_LIST', 'DEFAULT_FILE_LIST',
+           'DEF_CACHE_DIR', 'DEF_CACHE_SIZE', 'COMPRESS_FORMATS', 'str2number']
+
+DEF_OUTPUT_FILE = "firmware.bin"
+DEF_SETTING_PATH = "settings.json"
+DEF_BUFFER_SIZE = 1024 * 1024
+DEF_FILL_BYTE = 0x00
+NAND_FILL_BYTE = 0xff
+DEF_PAGE_SIZE = 2048
+DEF_BLOCK_SIZE = 128 * 1024
+PAGE_MAP_SUFFIX = ".pagemap.json"
+MANIFEST_SUFFIX = ".manifest.json"
+BATCH_SUMMARY_FILE = "summary.json"
+FLASH_PLAN_FILE = "flash_plan.json"
+FLASH_SCRIPT_FILE = "flash_plan.tcl"
+DEF_HEADROOM = 10
+ESSENTIAL_FILE_LIST = ["bootstrap", "kernel", "rootfs"]
+DEFAULT_FILE_LIST = ["bootstrap", "u-boot", "u-boot env", "dtb", "kernel", "rootfs"]
+
+DEF_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "at91fwmaker")
+DEF_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+# All formats fwcompress knows, fwcompress.available_formats() tells which ones this python supports
+COMPRESS_FORMATS = ["gz", "bz2", "xz"]
+
+
+def str2number(text):
+    if isinstance(text, int):
+        return text
+
+    if not isinstance(text, types.StringTypes):
+        print "TypeError:{0:s}".format(type(text))
+        return 0
+
+    try:
+
+        text = text.lower()
+
+        if text.startswith("0b"):
+            return int(text, 2)
+        elif text.startswith("0x"):
+            return int(text, 16)
+        elif text.startswith("0"):
+            return int(text, 8)
+        elif text == "true":
+            return 1
+        elif text == "false":
+            return 0
+        elif text.endswith("k") or text.endswith("kb"):
+            return int(text.split("k")[0]) * 1024
+        elif text.endswith("m") or text.endswith("mb"):
+            return int(text.split("m")[0]) * 1024 * 1024
+        else:
+            return int(text)
+
+    except ValueError, e:
+        print "Str2number error:{0:s}, {1:s}".format(text, e)
+        return 0
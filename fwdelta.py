@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Block level binary delta between two firmware images
+
+Target image is split into regions (normally by layout, partition by partition), each region is matched
+against its source region: source blocks are indexed by adler32, target is scanned with a rolling adler32,
+a weak match is confirmed by comparing the data directly (both images are memory mapped), then extended
+block by block. Unmatched data is stored as literal.
+
+Delta file format, integers are little endian:
+
+    MAGIC
+    header length (uint32), json header {"version", "block_size", "source_size", "source_md5", "target_size"}
+    commands:
+        'C' source offset (uint64), length (uint64)     copy from source image
+        'L' length (uint64), data                        literal data
+        'E' target md5 (16 bytes)                        end of delta
+
+Memory usage is bounded by the block index of one source region (one entry per block) and MAX_LITERAL_SIZE,
+images are never read into memory.
+"""
+
+import os
+import mmap
+import zlib
+import json
+import struct
+import hashlib
+import tempfile
+from fastcopy import data_extents
+
+
+__all__ = ['DEF_BLOCK_SIZE', 'make_delta', 'apply_delta', 'delta_header']
+
+MAGIC = "AT91DLT1"
+VERSION = 1
+DEF_BLOCK_SIZE = 2048
+MAX_LITERAL_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+ADLER_BASE = 65521
+COPY_COMMAND = struct.Struct("<cQQ")
+LITERAL_COMMAND = struct.Struct("<cQ")
+HEADER_LENGTH = struct.Struct("<I")
+
+
+class _Writer(object):
+    """Delta command writer, contiguous copies are merged to one command"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.copy = None
+        self.stats = {"copy_commands": 0, "copy_bytes": 0, "literal_commands": 0, "literal_bytes": 0}
+
+    def __flush_copy(self):
+        if self.copy is not None:
+            self.fp.write(COPY_COMMAND.pack("C", *self.copy))
+            self.stats["copy_commands"] += 1
+            self.copy = None
+
+    def copy_from(self, offset, length):
+        self.stats["copy_bytes"] += length
+        if self.copy is not None and self.copy[0] + self.copy[1] == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+
+        self.__flush_copy()
+        self.copy = (offset, length)
+
+    def literal(self, data):
+        if not len(data):
+            return
+
+        self.__flush_copy()
+        self.fp.write(LITERAL_COMMAND.pack("L", len(data)))
+        self.fp.write(data)
+        self.stats["literal_commands"] += 1
+        self.stats["literal_bytes"] += len(data)
+
+    def end(self, md5):
+        self.__flush_copy()
+        self.fp.write("E" + md5)
+
+
+def _map(fp):
+    size = os.fstat(fp.fileno()).st_size
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else "", size
+
+
+def _file_md5(path):
+    # Holes (sparse firmware gaps) are hashed as zeros without reading
+    digest = hashlib.md5()
+    buf = bytearray(COPY_BUFFER_SIZE)
+    zeros = bytearray(COPY_BUFFER_SIZE)
+    with open(path, "rb") as fp:
+        position = 0
+        size = os.fstat(fp.fileno()).st_size
+        for offset, length in list(data_extents(fp.fileno(), 0, size)) + [(size, 0)]:
+            while position < offset:
+                digest.update(buffer(zeros, 0, min(len(zeros), offset - position)))
+                position += min(len(zeros), offset - position)
+
+            fp.seek(offset, os.SEEK_SET)
+            while position < offset + length:
+                read = fp.readinto(memoryview(buf)[:min(len(buf), offset + length - position)])
+                if not read:
+                    break
+                digest.update(buffer(buf, 0, read))
+                position += read
+
+    return digest.hexdigest()
+
+
+def _index_blocks(src, start, end, block_size):
+    index = dict()
+    for offset in xrange(start, end - block_size + 1, block_size):
+        index.setdefault(zlib.adler32(buffer(src, offset, block_size)) & 0xffffffff, offset)
+
+    return index
+
+
+def _encode_region(writer, src, src_start, src_end, tgt, tgt_start, tgt_end, block_size):
+    index = _index_blocks(src, src_start, src_end, block_size)
+    position = literal = tgt_start
+    a = b = None
+
+    while position + block_size <= tgt_end:
+        if a is None:
+            weak = zlib.adler32(buffer(tgt, position, block_size)) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+
+        offset = index.get((b << 16) | a)
+        if offset is not None and buffer(src, offset, block_size) == buffer(tgt, position, block_size):
+            writer.literal(buffer(tgt, literal, position - literal))
+
+            # Matched data is usually longer than a block, extend it without hashing
+            length = block_size
+            while position + length + block_size <= tgt_end and offset + length + block_size <= src_end and \
+                    buffer(src, offset + length, block_size) == buffer(tgt, position + length, block_size):
+                length += block_size
+
+            writer.copy_from(offset, length)
+            position += length
+            literal = position
+            a = None
+            continue
+
+        # Roll window one byte forward
+        if position + block_size < tgt_end:
+            out, new = ord(tgt[position]), ord(tgt[position + block_size])
+            a = (a - out + new) % ADLER_BASE
+            b = (b - block_size * out + a - 1) % ADLER_BASE
+
+        position += 1
+        if position - literal >= MAX_LITERAL_SIZE:
+            writer.literal(buffer(tgt, literal, position - literal))
+            literal = position
+
+    writer.literal(buffer(tgt, literal, tgt_end - literal))
+
+
+def make_delta(source, target, delta, regions=None, block_size=DEF_BLOCK_SIZE):
+    """Generate delta which converts source image to target image
+
+    :param source: source (old) image path
+    :param target: target (new) image path
+    :param delta: delta output path
+    :param regions: [(target offset, target length, source offset, source length)], target data is only matched
+    against its source region, regions must cover the whole target in order, default is the whole image
+    :param block_size: match block size
+    :return: statistics {"copy_commands", "copy_bytes", "literal_commands", "literal_bytes", "delta_size", ...}
+    """
+    with open(source, "rb") as sfp, open(target, "rb") as tfp, open(delta, "wb") as dfp:
+        src, source_size = _map(sfp)
+        tgt, target_size = _map(tfp)
+
+        try:
+
+            regions = regions or [(0, target_size, 0, source_size)]
+            position = 0
+            for tgt_offset, tgt_length, _, _ in regions:
+                if tgt_offset != position or tgt_offset + tgt_length > target_size:
+                    raise ValueError("Invalid delta region: 0x{0:x}, 0x{1:x}".format(tgt_offset, tgt_length))
+                position += tgt_length
+
+            if position != target_size:
+                raise ValueError("Delta regions doesn't cover target image: 0x{0:x}".format(position))
+
+            header = json.dumps({"version": VERSION, "block_size": block_size, "source_size": source_size,
+                                 "source_md5": _file_md5(source), "target_size": target_size})
+            dfp.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+
+            writer = _Writer(dfp)
+            target_md5 = hashlib.md5()
+            for tgt_offset, tgt_length, src_offset, src_length in regions:
+                src_offset = min(src_offset, source_size)
+                src_end = min(src_offset + src_length, source_size)
+                _encode_region(writer, src, src_offset, src_end, tgt, tgt_offset, tgt_offset + tgt_length, block_size)
+                target_md5.update(buffer(tgt, tgt_offset, tgt_length))
+
+            writer.end(target_md5.digest())
+
+        finally:
+
+            for mapped in (src, tgt):
+                if isinstance(mapped, mmap.mmap):
+                    mapped.close()
+
+    stats = writer.stats
+    stats.update({"source_size": source_size, "target_size": target_size, "delta_size": os.path.getsize(delta),
+                  "target_md5": target_md5.hexdigest()})
+    return stats
+
+
+def delta_header(fp):
+    """Read delta header
+
+    :param fp: delta file object
+    :return: header dict, raise ValueError if it is not a delta file
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Invalid delta file")
+
+    length, = HEADER_LENGTH.unpack(fp.read(HEADER_LENGTH.size))
+    header = json.loads(fp.read(length))
+    if header.get("version") != VERSION:
+        raise ValueError("Unsupported delta version: {0}".format(header.get("version")))
+
+    return header
+
+
+def apply_delta(source, delta, output, verify_source=True):
+    """Apply delta to source image, output is written to a temporary file then renamed, so output could be source
+
+    :param source: source (old) image path
+    :param delta: delta path
+    :param output: target image output path
+    :param verify_source: check source md5 before applying
+    :return: target image md5, raise ValueError if source doesn't match or delta is corrupted
+    """
+    with open(delta, "rb") as dfp:
+        header = delta_header(dfp)
+        if os.path.getsize(source) != header.get("source_size") or \
+                (verify_source and _file_md5(source) != header.get("source_md5")):
+            raise ValueError("Source image: {0:s} doesn't match delta".format(source))
+
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)))
+        try:
+
+            digest = hashlib.md5()
+            buf = bytearray(COPY_BUFFER_SIZE)
+            with open(source, "rb") as sfp, os.fdopen(fd, "wb") as fw:
+                while True:
+                    command = dfp.read(1)
+                    if command == "C":
+                        offset, length = COPY_COMMAND.unpack(command + dfp.read(COPY_COMMAND.size - 1))[1:]
+                        sfp.seek(offset, os.SEEK_SET)
+                    elif command == "L":
+                        length, = LITERAL_COMMAND.unpack(command + dfp.read(LITERAL_COMMAND.size - 1))[1:]
+                    elif command == "E":
+                        if digest.digest() != dfp.read(16):
+                            raise ValueError("Target md5 mismatch, delta is corrupted")
+                        break
+                    else:
+                        raise ValueError("Invalid delta command: {0:s}".format(repr(command)))
+
+                    reader = sfp if command == "C" else dfp
+                    while length:
+                        chunk = reader.readinto(buf) if length >= len(buf) else None
+                        data = buffer(buf, 0, chunk) if chunk is not None else reader.read(length)
+                        if not len(data):
+                            raise ValueError("Unexpected end of {0:s}".format("source" if command == "C" else "delta"))
+
+                        fw.write(data)
+                        digest.update(data)
+                        length -= len(data)
+
+            if os.path.getsize(temp) != header.get("target_size"):
+                raise ValueError("Target size mismatch, delta is corrupted")
+
+            os.chmod(temp, 0644)
+            os.rename(temp, output)
+            return digest.hexdigest()
+
+        except StandardError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
@@ -1,54 +1,890 @@
 # -*- coding: utf-8 -*-
 
 import os
+import zlib
+import mmap
+import stat
+import glob
 import json
+import time
+import Queue
 import types
+import struct
 import hashlib
+import fwdefaults
+import threading
+from fastcopy import COPY_AUTO, COPY_BUFFERED, copy_range, punch_hole, data_extents, allocated_size
 
 
-__all__ = ['FirmwareMaker']
+__all__ = ['FirmwareMaker', 'Partition', 'Layout', 'DigestGroup', 'PageMap', 'Crc32', 'ImageDigest', 'new_digest',
+           'BuildProgress', 'BuildCancelled', 'BuildStats', 'ReadAhead', 'FirmwareImage', 'DataExtent']
 
 
-class FirmwareMaker(object):
+class Partition(object):
+    """Firmware partition, immutable, component file stat is cached on first use
+
+    If decompress is set, component is a compressed file (gzip, bzip2 or xz), it is decompressed on the fly,
+    length is uncompressed size, see fwcompress.uncompressed_size
+    """
+
+    __slots__ = ('name', 'offset', 'size', 'path', 'decompress', '_stat', '_length')
+
+    def __init__(self, name, offset, size, path, decompress=False):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "offset", offset)
+        object.__setattr__(self, "size", size)
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "decompress", bool(decompress))
+        object.__setattr__(self, "_stat", None)
+        object.__setattr__(self, "_length", None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Partition is immutable")
+
+    def __reduce__(self):
+        return Partition, (self.name, self.offset, self.size, self.path, self.decompress)
+
+    def __key(self):
+        return self.name, self.offset, self.size, self.path, self.decompress
+
+    def __eq__(self, other):
+        return isinstance(other, Partition) and self.__key() == other.__key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__key())
+
+    def __repr__(self):
+        return "Partition({0:s}, offset=0x{1:x}, size=0x{2:x}, path={3:s}{4:s})".\
+            format(self.name, self.offset, self.size, self.path, ", decompress=True" if self.decompress else "")
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    @property
+    def stat(self):
+        """Component file stat result, None if file is not exist"""
+        if self._stat is None:
+            try:
+                object.__setattr__(self, "_stat", os.stat(self.path))
+            except (OSError, TypeError):
+                return None
+
+        return self._stat
+
+    @property
+    def length(self):
+        """Component data size, -1 if file is not exist, raise ValueError if compressed file is invalid"""
+        if self.stat is None:
+            return -1
+
+        if not self.decompress:
+            return self.stat.st_size
+
+        # Counting uncompressed data stops once reserved size is exceeded
+        if self._length is None:
+            import fwcompress
+            try:
+                object.__setattr__(self, "_length", fwcompress.uncompressed_size(self.path, self.size))
+            except (IOError, ValueError, struct.error, IndexError), e:
+                raise ValueError("[{0:s}] invalid compressed file, {1:s}".format(self.name, e))
+
+        return self._length
+
+    def exists(self):
+        st = self.stat
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def open(self):
+        """Open component data for reading
+
+        :return: file object, or fwcompress.DecompressReader (has no fileno) if decompress is set
+        """
+        if self.decompress:
+            import fwcompress
+            return fwcompress.DecompressReader(self.path)
+
+        return open(self.path, "rb")
+
+    def refresh(self):
+        """Drop cached stat, component file may be changed
+
+        :return: self
+        """
+        object.__setattr__(self, "_stat", None)
+        object.__setattr__(self, "_length", None)
+        return self
+
+    def setting(self):
+        """Get partition setting
+
+        :return: {name: {"path", "size", "offset"[, "decompress"]}}
+        """
+        data = {"path": self.path, "size": "0x{0:x}".format(self.size), "offset": "0x{0:x}".format(self.offset)}
+        if self.decompress:
+            data["decompress"] = True
+
+        return {self.name: data}
+
+
+class Layout(tuple):
+    """Compiled firmware layout, immutable sequence of Partition in settings order
 
-    DEF_OUTPUT_FILE = "firmware.bin"
-    DEF_SETTING_PATH = "settings.json"
-    ESSENTIAL_FILE_LIST = ["bootstrap", "kernel", "rootfs"]
-    DEFAULT_FILE_LIST = ["bootstrap", "u-boot", "u-boot env", "dtb", "kernel", "rootfs"]
+    Settings (list of single key dict) is parsed only once by compile(), check, make and gui use it directly
+    """
+
+    def __new__(cls, partitions=()):
+        layout = super(Layout, cls).__new__(cls, partitions)
+        layout.__sorted = None
+        layout.__index = None
+        return layout
 
     @staticmethod
-    def str2number(text):
-        if isinstance(text, int):
-            return text
+    def compile(setting):
+        """Compile settings to layout
 
-        if not isinstance(text, types.StringTypes):
-            print "TypeError:{0:s}".format(type(text))
-            return 0
+        :param setting: settings list [{name: {"path", "size", "offset"[, "decompress"]}}] or Layout
+        :return: Layout, raise TypeError or ValueError if settings is invalid
+        """
+        if isinstance(setting, Layout):
+            return setting
+
+        if not isinstance(setting, list):
+            raise TypeError("Invalid settings!")
+
+        partitions = list()
+        for item in setting:
+            if not isinstance(item, dict) or len(item) != 1:
+                raise ValueError("Invalid setting item: {0!r}".format(item))
+
+            name, data = item.items()[0]
+            if not isinstance(data, dict):
+                raise ValueError("[{0:s}] invalid setting: {1!r}".format(name, data))
+
+            for key in ("path", "size", "offset"):
+                if key not in data:
+                    raise ValueError("[{0:s}] {1:s} is not specified".format(name, key))
+
+            if not isinstance(data.get("path"), types.StringTypes):
+                raise TypeError("[{0:s}] invalid path: {1!r}".format(name, data.get("path")))
+
+            partitions.append(Partition(name, FirmwareMaker.str2number(data.get("offset")),
+                                        FirmwareMaker.str2number(data.get("size")), data.get("path"),
+                                        data.get("decompress", False)))
+
+        return Layout(partitions)
+
+    def names(self):
+        return [partition.name for partition in self]
+
+    def get(self, name, default=None):
+        if self.__index is None:
+            self.__index = {partition.name: partition for partition in self}
+
+        return self.__index.get(name, default)
+
+    def by_offset(self):
+        """Get partitions sorted by offset
+
+        :return: tuple of Partition
+        """
+        if self.__sorted is None:
+            self.__sorted = tuple(sorted(self, key=lambda partition: (partition.offset, partition.name)))
+
+        return self.__sorted
+
+    def refresh(self):
+        """Drop all partition cached stat
+
+        :return: self
+        """
+        for partition in self:
+            partition.refresh()
+
+        return self
+
+    def settings(self):
+        """Get settings list, could be dumped to json
+
+        :return: [{name: {"path", "size", "offset"}}]
+        """
+        return [partition.setting() for partition in self]
+
+
+class DigestGroup(object):
+    """Update several hash like objects with the same data"""
+
+    def __init__(self, *members):
+        self.members = [member for member in members if member is not None]
+
+    def update(self, data):
+        for member in self.members:
+            member.update(data)
+
+
+class BuildCancelled(Exception):
+    """Raised when build progress callback cancels the build"""
+    pass
+
+
+class BuildProgress(object):
+    """Track build progress, fed through update() with every component chunk like hash objects
 
+    callback(name, partition done, partition total, image done, image total) is called with bytes counts
+    after each chunk is written (or hashed when partition is unchanged), return False to cancel the build.
+    """
+
+    def __init__(self, callback, partitions):
+        self.callback = callback
+        self.total = sum(max(partition.length, 0) for partition in partitions)
+        self.done = 0
+        self.name = ""
+        self.partition_done = 0
+        self.partition_total = 0
+
+    def begin(self, partition):
+        self.name = partition.name
+        self.partition_done = 0
+        self.partition_total = max(partition.length, 0)
+        self.__report()
+
+    def update(self, data):
+        self.done += len(data)
+        self.partition_done += len(data)
+        self.__report()
+
+    def __report(self):
+        if self.callback(self.name, self.partition_done, self.partition_total, self.done, self.total) is False:
+            raise BuildCancelled("Build is cancelled")
+
+
+class BuildStats(object):
+    """Build instrumentation, duration, bytes and syscall counts of each stage and partition
+
+    A record is {"stage", ["partition",] "time", ["bytes", "method",] "syscr", "syscw", "rchar", "wchar"}, caller
+    of stage() may add keys to it. Syscall counts come from /proc/self/io (Linux only), they are process wide,
+    so worker threads of a stage are included. Hooks are called as hook(event, record) with event "begin" or
+    "end", e.g. to enable an external profiler around a stage. Pass None (default) to disable it, disabled
+    stats is a shared no-op object.
+    """
+
+    PROC_IO = "/proc/self/io"
+    IO_COUNTERS = ("syscr", "syscw", "rchar", "wchar")
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.records = list()
+        self.start = time.time()
+        self.io = os.path.isfile(self.PROC_IO)
+
+        # Reading /proc/self/io is counted too
+        self.overhead = [0] * len(self.IO_COUNTERS)
+        if self.io:
+            first, second = self.__counters(), self.__counters()
+            self.overhead = [new - old for new, old in zip(second, first)] if first and second else self.overhead
+
+    def __counters(self):
         try:
+            with open(self.PROC_IO) as fp:
+                counters = dict(line.split(":") for line in fp.read().splitlines() if ":" in line)
+                return [int(counters.get(key)) for key in self.IO_COUNTERS]
+        except (IOError, ValueError, TypeError):
+            return None
 
-            text = text.lower()
+    def stage(self, name, partition=None):
+        """Measure a stage (with statement), records are kept in begin order
 
-            if text.startswith("0b"):
-                return int(text, 2)
-            elif text.startswith("0x"):
-                return int(text, 16)
-            elif text.startswith("0"):
-                return int(text, 8)
-            elif text == "true":
-                return 1
-            elif text == "false":
-                return 0
-            elif text.endswith("k") or text.endswith("kb"):
-                return int(text.split("k")[0]) * 1024
-            elif text.endswith("m") or text.endswith("mb"):
-                return int(text.split("m")[0]) * 1024 * 1024
-            else:
-                return int(text)
+        :param name: stage name
+        :param partition: partition name, if it is a per-partition record
+        :return: context manager, enter returns the record dict
+        """
+        record = {"stage": name}
+        if partition is not None:
+            record["partition"] = partition
 
-        except ValueError, e:
-            print "Str2number error:{0:s}, {1:s}".format(text, e)
-            return 0
+        return _StatsScope(self, record)
+
+    def begin(self, record):
+        self.records.append(record)
+        for hook in self.hooks:
+            hook("begin", record)
+
+        record["_io"] = self.__counters() if self.io else None
+        record["_start"] = time.time()
+
+    def end(self, record):
+        record["time"] = time.time() - record.pop("_start")
+        before, after = record.pop("_io"), self.__counters() if self.io else None
+        if before and after:
+            record.update(zip(self.IO_COUNTERS, [max(new - old - extra, 0) for new, old, extra in
+                                                 zip(after, before, self.overhead)]))
+
+        for hook in self.hooks:
+            hook("end", record)
+
+    def stages(self):
+        return [record for record in self.records if "partition" not in record and "time" in record]
+
+    def partitions(self):
+        return [record for record in self.records if "partition" in record and "time" in record]
+
+    def result(self):
+        """Get structured result, could be dumped to json
+
+        :return: {"wall", "stages", "partitions"}
+        """
+        return {"wall": time.time() - self.start, "stages": self.stages(), "partitions": self.partitions()}
+
+    def dump(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.result(), fp, indent=4)
+
+    def report(self):
+        """Get text report
+
+        :return: report lines
+        """
+        lines = ["{0:24s}{1:>12s}{2:>14s}{3:>10s}{4:>10s}".format("stage", "time", "bytes", "syscr", "syscw")]
+        for record in self.stages() + self.partitions():
+            name = record.get("stage") if "partition" not in record else "  {0:s}".format(record.get("partition"))
+            lines.append("{0:24s}{1:10.3f}ms{2:14d}{3:10d}{4:10d}".
+                         format(name, record.get("time") * 1000, record.get("bytes", 0), record.get("syscr", 0),
+                                record.get("syscw", 0)))
+
+        return lines
+
+
+class _StatsScope(object):
+    __slots__ = ('stats', 'record')
+
+    def __init__(self, stats, record):
+        self.stats = stats
+        self.record = record
+
+    def __enter__(self):
+        self.stats.begin(self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.end(self.record)
+        return False
+
+
+class _NullStats(object):
+    """Disabled BuildStats, stage() costs a method call"""
+
+    __slots__ = ()
+
+    def stage(self, name, partition=None):
+        return self
+
+    def __enter__(self):
+        return dict()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_STATS = _NullStats()
+
+
+class Crc32(object):
+    """CRC32 with hashlib like interface"""
+
+    name = "crc32"
+    digest_size = 4
+
+    def __init__(self, data=None):
+        self.value = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack(">I", self.value & 0xffffffff)
+
+    def hexdigest(self):
+        return "{0:08x}".format(self.value & 0xffffffff)
+
+
+def new_digest(name):
+    """Create hash object by algorithm name, crc32 is supported too
+
+    :param name: algorithm name
+    :return: hash object
+    """
+    return Crc32() if name == Crc32.name else hashlib.new(name)
+
+
+class ImageDigest(object):
+    """Firmware image and partitions digest pipeline
+
+    Every enabled hash object is fed from the same buffers while firmware is assembled: image hash objects
+    by update(), partition hash objects by update() between begin_partition() and end_partition(), partition
+    padding up to reserved size is hashed from fill pattern without any io. If threaded, hashing runs on a
+    worker thread (hashlib releases GIL) to overlap write io, data is copied before queued because caller
+    reuses its buffer. Image data is also passed to sink (e.g. fwcompress.ParallelCompressor) in image order.
+    """
+
+    QUEUE_DEPTH = 4
+    DEF_IMAGE_ALGORITHMS = ("md5",)
+    MANIFEST_IMAGE_ALGORITHMS = ("md5", "sha256")
+    MANIFEST_PARTITION_ALGORITHMS = ("crc32", "sha256")
+
+    def __init__(self, image_algorithms=DEF_IMAGE_ALGORITHMS, partition_algorithms=(), threaded=False, sink=None):
+        self.image = [(name, new_digest(name)) for name in image_algorithms]
+        self.sink = sink
+        self.partition_algorithms = partition_algorithms
+        self.partitions = dict()
+        self.current = None
+        self.error = None
+        self.queue = None
+        self.thread = None
+        self.hash_time = 0.0
+
+        if threaded:
+            self.queue = Queue.Queue(self.QUEUE_DEPTH)
+            self.thread = threading.Thread(target=self.__worker)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def __worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+
+            if self.error is None:
+                try:
+                    task[0](*task[1:])
+                except StandardError, e:
+                    self.error = e
+
+    def __call(self, func, *args):
+        if self.queue is None:
+            func(*args)
+        else:
+            self.queue.put((func,) + args)
+
+    def __update(self, data):
+        start = time.time()
+        for _, digest in self.image:
+            digest.update(data)
+
+        if self.sink is not None:
+            self.sink.update(data)
+
+        if self.current is not None:
+            for _, digest in self.current.get("digests"):
+                digest.update(data)
+            self.current["length"] += len(data)
+
+        self.hash_time += time.time() - start
+
+    def __begin_partition(self, name, offset, size):
+        self.current = {"name": name, "offset": offset, "size": size, "length": 0,
+                        "digests": [(algorithm, new_digest(algorithm)) for algorithm in self.partition_algorithms]}
+
+    def __end_partition(self, pattern):
+        current, self.current = self.current, None
+        if current is None:
+            return
+
+        padding = current.get("size") - current.get("length")
+        result = {"offset": current.get("offset"), "size": current.get("size"), "length": current.get("length")}
+
+        for algorithm, digest in current.get("digests"):
+            FirmwareMaker.hash_pattern(digest, padding, pattern)
+            result[algorithm] = digest.hexdigest()
+
+        self.partitions[current.get("name")] = result
+
+    def update(self, data):
+        if self.queue is not None:
+            data = data.tobytes() if isinstance(data, memoryview) else str(data)
+
+        self.__call(self.__update, data)
+
+    def begin_partition(self, name, offset, size):
+        """Following update() data belongs to partition
+
+        :param name: partition name
+        :param offset: partition offset
+        :param size: partition reserved size
+        :return: None
+        """
+        self.__call(self.__begin_partition, name, offset, size)
+
+    def end_partition(self, pattern=None):
+        """Partition data end, hash padding up to reserved size
+
+        :param pattern: fill byte pattern buffer (must not be modified later), default is zeros
+        :return: None
+        """
+        self.__call(self.__end_partition, pattern)
+
+    def close(self):
+        """Wait until all data is hashed, must be called before getting result
+
+        :return: None
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+
+        if self.error is not None:
+            raise self.error
+
+    def hexdigest(self, algorithm=DEF_IMAGE_ALGORITHMS[0]):
+        """Get image digest
+
+        :param algorithm: algorithm name
+        :return: hex digest
+        """
+        return dict(self.image).get(algorithm).hexdigest()
+
+    def image_digests(self):
+        """Get all image digests
+
+        :return: {algorithm: hex digest}
+        """
+        return {algorithm: digest.hexdigest() for algorithm, digest in self.image}
+
+
+class ReadAhead(object):
+    """Prefetch component files on a reader thread, bounded producer/consumer pipeline
+
+    Reader thread reads components in order into a fixed pool of buffers (memory budget / buffer size),
+    consumer writes and hashes each chunk then gives its buffer back, so reading next chunk (or next
+    component) overlaps with writing and hashing current one. Time of each stage is recorded.
+    """
+
+    MIN_BUFFERS = 2
+
+    def __init__(self, partitions, buffer_size, budget):
+        self.partitions = list(partitions)
+        self.free = Queue.Queue()
+        self.ready = Queue.Queue()
+        self.stopped = False
+        self.timing = {"read": 0.0, "wait": 0.0, "write": 0.0}
+        self.buffers = max(self.MIN_BUFFERS, budget // buffer_size)
+
+        for _ in range(self.buffers):
+            self.free.put(bytearray(buffer_size))
+
+        self.thread = threading.Thread(target=self.__reader)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __reader(self):
+        for index, partition in enumerate(self.partitions):
+            # Compressed component stops once reserved size is exceeded, like copy_stream limit
+            remain = partition.size + 1 if partition.decompress else None
+            try:
+
+                with partition.open() as fp:
+                    while remain is None or remain > 0:
+                        buf = self.free.get()
+                        if self.stopped:
+                            return
+
+                        start = time.time()
+                        length = fp.readinto(buf if remain is None else memoryview(buf)[:min(len(buf), remain)])
+                        self.timing["read"] += time.time() - start
+
+                        if not length:
+                            self.free.put(buf)
+                            break
+
+                        if remain is not None:
+                            remain -= length
+
+                        self.ready.put((index, buf, length))
+
+            except Exception, e:
+                # Any failure (e.g. corrupt compressed component) must reach consumer, it is waiting for data
+                self.ready.put((index, e, 0))
+                return
+
+            # End of component
+            self.ready.put((index, None, 0))
+
+    def copy(self, index, dst, digest=None):
+        """Write prefetched component to dst current position
+
+        :param index: component index
+        :param dst: destination file object
+        :param digest: hash object updated with copied data, optional
+        :return: copied bytes
+        """
+        copied = 0
+        while True:
+            start = time.time()
+            current, buf, length = self.ready.get()
+            self.timing["wait"] += time.time() - start
+
+            if isinstance(buf, Exception):
+                raise buf
+
+            if current != index:
+                raise ValueError("Read ahead out of order: {0:d} != {1:d}".format(current, index))
+
+            if buf is None:
+                return copied
+
+            chunk = buffer(buf, 0, length)
+            start = time.time()
+            dst.write(chunk)
+            self.timing["write"] += time.time() - start
+
+            if digest is not None:
+                digest.update(chunk)
+
+            self.free.put(buf)
+            copied += length
+
+    def close(self):
+        """Stop reader thread
+
+        :return: stage timing {"read", "wait", "write"}
+        """
+        self.stopped = True
+        self.free.put(bytearray())
+        self.thread.join()
+        return self.timing
+
+
+class DataExtent(object):
+    """Hash like object, track data length and end of the last byte which is not fill byte"""
+
+    def __init__(self, fill_byte=0x00):
+        self.fill = chr(fill_byte)
+        self.length = 0
+        self.end = 0
+
+    def update(self, data):
+        stripped = len(str(data).rstrip(self.fill))
+        if stripped:
+            self.end = self.length + stripped
+
+        self.length += len(data)
+
+
+class PageMap(object):
+    """NAND page map, track which pages of firmware are fully erased (filled with erased byte 0xff)
+
+    Pages are erased by default, gaps are reported by fill(), pages covered by them are erased only if
+    fill byte is erased byte, component data is fed through update() (same interface as hash object)
+    at current position.
+    """
+
+    def __init__(self, size, page_size, block_size, fill_byte, erased_byte=0xff):
+        self.size = size
+        self.position = 0
+        self.fill_byte = fill_byte
+        self.erased_byte = erased_byte
+        self.page_size = page_size
+        self.block_size = block_size
+        self.pattern = bytearray(chr(erased_byte)) * page_size
+        self.dirty = bytearray((size + page_size - 1) // page_size)
+
+    def seek(self, position):
+        self.position = position
+
+    def fill(self, offset, length):
+        """Gap filled with fill byte, flasher skipping its pages leaves erased byte there"""
+        if self.fill_byte == self.erased_byte or length <= 0:
+            return
+
+        first, last = offset // self.page_size, (offset + length - 1) // self.page_size
+        self.dirty[first:last + 1] = "\1" * (last + 1 - first)
+
+    def update(self, data):
+        length = len(data)
+        index = 0
+
+        while index < length:
+            page, page_offset = divmod(self.position + index, self.page_size)
+            chunk = min(self.page_size - page_offset, length - index)
+            if not self.dirty[page] and buffer(data, index, chunk) != buffer(self.pattern, 0, chunk):
+                self.dirty[page] = 1
+            index += chunk
+
+        self.position += length
+
+    @staticmethod
+    def __ranges(flags, unit=1):
+        ranges = list()
+        start = None
+        for index, flag in enumerate(flags):
+            if flag and start is None:
+                start = index
+            elif not flag and start is not None:
+                ranges.append([start * unit, (index - start) * unit])
+                start = None
+
+        if start is not None:
+            ranges.append([start * unit, (len(flags) - start) * unit])
+
+        return ranges
+
+    def erased_pages(self):
+        """Get erased pages
+
+        :return: [[first page, page count]]
+        """
+        return self.__ranges([not flag for flag in self.dirty])
+
+    def erased_blocks(self):
+        """Get erased blocks, block is erased only if all its pages are erased
+
+        :return: [[first block, block count]]
+        """
+        pages = max(self.block_size // self.page_size, 1)
+        blocks = [not any(self.dirty[index:index + pages]) for index in range(0, len(self.dirty), pages)]
+        return self.__ranges(blocks)
+
+    def dump(self, path):
+        """Write page map to json file
+
+        :param path: json file path
+        :return: erased page count
+        """
+        erased = self.erased_pages()
+        with open(path, "w") as fp:
+            json.dump({"size": self.size,
+                       "fill": "0x{0:02x}".format(self.fill_byte),
+                       "erased": "0x{0:02x}".format(self.erased_byte),
+                       "page_size": self.page_size,
+                       "block_size": self.block_size,
+                       "page_count": len(self.dirty),
+                       "erased_pages": erased,
+                       "erased_blocks": self.erased_blocks()}, fp, indent=4)
+
+        return sum(count for _, count in erased)
+
+
+class FirmwareImage(object):
+    """Memory mapped firmware image, partition regions are exposed as zero copy buffers
+
+    Image is never read into memory, multi-GB images only take address space, Python 2 mmap
+    doesn't support memoryview so regions are returned as buffer objects (read only, no copy)
+    """
+
+    TRIM_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, setting):
+        self.path = path
+        self.layout = Layout.compile(setting)
+        self.fp = open(path, "rb")
+        self.size = os.fstat(self.fp.fileno()).st_size
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def region(self, name, trim=False, fill_byte=0x00):
+        """Get partition region in image
+
+        :param name: partition name
+        :param trim: trim trailing fill bytes
+        :param fill_byte: fill byte to trim
+        :return: (offset, length), reserved region is clipped to image size
+        """
+        partition = self.layout.get(name)
+        if partition is None:
+            raise ValueError("Partition: {0:s} is not exist".format(name))
+
+        offset = min(partition.offset, self.size)
+        length = min(partition.end, self.size) - offset
+        if not trim:
+            return offset, length
+
+        # Scan backward chunk by chunk until a byte is not fill byte
+        fill = chr(fill_byte)
+        while length > 0:
+            start = max(0, length - self.TRIM_CHUNK_SIZE)
+            data = self.mm[offset + start:offset + length].rstrip(fill)
+            length = start + len(data)
+            if data:
+                break
+
+        return offset, length
+
+    def view(self, name, trim=False, fill_byte=0x00):
+        """Get partition data without copying
+
+        :param name: partition name
+        :param trim: trim trailing fill bytes
+        :param fill_byte: fill byte to trim
+        :return: read only buffer of image, valid until image is closed
+        """
+        offset, length = self.region(name, trim, fill_byte)
+        return buffer(self.mm, offset, length) if length else buffer("")
+
+    def views(self, trim=False, fill_byte=0x00):
+        """Get all partitions data without copying
+
+        :return: [(name, buffer)] in settings order
+        """
+        return [(partition.name, self.view(partition.name, trim, fill_byte)) for partition in self.layout]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+        self.fp.close()
+
+
+def _batch_worker(task):
+    """Batch mode worker, running in process pool, must be a module level function to be picklable"""
+    conf, layout, output, options = task
+    start = time.time()
+
+    try:
+        ret, err_or_md5 = FirmwareMaker.make_firmware(layout, output, **options)
+    except StandardError, e:
+        ret, err_or_md5 = False, "{0:s}".format(e)
+
+    return {"conf": conf, "output": output, "result": ret, "elapsed": time.time() - start,
+            "md5" if ret else "error": err_or_md5}
+
+
+class FirmwareMaker(object):
+
+    # Shared defaults live in fwdefaults, so command line help and option parsing don't import this module
+    DEF_OUTPUT_FILE = fwdefaults.DEF_OUTPUT_FILE
+    DEF_SETTING_PATH = fwdefaults.DEF_SETTING_PATH
+    DEF_BUFFER_SIZE = fwdefaults.DEF_BUFFER_SIZE
+    DEF_FILL_BYTE = fwdefaults.DEF_FILL_BYTE
+    NAND_FILL_BYTE = fwdefaults.NAND_FILL_BYTE
+    DEF_PAGE_SIZE = fwdefaults.DEF_PAGE_SIZE
+    DEF_BLOCK_SIZE = fwdefaults.DEF_BLOCK_SIZE
+    PAGE_MAP_SUFFIX = fwdefaults.PAGE_MAP_SUFFIX
+    MANIFEST_SUFFIX = fwdefaults.MANIFEST_SUFFIX
+    BATCH_SUMMARY_FILE = fwdefaults.BATCH_SUMMARY_FILE
+    VERIFY_SLICE_SIZE = 16 * 1024 * 1024
+    FLASH_PLAN_FILE = fwdefaults.FLASH_PLAN_FILE
+    FLASH_SCRIPT_FILE = fwdefaults.FLASH_SCRIPT_FILE
+    DEF_HEADROOM = fwdefaults.DEF_HEADROOM
+    ESSENTIAL_FILE_LIST = fwdefaults.ESSENTIAL_FILE_LIST
+    DEFAULT_FILE_LIST = fwdefaults.DEFAULT_FILE_LIST
+
+    str2number = staticmethod(fwdefaults.str2number)
 
     @staticmethod
     def generate_def_configure(file_list):
@@ -91,97 +927,216 @@ class FirmwareMaker(object):
 
     @staticmethod
     def load_configure(file_path):
-        """Load settings.json to memory
+        """Load settings.json to memory and compile it to layout
 
         :param file_path: settings file path
-        :return: (result,setting list)
+        :return: (result, Layout or error message)
         """
-        setting = []
-
         try:
 
             with open(file_path) as fp:
-                setting = json.load(fp)
+                layout = Layout.compile(json.load(fp))
 
-        except(ValueError, IOError), e:
+        except(ValueError, TypeError, IOError), e:
 
             print "Load settings error:", e
-            return False, setting
+            return False, "{0:s}".format(e)
 
-        return True, setting
+        return True, layout
 
     @staticmethod
-    def check_configure(setting, verbose=False):
-        """Check settings
+    def validate_layout(setting, block_size=0, flash_size=0):
+        """Validate layout in one sweep over partitions sorted by offset, O(n log n), settings order doesn't matter
 
-        :param setting: setting data
-        :param verbose: Debug message output control
-        :return: result, error-message
+        :param setting: Layout or setting data
+        :param block_size: if not zero, partition offset must be aligned to erase block size
+        :param flash_size: if not zero, partition reserved region must be inside flash
+        :return: error message list, empty if layout is valid
         """
+        layout = Layout.compile(setting)
+        errors = list()
 
-        err_msg = str()
+        names = set()
+        for partition in layout:
+            if partition.name in names:
+                errors.append("[{0:s}] is duplicated!".format(partition.name))
+            names.add(partition.name)
 
-        try:
-            # Type check
-            if not isinstance(setting, list):
-                err_msg = "Invalid settings!"
-                return False, err_msg
+        # Make sure essential file is exist
+        for name in FirmwareMaker.ESSENTIAL_FILE_LIST:
+            if name not in names:
+                errors.append("Essential file:{0:s} is not exist!".format(name))
 
-            # Get setting names
-            setting_name = [item.keys()[0] for item in setting]
-
-            # Make sure essential file is exist
-            for name in FirmwareMaker.ESSENTIAL_FILE_LIST:
-                if name not in setting_name:
-                    err_msg = "Essential file:{0:s} is not exist!".format(name)
-                    return False, err_msg
-
-            # Check each file offset and size
-            current_offset = 0
-            for name, data in zip(setting_name, setting):
-                # print name, data
-
-                path = data.get(name).get("path")
-                size = data.get(name).get("size")
-                offset = data.get(name).get("offset")
-                size = size if isinstance(size, int) else FirmwareMaker.str2number(size)
-                offset = offset if isinstance(offset, int) else FirmwareMaker.str2number(offset)
-
-                # Offset must grate than or equal to current_offset
-                if offset < current_offset:
-                    err_msg = "[{0:s}] offset: 0x{1:x} invalid, current offset: 0x{2:x}, {3:d}".\
-                        format(name, offset, current_offset, current_offset)
-                    return False, err_msg
-
-                # Check file path is exist
-                if not os.path.isfile(path):
-                    err_msg = "[{0:s}]: {1:s} is not exist!".format(name, path)
-                    return False, err_msg
-
-                # Check file size
-                if os.path.getsize(path) > size:
-                    err_msg = "[{0:s}]: {1:s} is to large, actual size: 0x{2:x}, reserved size: 0x{3:x}, {4:d}".\
-                        format(name, path, os.path.getsize(path), size, size)
-                    return False, err_msg
-
-                # Update current offset
-                current_offset = offset + size
-
-                # Debug message output
-                if verbose:
-                    print "File:{0:s}\toffset:0x{1:x}\treserved size\t0x{2:x}".format(name, offset, size)
+        # Partition with max end offset so far, any partition start before its end is overlapped with it
+        previous = None
+        for partition in layout.by_offset():
+            name, path, size, offset = partition.name, partition.path, partition.size, partition.offset
 
-        except (TypeError, ValueError, AttributeError), e:
+            if offset < 0 or size <= 0:
+                errors.append("[{0:s}] invalid offset: 0x{1:x} or size: 0x{2:x}".format(name, offset, size))
 
-            err_msg = "{0:s}".format(e)
-            return False, err_msg
+            if previous is not None and offset < previous.end:
+                errors.append("[{0:s}] offset: 0x{1:x} invalid, overlapped with [{2:s}] 0x{3:x} - 0x{4:x}".
+                              format(name, offset, previous.name, previous.offset, previous.end))
 
-        finally:
+            # Check file path is exist and file size
+            try:
+                length = partition.length
+            except ValueError, e:
+                errors.append("{0:s}".format(e))
+                length = 0
 
-            if len(err_msg):
-                print err_msg
+            if not partition.exists():
+                errors.append("[{0:s}]: {1:s} is not exist!".format(name, path))
+            elif length > size:
+                errors.append("[{0:s}]: {1:s} is to large, actual size: 0x{2:x}, reserved size: 0x{3:x}, {4:d}".
+                              format(name, path, partition.length, size, size))
 
-        return True, ""
+            if block_size > 0 and offset % block_size:
+                errors.append("[{0:s}] offset: 0x{1:x} is not aligned to erase block size: 0x{2:x}".
+                              format(name, offset, block_size))
+
+            if flash_size > 0 and partition.end > flash_size:
+                errors.append("[{0:s}] 0x{1:x} - 0x{2:x} exceeds flash size: 0x{3:x}".
+                              format(name, offset, partition.end, flash_size))
+
+            if previous is None or partition.end > previous.end:
+                previous = partition
+
+        return errors
+
+    @staticmethod
+    def check_configure(setting, verbose=False, block_size=0, flash_size=0):
+        """Check settings, all errors are reported at once
+
+        :param setting: Layout or setting data
+        :param verbose: Debug message output control
+        :param block_size: if not zero, partition offset must be aligned to erase block size
+        :param flash_size: if not zero, partition reserved region must be inside flash
+        :return: result, error-message
+        """
+
+        err_msg = str()
+
+        try:
+
+            layout = Layout.compile(setting)
+            errors = FirmwareMaker.validate_layout(layout, block_size, flash_size)
+            if errors:
+                err_msg = "\n".join(errors)
+                return False, err_msg
+
+            # Debug message output
+            if verbose:
+                for partition in layout.by_offset():
+                    print "File:{0:s}\toffset:0x{1:x}\treserved size\t0x{2:x}".\
+                        format(partition.name, partition.offset, partition.size)
+
+        except (TypeError, ValueError, AttributeError), e:
+
+            err_msg = "{0:s}".format(e)
+            return False, err_msg
+
+        finally:
+
+            if len(err_msg):
+                print err_msg
+
+        return True, ""
+
+    @staticmethod
+    def pack_layout(setting, block_size=DEF_BLOCK_SIZE, headroom=DEF_HEADROOM, pinned=None, flash_size=0,
+                    output=None, verbose=False):
+        """Compute a compact layout, each partition reserves its component size plus headroom rounded up to erase
+        block size, partitions are packed in current offset order, O(n log n)
+
+        Pinned partitions keep their offset (bootstrap is always pinned at 0), other partitions are placed first fit
+        after previous partition, skipping pinned partitions they would overlap
+
+        :param setting: Layout or setting data
+        :param block_size: erase block size, partition offset and size are aligned to it
+        :param headroom: growth headroom in percent of component size
+        :param pinned: {name: offset} or partition names keep current offset
+        :param flash_size: if not zero, packed layout must be inside flash
+        :param output: if specified, packed settings is written to this json file
+        :param verbose: debug output options
+        :return: result, err_or_plan {"layout", "reserved_size", "previous_reserved_size", "image_size",
+        "previous_image_size", "saved_bytes"}
+        """
+        try:
+
+            layout = Layout.compile(setting)
+            if block_size <= 0 or headroom < 0:
+                raise ValueError("Invalid block size: {0:d} or headroom: {1:d}".format(block_size, headroom))
+
+            # Caller's dict is never changed
+            if isinstance(pinned, dict):
+                pinned = dict(pinned)
+            else:
+                pinned = {name: layout.get(name).offset for name in pinned or () if layout.get(name) is not None}
+            pinned.setdefault(FirmwareMaker.ESSENTIAL_FILE_LIST[0], 0)
+
+            def align(value):
+                return (value + block_size - 1) // block_size * block_size
+
+            reserved = dict()
+            for partition in layout:
+                if not partition.exists():
+                    raise ValueError("[{0:s}]: {1:s} is not exist!".format(partition.name, partition.path))
+
+                reserved[partition.name] = max(align(partition.length + partition.length * headroom // 100),
+                                               block_size)
+
+            # Pinned partitions are fixed regions, they must not overlap each other
+            fixed = sorted((offset, name) for name, offset in pinned.items() if layout.get(name) is not None)
+            for (offset, name), (next_offset, next_name) in zip(fixed, fixed[1:]):
+                if offset + reserved[name] > next_offset:
+                    raise ValueError("[{0:s}] pinned at 0x{1:x} overlapped with [{2:s}] pinned at 0x{3:x}".
+                                     format(name, offset, next_name, next_offset))
+
+            offsets = dict((name, offset) for offset, name in fixed)
+            position = index = 0
+            for partition in layout.by_offset():
+                if partition.name in offsets:
+                    continue
+
+                size = reserved[partition.name]
+                offset = align(position)
+                while index < len(fixed) and offset + size > fixed[index][0]:
+                    offset = max(offset, align(fixed[index][0] + reserved[fixed[index][1]]))
+                    index += 1
+
+                offsets[partition.name] = position = offset
+                position += size
+
+            packed = Layout([Partition(partition.name, offsets[partition.name], reserved[partition.name],
+                                       partition.path, partition.decompress) for partition in layout])
+
+            errors = FirmwareMaker.validate_layout(packed, block_size, flash_size)
+            if errors:
+                raise ValueError("\n".join(errors))
+
+            plan = {"layout": packed,
+                    "reserved_size": max(partition.end for partition in packed),
+                    "previous_reserved_size": max(partition.end for partition in layout),
+                    "image_size": max(partition.offset + partition.length for partition in packed),
+                    "previous_image_size": max(partition.offset + partition.length for partition in layout)}
+            plan["saved_bytes"] = plan.get("previous_reserved_size") - plan.get("reserved_size")
+
+            if verbose:
+                for partition in packed.by_offset():
+                    print "File:{0:s}\toffset:0x{1:x}\treserved size\t0x{2:x}{3:s}".\
+                        format(partition.name, partition.offset, partition.size,
+                               "\tpinned" if partition.name in pinned else "")
+
+            if output:
+                with open(output, "w") as fp:
+                    json.dump(packed.settings(), fp, indent=4)
+
+            return True, plan
+
+        except (IOError, ValueError, TypeError, OSError), e:
+            return False, "Pack layout error:{0:s}".format(e)
 
     @staticmethod
     def generate_configure(name, path, size, offset):
@@ -196,41 +1151,1186 @@ class FirmwareMaker(object):
         return {name: {"path": path, "size": "0x{0:x}".format(size), "offset": "0x{0:x}".format(offset)}}
 
     @staticmethod
-    def make_firmware(setting, output, verbose=False):
+    def copy_stream(src, dst, digest=None, buf=None, buffer_size=DEF_BUFFER_SIZE, limit=None):
+        """Copy src file object to dst file object chunk by chunk
+
+        :param src: source file object (opened in binary mode)
+        :param dst: destination file object (opened in binary mode), None means only update digest
+        :param digest: hash object updated with copied data, optional
+        :param buf: reusable bytearray buffer, allocate a new one if not specified
+        :param buffer_size: buffer size when buf is not specified
+        :param limit: max bytes to copy, None means copy until src EOF
+        :return: copied bytes
+        """
+        buf = buf if isinstance(buf, bytearray) else bytearray(buffer_size)
+        view = memoryview(buf)
+        copied = 0
+
+        while limit is None or copied < limit:
+            request = len(buf) if limit is None else min(len(buf), limit - copied)
+            length = src.readinto(view[:request])
+            if not length:
+                break
+
+            chunk = buffer(buf, 0, length)
+            if dst is not None:
+                dst.write(chunk)
+
+            if digest is not None:
+                digest.update(chunk)
+
+            copied += length
+
+        return copied
+
+    @staticmethod
+    def copy_component(src, dst, digest=None, buf=None, method=COPY_BUFFERED):
+        """Copy src file object to dst file object current position
+
+        Unless method is buffered, try kernel side copy first (see fastcopy.copy_range),
+        kernel copied data never reach user space, so digest is updated by reading src,
+        which is usually page cached at that time. Data kernel failed to copy is copied in user space.
+
+        :param src: source file object (opened in binary mode)
+        :param dst: destination file object (opened in binary mode)
+        :param digest: hash object updated with copied data, optional
+        :param buf: reusable bytearray buffer
+        :param method: copy method, see fastcopy.COPY_METHODS
+        :return: (used method, copied bytes)
+        """
+        if method == COPY_BUFFERED:
+            return COPY_BUFFERED, FirmwareMaker.copy_stream(src, dst, digest, buf)
+
+        dst.flush()
+        start = src.tell()
+        offset = dst.tell()
+        length = os.fstat(src.fileno()).st_size - start
+        used, copied = copy_range(src.fileno(), dst.fileno(), offset, length, method, start)
+
+        if copied and digest is not None:
+            FirmwareMaker.copy_stream(src, None, digest, buf, limit=copied)
+
+        src.seek(start + copied, os.SEEK_SET)
+        dst.seek(offset + copied, os.SEEK_SET)
+        return used, copied + FirmwareMaker.copy_stream(src, dst, digest, buf)
+
+    @staticmethod
+    def hash_pattern(digest, length, pattern=None, buffer_size=DEF_BUFFER_SIZE):
+        """Update digest with length bytes of repeated pattern without any io
+
+        :param digest: hash object
+        :param length: data length
+        :param pattern: single byte filled bytearray buffer, allocate a zero filled one if not specified
+        :param buffer_size: buffer size when pattern is not specified
+        :return: length
+        """
+        pattern = pattern if isinstance(pattern, bytearray) else bytearray(max(1, min(length, buffer_size)))
+        remain = length
+        while remain > 0:
+            chunk = min(remain, len(pattern))
+            digest.update(buffer(pattern, 0, chunk))
+            remain -= chunk
+
+        return max(length, 0)
+
+    @staticmethod
+    def fill_gap(dst, length, digest=None, pattern=None, overwrite=False, buffer_size=DEF_BUFFER_SIZE):
+        """Fill length bytes of dst with pattern byte
+
+        Zero gap is just skipped, file system fill it with zeros (hole), others are written from pattern buffer
+
+        :param dst: destination file object
+        :param length: gap length
+        :param digest: hash object updated with gap data, optional
+        :param pattern: single byte filled bytearray buffer, allocate a zero filled one if not specified
+        :param overwrite: gap contains old data, zero gap must be written too
+        :param buffer_size: buffer size when pattern is not specified
+        :return: gap length
+        """
+        if length <= 0:
+            return 0
+
+        pattern = pattern if isinstance(pattern, bytearray) else bytearray(min(length, buffer_size))
+        if not pattern[0] and not overwrite:
+            dst.seek(length, os.SEEK_CUR)
+        else:
+            remain = length
+            while remain:
+                chunk = min(remain, len(pattern))
+                dst.write(buffer(pattern, 0, chunk))
+                remain -= chunk
+
+        if digest is not None:
+            FirmwareMaker.hash_pattern(digest, length, pattern)
+
+        return length
+
+    @staticmethod
+    def hash_file(path, digest=None, buf=None):
+        """Calculate file digest
+
+        File holes (SEEK_DATA/SEEK_HOLE, e.g. gaps of sparse firmware) are hashed as zeros without reading disk
+
+        :param path: file path
+        :param digest: hash object, default is md5
+        :param buf: reusable bytearray buffer
+        :return: hash object
+        """
+        digest = hashlib.md5() if digest is None else digest
+        buf = buf if isinstance(buf, bytearray) else bytearray(FirmwareMaker.DEF_BUFFER_SIZE)
+
+        with open(path, "rb") as fp:
+            position = 0
+            zeros = bytearray(len(buf))
+            size = os.fstat(fp.fileno()).st_size
+            for offset, length in list(data_extents(fp.fileno(), 0, size)):
+                FirmwareMaker.hash_pattern(digest, offset - position, zeros)
+                fp.seek(offset, os.SEEK_SET)
+                FirmwareMaker.copy_stream(fp, None, digest, buf, limit=length)
+                position = offset + length
+
+            FirmwareMaker.hash_pattern(digest, size - position, zeros)
+
+        return digest
+
+    @staticmethod
+    def sparse_gaps(output, gaps):
+        """Make sure firmware gaps are file system holes
+
+        :param output: firmware file path
+        :param gaps: gap list [(offset, length)]
+        :return: (logical size, allocated size)
+        """
+        fd = os.open(output, os.O_WRONLY)
+
+        try:
+            for offset, length in gaps:
+                if not punch_hole(fd, offset, length):
+                    break
+        finally:
+            os.close(fd)
+
+        return allocated_size(output)
+
+    @staticmethod
+    def load_manifest(output):
+        """Load manifest of firmware
+
+        :param output: firmware file path
+        :return: manifest dict, None if not exist or invalid
+        """
+        try:
+
+            with open(output + FirmwareMaker.MANIFEST_SUFFIX) as fp:
+                manifest = json.load(fp)
+
+            return manifest if isinstance(manifest, dict) else None
+
+        except (ValueError, IOError):
+            return None
+
+    @staticmethod
+    def store_manifest(output, layout, fill_byte, partitions, digests):
+        """Store manifest of firmware
+
+        :param output: firmware file path
+        :param layout: firmware layout [[name, offset, size]] in offset order
+        :param fill_byte: gaps fill byte
+        :param partitions: each partition {name: {"path", "offset", "size", "length", "source_md5", digests...}}
+        :param digests: firmware digests {algorithm: hex digest}
+        :return: None
+        """
+        st = os.stat(output)
+        manifest = {"layout": layout,
+                    "fill": fill_byte,
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                    "partitions": partitions}
+
+        manifest.update(digests)
+        with open(output + FirmwareMaker.MANIFEST_SUFFIX, "w") as fp:
+            json.dump(manifest, fp, indent=4)
+
+    @staticmethod
+    def __copy_partition(partition, fw, digest, buf, method):
+        """Copy partition component data to fw current position
+
+        Compressed component is decompressed in user space, copy stops once reserved size is exceeded
+
+        :return: (used method, copied bytes)
+        """
+        with partition.open() as fp:
+            if partition.decompress:
+                return "decompress", FirmwareMaker.copy_stream(fp, fw, digest, buf, limit=partition.size + 1)
+
+            return FirmwareMaker.copy_component(fp, fw, digest, buf, method)
+
+    @staticmethod
+    def __write_firmware(fw, components, previous, digest, page_map, progress, reader, gaps, partitions,
+                         buf, pattern, copy_method, incremental, verbose, stats=NULL_STATS):
+        """Write components to firmware file object, see make_firmware
+
+        :return: firmware size
+        """
+        position = 0
+        for index, partition in enumerate(components):
+            offset, name, path, reserved = partition.offset, partition.name, partition.path, partition.size
+            if offset < position:
+                raise ValueError("[{0:s}] offset: 0x{1:x} overlapped, current offset: 0x{2:x}".
+                                 format(name, offset, position))
+
+            if offset > position:
+                gaps.append((position, offset - position))
+                if page_map is not None:
+                    page_map.fill(position, offset - position)
+
+            with stats.stage("partition", name) as record:
+                if page_map is not None:
+                    page_map.seek(offset)
+
+                if progress is not None:
+                    progress.begin(partition)
+
+                source = hashlib.md5() if incremental else None
+                group = DigestGroup(digest, source, page_map, progress)
+                if previous:
+                    # Source is hashed first, only changed partition is rewritten
+                    position += FirmwareMaker.hash_pattern(digest, offset - position, pattern)
+                    digest.begin_partition(name, offset, reserved)
+                    with partition.open() as fp:
+                        size = FirmwareMaker.copy_stream(fp, None, group, buf)
+
+                    last = previous.get("partitions", dict()).get(name, dict())
+                    method = "unchanged"
+
+                    if last.get("source_md5") != source.hexdigest() or last.get("length") != size:
+                        fw.seek(offset, os.SEEK_SET)
+                        method, _ = FirmwareMaker.__copy_partition(partition, fw, None, buf, copy_method)
+
+                        # Old data longer than new one must be filled
+                        fw.seek(offset + size, os.SEEK_SET)
+                        FirmwareMaker.fill_gap(fw, last.get("length", 0) - size, None, pattern, True)
+                else:
+                    position += FirmwareMaker.fill_gap(fw, offset - position, digest, pattern)
+                    digest.begin_partition(name, offset, reserved)
+                    if reader is not None:
+                        method, size = "read ahead", reader.copy(index, fw, group)
+                    else:
+                        method, size = FirmwareMaker.__copy_partition(partition, fw, group, buf, copy_method)
+
+                record.update({"bytes": size, "method": method})
+
+            # Recorded uncompressed size is used by check and layout, it must be right
+            if partition.decompress and size != partition.length:
+                raise ValueError("[{0:s}] uncompressed size: 0x{1:x} mismatch, expected size: 0x{2:x}, "
+                                 "reserved size: 0x{3:x}".format(name, size, partition.length, reserved))
+
+            digest.end_partition(pattern)
+            position += size
+
+            partitions[name] = {"path": path}
+            if source is not None:
+                partitions[name]["source_md5"] = source.hexdigest()
+
+            # Debug output
+            if verbose:
+                print "Write:{0:s}(0x{1:x}) to {2:s} offset: 0x{3:x}, {4:s}".\
+                    format(name, size, os.path.basename(fw.name), offset, method)
+
+        # Drop tail of previous firmware
+        fw.truncate(position)
+        return position
+
+    @staticmethod
+    def make_firmware(setting, output, verbose=False, buffer_size=DEF_BUFFER_SIZE, copy_method=COPY_BUFFERED,
+                      sparse=False, fill_byte=DEF_FILL_BYTE, page_size=0, block_size=DEF_BLOCK_SIZE,
+                      incremental=False, cache=None, manifest=False, progress=None, read_ahead=0,
+                      compress=None, compress_workers=None, stats=None):
         """Firmware make
 
-        :param setting: settings
+        :param setting: Layout or settings
         :param output:firmware output file name
         :param verbose: debug output options
+        :param buffer_size: copy buffer size, memory usage is constant whatever the component size is
+        :param copy_method: component copy method, see fastcopy.COPY_METHODS, 'auto' try the fastest one
+        :param sparse: punch gaps between components as file system holes
+        :param fill_byte: gaps fill byte, NAND erased state is 0xff
+        :param page_size: NAND page size, if not zero emit page map (output + PAGE_MAP_SUFFIX) with erased pages
+        :param block_size: NAND erase block size
+        :param incremental: if layout is unchanged since last incremental build (output + MANIFEST_SUFFIX),
+        only rewrite partitions whose source changed in existing firmware
+        :param cache: fwcache.BuildCache instance, if firmware is cached clone it to output instead of making,
+        not used with page map, incremental build and manifest (sidecar files are not cached)
+        :param manifest: write manifest (output + MANIFEST_SUFFIX) with firmware md5 and sha256, each partition
+        (including padding up to reserved size) crc32 and sha256, all digests are calculated in the same pass
+        on a worker thread
+        :param progress: progress callback, see BuildProgress, return False from it to cancel the build, partial
+        output is removed
+        :param read_ahead: read ahead memory budget, if not zero, components are prefetched on a reader thread and
+        hashed on another thread, overlap with writing, only for buffered copy and full build
+        :param compress: also write compressed firmware (output.<format>) while assembling, see fwcompress
+        :param compress_workers: compress process pool size, default is cpu count
+        :param stats: BuildStats instance, stages and partitions are recorded to it
         :return: result, err_or_md5
         """
+        compressor = None
+        stats = stats or NULL_STATS
+
         try:
 
-            with open(output, "wb") as fw:
-                for data in setting:
-                    name = data.keys()[0]
-                    path = data.get(name).get("path")
-                    size = os.path.getsize(path)
-                    offset = data.get(name).get("offset")
-                    offset = offset if isinstance(offset, int) else FirmwareMaker.str2number(offset)
+            with stats.stage("prepare"):
+                # Components are written in offset order, so image digest can be calculated while writing
+                components = Layout.compile(setting).by_offset()
+                buf = bytearray(buffer_size)
+                pattern = bytearray(chr(fill_byte)) * buffer_size
+                layout = [[partition.name, partition.offset, partition.size] for partition in components]
 
-                    # Set offset
-                    fw.seek(offset, os.SEEK_SET)
-                    fw.write(open(path, "rb").read())
+                # Holes are always read as zeros
+                if sparse and fill_byte:
+                    raise ValueError("sparse firmware requires zero fill byte, fill byte: 0x{0:02x}".
+                                     format(fill_byte))
 
-                    # Debug output
-                    if verbose:
-                        print "Write:{0:s}(0x{1:x}) to {2:s} offset: 0x{3:x}".\
-                            format(name, size, os.path.basename(output), offset)
+                page_map = None
+                if page_size > 0 and components:
+                    page_map = PageMap(components[-1].offset + max(components[-1].length, 0),
+                                       page_size, block_size, fill_byte, FirmwareMaker.NAND_FILL_BYTE)
+
+                cache_key = None
+                if cache is not None and page_map is None and not incremental and not manifest and not compress:
+                    cache_key = cache.build_key(components, fill_byte, sparse)
+                    cached = cache.lookup(cache_key, output)
+                    cache.flush()
+
+                    if cached:
+                        if verbose:
+                            print "Cache hit:{0:s}, {1:s}".format(cache_key, cached)
+                        return True, cached
+
+                # Previous build must have same layout and firmware is not modified after it
+                previous = FirmwareMaker.load_manifest(output) if incremental and os.path.isfile(output) else None
+                if previous and (previous.get("layout") != layout or previous.get("fill") != fill_byte or
+                                 previous.get("size") != os.path.getsize(output) or
+                                 previous.get("mtime") != os.path.getmtime(output)):
+                    previous = None
+
+                # Only a writable, not linked output is updated in place, otherwise it is replaced
+                # (it may be read only or hard linked, e.g. by a hard link based cache of an older version)
+                if previous and (os.stat(output).st_nlink > 1 or not os.access(output, os.W_OK)):
+                    previous = None
+                if not previous and os.path.isfile(output):
+                    os.remove(output)
+
+                if verbose and incremental:
+                    print "Incremental:{0:s}".format("update partitions in place" if previous else "full build")
+
+                gaps = list()
+                partitions = dict()
+                if compress:
+                    import fwcompress
+                    compressor = fwcompress.ParallelCompressor("{0:s}.{1:s}".format(output, compress), compress,
+                                                               workers=compress_workers)
+
+                reader = None
+                if read_ahead > 0 and copy_method == COPY_BUFFERED and not previous:
+                    reader = ReadAhead(components, buffer_size, read_ahead)
+
+                digest = ImageDigest(ImageDigest.MANIFEST_IMAGE_ALGORITHMS if manifest else
+                                     ImageDigest.DEF_IMAGE_ALGORITHMS,
+                                     ImageDigest.MANIFEST_PARTITION_ALGORITHMS if manifest else (),
+                                     manifest or reader is not None or compressor is not None, compressor)
+
+            start = time.time()
+            try:
+                with stats.stage("write") as record, open(output, "r+b" if previous else "wb") as fw:
+                    record["bytes"] = FirmwareMaker.__write_firmware(fw, components, previous, digest, page_map,
+                                                                     BuildProgress(progress, components)
+                                                                     if progress else None, reader, gaps,
+                                                                     partitions, buf, pattern, copy_method,
+                                                                     incremental, verbose, stats)
+            finally:
+                # Threaded digest and read ahead are drained
+                with stats.stage("digest"):
+                    digest.close()
+                    timing = reader.close() if reader is not None else None
+
+            # Stages are overlapped if their sum is greater than wall time
+            if verbose and timing is not None:
+                timing["hash"] = digest.hash_time
+                timing["wall"] = time.time() - start
+                overlap = (timing.get("read") + timing.get("write") + timing.get("hash")) / \
+                    max(timing.get("wall"), 1e-6)
+                print "Pipeline:{0:d} buffers, wall: {1:.3f}s, read: {2:.3f}s, write: {3:.3f}s, hash: {4:.3f}s, " \
+                      "wait: {5:.3f}s, overlap: {6:.2f}".\
+                    format(reader.buffers, timing.get("wall"), timing.get("read"), timing.get("write"),
+                           timing.get("hash"), timing.get("wait"), overlap)
+
+            if compressor is not None:
+                with stats.stage("compress") as record:
+                    compressed, compressor = compressor.close(), None
+                    record["bytes"] = compressed.get("compressed_size")
+                if verbose:
+                    print "Compress:{0:s}.{1:s} size: 0x{2:x}, compressed size: 0x{3:x}, blocks: {4:d}, " \
+                          "fill blocks: {5:d}".format(os.path.basename(output), compress, compressed.get("size"),
+                                                      compressed.get("compressed_size"), compressed.get("blocks"),
+                                                      compressed.get("fill_blocks"))
+
+            if sparse:
+                with stats.stage("sparse"):
+                    logical, allocated = FirmwareMaker.sparse_gaps(output, gaps)
+                if verbose:
+                    print "Sparse:{0:s} logical size: 0x{1:x}, allocated size: 0x{2:x}".\
+                        format(os.path.basename(output), logical, allocated)
+
+            if page_map is not None:
+                with stats.stage("page map"):
+                    erased = page_map.dump(output + FirmwareMaker.PAGE_MAP_SUFFIX)
+                if verbose:
+                    print "Page map:{0:s} erased pages: {1:d}/{2:d}".\
+                        format(os.path.basename(output) + FirmwareMaker.PAGE_MAP_SUFFIX, erased, len(page_map.dirty))
+
+            for name, result in digest.partitions.items():
+                partitions.setdefault(name, dict()).update(result)
+
+            if incremental or manifest:
+                with stats.stage("manifest"):
+                    FirmwareMaker.store_manifest(output, layout, fill_byte, partitions, digest.image_digests())
+
+            if cache_key:
+                with stats.stage("cache"):
+                    cache.store(cache_key, output, digest.hexdigest())
+
+        except BuildCancelled, e:
+
+            if compressor is not None:
+                compressor.abort()
 
-            # Calculate file md5
-            md5 = hashlib.md5()
-            md5.update(open(output, "rb").read())
+            # Partial output (and its manifest, in place update is partial too) is useless
+            for path in (output, output + FirmwareMaker.MANIFEST_SUFFIX):
+                if os.path.isfile(path):
+                    os.remove(path)
 
-        except(IOError, ValueError, OSError), e:
+            return False, "{0:s}".format(e)
+
+        except(IOError, ValueError, TypeError, OSError), e:
+
+            if compressor is not None:
+                compressor.abort()
 
             error = "Maker firmware error:{0:s}".format(e)
             return False, error
 
         # Return result and file md5
-        return True, md5.hexdigest()
+        return True, digest.hexdigest()
+
+    @staticmethod
+    def __patch_partition(fw, partition, last, buf, pattern, copy_method):
+        """Rewrite partition region of firmware in place, data left by longer previous component is filled
+
+        :param last: previous {"length", "source_md5"} of partition
+        :return: {"length", "source_md5", "method"}
+        """
+        partition.refresh()
+        if not partition.exists():
+            raise ValueError("[{0:s}]: {1:s} is not exist!".format(partition.name, partition.path))
+
+        # Component is checked before writing, it must never overwrite next partition
+        if partition.length > partition.size:
+            raise ValueError("[{0:s}]: {1:s} is to large, actual size: 0x{2:x}, reserved size: 0x{3:x}".
+                             format(partition.name, partition.path, partition.length, partition.size))
+
+        source = hashlib.md5()
+        fw.seek(partition.offset, os.SEEK_SET)
+        method, size = FirmwareMaker.__copy_partition(partition, fw, source, buf, copy_method)
+        if size > partition.size:
+            raise ValueError("[{0:s}] size: 0x{1:x} exceeds reserved size: 0x{2:x} while writing".
+                             format(partition.name, size, partition.size))
+
+        FirmwareMaker.fill_gap(fw, last.get("length", 0) - size, None, pattern, True)
+        return {"length": size, "source_md5": source.hexdigest(), "method": method}
+
+    @staticmethod
+    def watch_firmware(setting, output, fill_byte=DEF_FILL_BYTE, buffer_size=DEF_BUFFER_SIZE,
+                       copy_method=COPY_BUFFERED, interval=None, debounce=None,
+                       method=None, callback=None, stop=None, verbose=False):
+        """Make firmware, then watch component files and patch changed partitions in place until stopped
+
+        Layout and each partition length and source md5 are kept in memory, a changed component is read once
+        (hashed while written to its region), firmware md5 is not recalculated. Manifest of firmware is removed
+        on first patch because its digests are stale.
+
+        :param setting: Layout or settings
+        :param output: firmware output path
+        :param fill_byte: gaps fill byte
+        :param buffer_size: copy buffer size
+        :param copy_method: component copy method, see fastcopy.COPY_METHODS
+        :param interval: stat polling interval, also how often stop is checked, default is fwwatch.DEF_INTERVAL
+        :param debounce: quiet time before changes are patched, default is fwwatch.DEF_DEBOUNCE
+        :param method: fwwatch.WATCH_INOTIFY or fwwatch.WATCH_POLL, default is inotify if available
+        :param callback: callback(report) after each round, report is {"changed", "patched", "unchanged",
+        "errors", "time"}, return False from it to stop watching
+        :param stop: threading.Event, set it to stop watching
+        :param verbose: debug output options
+        :return: result, err_or_patch_rounds
+        """
+        import fwwatch
+        interval = fwwatch.DEF_INTERVAL if interval is None else interval
+        debounce = fwwatch.DEF_DEBOUNCE if debounce is None else debounce
+
+        try:
+
+            layout = Layout.compile(setting).refresh()
+            ret, err_or_md5 = FirmwareMaker.make_firmware(layout, output, verbose, buffer_size, copy_method,
+                                                          fill_byte=fill_byte, incremental=True)
+            if not ret:
+                return False, err_or_md5
+
+            # Incremental build manifest has source md5 and length of each partition
+            manifest = FirmwareMaker.load_manifest(output) or dict()
+            state = {name: {"length": value.get("length"), "source_md5": value.get("source_md5")}
+                     for name, value in manifest.get("partitions", dict()).items()}
+
+            last = layout.by_offset()[-1] if layout else None
+            watched = dict()
+            for partition in layout:
+                watched.setdefault(os.path.abspath(partition.path), list()).append(partition)
+
+            buf = bytearray(buffer_size)
+            pattern = bytearray(chr(fill_byte)) * buffer_size
+            rounds = 0
+
+            with fwwatch.ChangeWatcher([partition.path for partition in layout], interval, debounce, method) as watcher:
+                if verbose:
+                    print "Watch:{0:d} components, {1:s}, md5: {2:s}".format(len(watched), watcher.method, err_or_md5)
+
+                while stop is None or not stop.is_set():
+                    changed = watcher.wait(interval)
+                    if not changed:
+                        continue
+
+                    start = time.time()
+                    report = {"changed": list(), "patched": list(), "unchanged": list(), "errors": list()}
+                    partitions = [partition for path in changed for partition in watched.get(os.path.abspath(path))]
+
+                    with open(output, "r+b") as fw:
+                        for partition in sorted(partitions, key=lambda item: item.offset):
+                            report["changed"].append(partition.name)
+                            try:
+                                result = FirmwareMaker.__patch_partition(fw, partition, state.get(partition.name, {}),
+                                                                         buf, pattern, copy_method)
+                            except (IOError, ValueError, OSError), e:
+                                report["errors"].append("{0:s}".format(e))
+                                continue
+
+                            previous = state.get(partition.name, dict())
+                            state[partition.name] = result
+                            if previous.get("source_md5") == result.get("source_md5") and \
+                                    previous.get("length") == result.get("length"):
+                                report["unchanged"].append(partition.name)
+                            else:
+                                report["patched"].append(partition.name)
+
+                            if verbose:
+                                print "Patch:{0:s}(0x{1:x}) to {2:s} offset: 0x{3:x}, {4:s}".\
+                                    format(partition.name, result.get("length"), os.path.basename(output),
+                                           partition.offset, result.get("method"))
+
+                        # Firmware ends with the last partition data
+                        if last is not None and last.name in state:
+                            fw.truncate(last.offset + state[last.name].get("length"))
+
+                    if report.get("patched") and os.path.isfile(output + FirmwareMaker.MANIFEST_SUFFIX):
+                        os.remove(output + FirmwareMaker.MANIFEST_SUFFIX)
+
+                    rounds += 1
+                    report["time"] = time.time() - start
+                    if callback is not None and callback(report) is False:
+                        break
+
+            return True, rounds
+
+        except (IOError, ValueError, TypeError, OSError), e:
+            return False, "Watch firmware error:{0:s}".format(e)
+
+    @staticmethod
+    def make_sparse_image(setting, output, fill_byte=DEF_FILL_BYTE, dont_care=False,
+                          block_size=None, verbose=False, buffer_size=DEF_BUFFER_SIZE):
+        """Make Android sparse image (simg) directly from layout, raw firmware is never generated
+
+        Gaps are FILL (or DONT_CARE) chunks without any io, component blocks filled with a single byte
+        are FILL chunks, others are RAW chunks, see fwsparse
+
+        :param setting: Layout or settings
+        :param output: sparse image output path
+        :param fill_byte: gaps fill byte
+        :param dont_care: gaps are DONT_CARE chunks, flasher leaves them untouched
+        :param block_size: sparse block size, default is fwsparse.DEF_BLOCK_SIZE
+        :param verbose: debug output options
+        :param buffer_size: component read buffer size
+        :return: result, err_or_md5 (md5 of raw firmware, the same as make_firmware)
+        """
+        import fwsparse
+
+        try:
+
+            components = Layout.compile(setting).by_offset()
+            digest = hashlib.md5()
+            buf = bytearray(buffer_size)
+            pattern = bytearray(chr(fill_byte)) * buffer_size
+            position = 0
+
+            with fwsparse.SparseWriter(output, block_size or fwsparse.DEF_BLOCK_SIZE, fill_byte) as writer:
+                for partition in components:
+                    if partition.offset < position:
+                        raise ValueError("[{0:s}] offset: 0x{1:x} overlapped, current offset: 0x{2:x}".
+                                         format(partition.name, partition.offset, position))
+
+                    writer.fill(partition.offset - position, dont_care)
+                    FirmwareMaker.hash_pattern(digest, partition.offset - position, pattern)
+
+                    with partition.open() as fp:
+                        size = FirmwareMaker.copy_stream(fp, writer, digest, buf,
+                                                         limit=partition.size + 1 if partition.decompress else None)
+
+                    if partition.decompress and size != partition.length:
+                        raise ValueError("[{0:s}] uncompressed size: 0x{1:x} mismatch, expected size: 0x{2:x}".
+                                         format(partition.name, size, partition.length))
+
+                    position = partition.offset + size
+
+                stats = writer.close()
+
+            if verbose:
+                print "Sparse image:{0:s} size: 0x{1:x}, sparse size: 0x{2:x}, chunks: {3:d}, raw blocks: {4:d}, " \
+                      "fill blocks: {5:d}, don't care blocks: {6:d}".\
+                    format(os.path.basename(output), stats.get("size"), stats.get("sparse_size"), stats.get("chunks"),
+                           stats.get("raw_blocks"), stats.get("fill_blocks"), stats.get("dont_care_blocks"))
+
+            return True, digest.hexdigest()
+
+        except (IOError, ValueError, TypeError, OSError), e:
+            if os.path.isfile(output):
+                os.remove(output)
+
+            return False, "Make sparse image error:{0:s}".format(e)
+
+    @staticmethod
+    def expand_sparse_image(sparse, output):
+        """Expand Android sparse image to raw firmware, raw size is rounded up to sparse block size
+
+        :param sparse: sparse image path
+        :param output: raw firmware output path
+        :return: result, err_or_size
+        """
+        import fwsparse
+
+        try:
+
+            return True, fwsparse.expand(sparse, output)
+
+        except (IOError, ValueError, OSError, struct.error), e:
+            return False, "Expand sparse image error:{0:s}".format(e)
+
+    @staticmethod
+    def __verify_region(region):
+        """Compare one firmware region with component file or fill byte, running in thread pool
+
+        :param region: (mm, name, offset, length, partition, src_offset, fill_byte, buffer_size), partition is None
+        for padding
+        :return: None if matched, otherwise (name, offset, message)
+        """
+        mm, name, offset, length, partition, src_offset, fill_byte, buffer_size = region
+        pattern = chr(fill_byte) * min(buffer_size, length)
+        buf = bytearray(min(buffer_size, length))
+        fp = partition.open() if partition else None
+
+        try:
+
+            # Compressed component is never sliced
+            if src_offset:
+                fp.seek(src_offset, os.SEEK_SET)
+
+            done = 0
+            while done < length:
+                size = min(len(buf), length - done)
+                if fp is None:
+                    expected = buffer(pattern, 0, size)
+                else:
+                    buf = buf if size == len(buf) else bytearray(size)
+                    if fp.readinto(buf) != size:
+                        return name, offset + done, "component file is shorter than layout"
+                    expected = buffer(buf, 0, size)
+
+                # Both sides are buffers, compare without copying image data
+                if expected != buffer(mm, offset + done, size):
+                    for index in xrange(size):
+                        if expected[index] != mm[offset + done + index]:
+                            break
+                    else:
+                        index = 0
+
+                    if fp is None:
+                        return name, offset + done + index, "padding is not fill byte 0x{0:02x}".format(fill_byte)
+                    return name, offset + done + index, "data differs from {0:s}".format(partition.path)
+
+                done += size
+
+            return None
+
+        finally:
+
+            if fp is not None:
+                fp.close()
+
+    @staticmethod
+    def verify_firmware(setting, firmware, fill_byte=DEF_FILL_BYTE, workers=None, verbose=False,
+                        buffer_size=DEF_BUFFER_SIZE):
+        """Verify existing firmware against settings and component files without rebuilding
+
+        Firmware is memory mapped and split into regions by layout, each partition data region is compared
+        with its component file, padding of its reserved region and gaps outside any reserved region are
+        checked against fill byte, large regions are split into VERIFY_SLICE_SIZE slices, slices are compared
+        in a thread pool. Holes are zeros, so zero padding in file holes (sparse firmware) is never read
+
+        :param setting: Layout or settings
+        :param firmware: firmware file path
+        :param fill_byte: expected gaps fill byte
+        :param workers: thread pool size, default is cpu count
+        :param verbose: debug output options
+        :param buffer_size: compare buffer size
+        :return: result, errors, each error is a string starts with partition name (or "gap")
+        """
+        try:
+
+            components = Layout.compile(setting).by_offset()
+            regions = list()
+            position = 0
+            reserved_end = 0
+            previous = None
+            for partition in components:
+                if partition.offset < position:
+                    return False, ["[{0:s}] offset: 0x{1:x} overlapped, current offset: 0x{2:x}".
+                                   format(partition.name, partition.offset, position)]
+
+                if not partition.exists():
+                    return False, ["[{0:s}] component file: {1:s} is not exist".format(partition.name, partition.path)]
+
+                # Padding up to end of previous reserved region belongs to previous partition, the rest is a gap
+                padding_end = min(max(reserved_end, position), partition.offset)
+                if previous is not None:
+                    regions.append((previous.name, position, padding_end - position, None))
+                regions.append(("gap", padding_end, partition.offset - padding_end, None))
+
+                regions.append((partition.name, partition.offset, partition.length, partition))
+                position = partition.offset + partition.length
+                reserved_end = partition.offset + partition.size
+                previous = partition
+
+            size = os.path.getsize(firmware)
+            if size != position:
+                return False, ["[{0:s}] size: 0x{1:x} mismatch, expected size: 0x{2:x}".
+                               format(os.path.basename(firmware), size, position)]
+
+            if not size:
+                return True, list()
+
+            with open(firmware, "rb") as fp:
+                extents = list(data_extents(fp.fileno(), 0, size)) if not fill_byte else None
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+
+                slices = list()
+                for name, offset, length, partition in regions:
+                    # Only data extents of zero padding are compared
+                    pieces = [(offset, length)]
+                    if partition is None and extents is not None:
+                        pieces = [(max(start, offset), min(start + count, offset + length) - max(start, offset))
+                                  for start, count in extents if start < offset + length and offset < start + count]
+
+                    step = length if partition and partition.decompress else FirmwareMaker.VERIFY_SLICE_SIZE
+                    for begin, count in pieces:
+                        for start in range(0, count, max(step, 1)):
+                            slices.append((mm, name, begin + start, min(step, count - start),
+                                           partition, start if partition else 0, fill_byte, buffer_size))
+
+                import multiprocessing
+                from multiprocessing.pool import ThreadPool
+                workers = min(workers or multiprocessing.cpu_count(), max(len(slices), 1))
+                if workers > 1:
+                    pool = ThreadPool(workers)
+                    try:
+                        results = pool.map(FirmwareMaker.__verify_region, slices)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    results = map(FirmwareMaker.__verify_region, slices)
+
+            finally:
+
+                mm.close()
+
+            # Only report the first mismatch of each partition, gaps are reported before the partition after them
+            mismatches = dict()
+            for name, offset, message in filter(None, results):
+                if name not in mismatches or offset < mismatches.get(name)[0]:
+                    mismatches[name] = (offset, message)
+
+            errors = list()
+            gaps = list()
+            failures = sorted((offset, message) for name, offset, message in filter(None, results) if name == "gap")
+            for name, start, length, _ in regions:
+                found = [failure for failure in failures if name == "gap" and start <= failure[0] < start + length]
+                if found:
+                    gaps.append(found[0])
+
+            for partition in components:
+                while gaps and gaps[0][0] < partition.offset:
+                    errors.append("[gap] mismatch at offset: 0x{0:x}, {1:s}".format(*gaps.pop(0)))
+
+                if partition.name in mismatches:
+                    offset, message = mismatches.get(partition.name)
+                    errors.append("[{0:s}] mismatch at offset: 0x{1:x}, {2:s}".format(partition.name, offset, message))
+                elif verbose:
+                    print "Verify:{0:s} offset: 0x{1:x} size: 0x{2:x}, ok".\
+                        format(partition.name, partition.offset, partition.length)
+
+            return not errors, errors
+
+        except (IOError, ValueError, TypeError, OSError, mmap.error), e:
+            return False, ["Verify firmware error:{0:s}".format(e)]
+
+    @staticmethod
+    def extract_firmware(setting, firmware, output_dir=".", names=None, trim=False, fill_byte=DEF_FILL_BYTE,
+                         copy_method=COPY_AUTO, verbose=False, buffer_size=DEF_BUFFER_SIZE):
+        """Extract partitions from firmware image to separate files
+
+        Image is memory mapped, each partition region (reserved size, clipped to image size) is copied
+        in kernel (see fastcopy.copy_range) or written directly from mapped image, settings file refer
+        to extracted files is written to output_dir/DEF_SETTING_PATH, so firmware could be made again
+
+        :param setting: Layout or settings
+        :param firmware: firmware image path
+        :param output_dir: extracted files directory, file name is partition name with .bin extension
+        :param names: partitions to extract, default is all
+        :param trim: trim trailing fill bytes of each partition
+        :param fill_byte: fill byte to trim
+        :param copy_method: copy method, see fastcopy.COPY_METHODS
+        :param verbose: debug output options
+        :param buffer_size: write chunk size when data is written from mapped image
+        :return: result, err_or_extracted {name: {"path", "offset", "length"}}
+        """
+        try:
+
+            extracted = dict()
+            settings = list()
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+
+            with FirmwareImage(firmware, setting) as image:
+                for name in names or image.layout.names():
+                    offset, length = image.region(name, trim, fill_byte)
+                    path = os.path.join(output_dir, "{0:s}.bin".format(name.replace(" ", "_")))
+                    with open(path, "wb") as fw:
+                        method, copied = copy_range(image.fileno(), fw.fileno(), 0, length, copy_method, offset)
+                        fw.seek(copied, os.SEEK_SET)
+                        for position in range(offset + copied, offset + length, buffer_size):
+                            fw.write(buffer(image.mm, position, min(buffer_size, offset + length - position)))
+
+                    extracted[name] = {"path": path, "offset": offset, "length": length}
+                    settings.append(Partition(name, image.layout.get(name).offset,
+                                              image.layout.get(name).size, path).setting())
+
+                    if verbose:
+                        print "Extract:{0:s}(0x{1:x}) from {2:s} offset: 0x{3:x} to {4:s}, {5:s}".\
+                            format(name, length, os.path.basename(firmware), offset, path, method)
+
+            with open(os.path.join(output_dir, FirmwareMaker.DEF_SETTING_PATH), "w") as fp:
+                json.dump(settings, fp, indent=4)
+
+            return True, extracted
+
+        except (IOError, ValueError, TypeError, OSError, mmap.error), e:
+            return False, "Extract firmware error:{0:s}".format(e)
+
+    @staticmethod
+    def make_flash_plan(setting, output_dir, previous=None, fill_byte=DEF_FILL_BYTE, trim=False,
+                        copy_method=COPY_AUTO, verbose=False, buffer_size=DEF_BUFFER_SIZE, erased_byte=NAND_FILL_BYTE):
+        """Make per partition output and a flash plan instead of a monolithic firmware
+
+        Each partition data is written to output_dir/<name>.bin, flash plan lists (offset, length, file)
+        to flash, as json (FLASH_PLAN_FILE) and SAM-BA tcl script (FLASH_SCRIPT_FILE), padding is never
+        flashed. Partitions whose offset, size and data sha256 are the same as previous plan are skipped,
+        so are empty partitions (no data or all erased bytes, flash reads them back the same), unless previous
+        plan has data in them, then their reserved region is erased
+
+        :param setting: Layout or settings
+        :param output_dir: partition files and flash plan directory
+        :param previous: previous flash plan path, default is the plan in output_dir if exists
+        :param fill_byte: gaps fill byte of the monolithic firmware, recorded in plan
+        :param trim: trim trailing erased bytes of each partition
+        :param copy_method: copy method, see fastcopy.COPY_METHODS
+        :param verbose: debug output options
+        :param buffer_size: copy buffer size
+        :param erased_byte: flash erased state, unflashed bytes read back as it
+        :return: result, err_or_plan
+        """
+        try:
+
+            previous = previous or os.path.join(output_dir, FirmwareMaker.FLASH_PLAN_FILE)
+            last = dict()
+            if os.path.isfile(previous):
+                with open(previous) as fp:
+                    last = dict((entry.get("name"), entry) for entry in json.load(fp).get("partitions", list()))
+
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+
+            buf = bytearray(buffer_size)
+            entries = list()
+            for partition in Layout.compile(setting).by_offset():
+                sha256 = hashlib.sha256()
+                extent = DataExtent(erased_byte)
+                with partition.open() as src:
+                    FirmwareMaker.copy_stream(src, None, DigestGroup(sha256, extent), buf)
+
+                length = extent.end if trim else extent.length
+                name = "{0:s}.bin".format(partition.name.replace(" ", "_"))
+                path = os.path.join(output_dir, name)
+                entry = {"name": partition.name, "offset": partition.offset, "size": partition.size,
+                         "length": length, "file": name, "sha256": sha256.hexdigest()}
+
+                # Data of previous plan is still on flash
+                if not extent.end:
+                    entry["action"] = "erase" if last.get(partition.name, dict()).get("action") in \
+                        ("flash", "unchanged") else "empty"
+                elif all(last.get(partition.name, dict()).get(key) == entry.get(key)
+                         for key in ("offset", "size", "length", "sha256")) and \
+                        os.path.isfile(path) and os.path.getsize(path) == length:
+                    entry["action"] = "unchanged"
+                else:
+                    entry["action"] = "flash"
+                    with partition.open() as src, open(path, "wb") as dst:
+                        method, copied = COPY_BUFFERED, 0
+                        if copy_method != COPY_BUFFERED and not partition.decompress:
+                            method, copied = copy_range(src.fileno(), dst.fileno(), 0, length, copy_method)
+                            src.seek(copied, os.SEEK_SET)
+                            dst.seek(copied, os.SEEK_SET)
+
+                        FirmwareMaker.copy_stream(src, dst, None, buf, limit=length - copied)
+
+                entries.append(entry)
+                if verbose:
+                    print "Plan:{0:s}(0x{1:x}) offset: 0x{2:x}, {3:s}".\
+                        format(partition.name, length, partition.offset, entry.get("action"))
+
+            flash = [entry for entry in entries if entry.get("action") == "flash"]
+            erase = [entry for entry in entries if entry.get("action") == "erase"]
+            plan = {"fill": "0x{0:02x}".format(fill_byte),
+                    "erased": "0x{0:02x}".format(erased_byte),
+                    "partitions": entries,
+                    "flash": [[entry.get("offset"), entry.get("length"), entry.get("file")] for entry in flash],
+                    "erase": [[entry.get("offset"), entry.get("size")] for entry in erase],
+                    "flash_bytes": sum(entry.get("length") for entry in flash),
+                    "erase_bytes": sum(entry.get("size") for entry in erase),
+                    "skipped_bytes": sum(entry.get("length") for entry in entries if entry not in flash + erase),
+                    "image_bytes": max([entry.get("offset") + entry.get("length") for entry in entries] or [0])}
+
+            with open(os.path.join(output_dir, FirmwareMaker.FLASH_PLAN_FILE), "w") as fp:
+                json.dump(plan, fp, indent=4)
+
+            with open(os.path.join(output_dir, FirmwareMaker.FLASH_SCRIPT_FILE), "w") as fp:
+                fp.write("# SAM-BA flash plan, only changed partitions are sent, {0:d} bytes\n".
+                         format(plan.get("flash_bytes")))
+                fp.write("set media \"NandFlash\"\n")
+                for offset, size in plan.get("erase"):
+                    fp.write("NANDFLASH::EraseBlocks 0x{0:x} 0x{1:x}\n".format(offset, offset + size))
+                for offset, length, name in plan.get("flash"):
+                    fp.write("send_file $media \"{0:s}\" 0x{1:x} 0\n".format(name, offset))
+
+            return True, plan
+
+        except (IOError, ValueError, TypeError, OSError), e:
+            return False, "Make flash plan error:{0:s}".format(e)
+
+    @staticmethod
+    def make_delta(source, target, delta, source_setting=None, target_setting=None,
+                   block_size=None, verbose=False):
+        """Generate block level delta from source (old) firmware to target (new) firmware, see fwdelta
+
+        If target settings is specified, target is compared partition by partition, each partition is only
+        matched against the same name partition of source (source settings, default is target settings),
+        gaps are matched against the same range of source
+
+        :param source: source firmware path
+        :param target: target firmware path
+        :param delta: delta output path
+        :param source_setting: source Layout or settings
+        :param target_setting: target Layout or settings
+        :param block_size: match block size, default is fwdelta.DEF_BLOCK_SIZE
+        :param verbose: debug output options
+        :return: result, err_or_stats
+        """
+        import fwdelta
+        try:
+
+            regions = None
+            if target_setting is not None:
+                target_size = os.path.getsize(target)
+                layout = Layout.compile(target_setting)
+                old = Layout.compile(source_setting) if source_setting is not None else layout
+
+                regions = list()
+                position = 0
+                for partition in layout.by_offset():
+                    start = max(min(partition.offset, target_size), position)
+                    end = max(min(partition.end, target_size), start)
+                    if start > position:
+                        regions.append((position, start - position, position, start - position))
+
+                    previous = old.get(partition.name, partition)
+                    regions.append((start, end - start, previous.offset, previous.size))
+                    position = end
+
+                if target_size > position:
+                    regions.append((position, target_size - position, position, target_size - position))
+
+            stats = fwdelta.make_delta(source, target, delta, regions, block_size or fwdelta.DEF_BLOCK_SIZE)
+            if verbose:
+                for key, value in sorted(stats.items()):
+                    print "Delta:{0:s}: {1}".format(key, value)
+
+            return True, stats
+
+        except (IOError, ValueError, TypeError, OSError, mmap.error), e:
+            return False, "Make delta error:{0:s}".format(e)
+
+    @staticmethod
+    def apply_delta(source, delta, output):
+        """Apply delta generated by make_delta to source firmware
+
+        :param source: source firmware path
+        :param delta: delta path
+        :param output: target firmware output path, could be the same as source
+        :return: result, err_or_md5
+        """
+        import fwdelta
+        try:
+
+            return True, fwdelta.apply_delta(source, delta, output)
+
+        except (IOError, ValueError, TypeError, OSError, struct.error), e:
+            return False, "Apply delta error:{0:s}".format(e)
+
+    @staticmethod
+    def make_batch(configs, output_dir=".", workers=None, verbose=False, **options):
+        """Make firmware for each configure file in a process pool
+
+        Configure files are loaded and checked only once in main process, shared component digests are
+        calculated once there and workers share them through build cache (a temporary one in output_dir if
+        options doesn't contain one), configure files of the same cache key are built once, the others are
+        cloned from cache after that. Output file name is configure file name with .bin extension,
+        a summary is written to output_dir/BATCH_SUMMARY_FILE
+
+        :param configs: configure file list or glob pattern(s)
+        :param output_dir: firmware output directory
+        :param workers: process pool size, default is cpu count
+        :param verbose: debug output options
+        :param options: other make_firmware options
+        :return: all success return True else False, summary list
+        """
+        configs = [configs] if isinstance(configs, types.StringTypes) else configs
+        paths = list()
+        for pattern in configs:
+            matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            paths.extend(path for path in matched if path not in paths)
+
+        tasks = list()
+        summary = list()
+        outputs = dict()
+        for conf in paths:
+            name = os.path.splitext(os.path.basename(conf))[0]
+            output = os.path.join(output_dir, name + ".bin")
+
+            ret, layout = FirmwareMaker.load_configure(conf)
+            if ret:
+                ret, error = FirmwareMaker.check_configure(layout, verbose)
+            else:
+                error = "Load settings file:{0:s} error, {1:s}".format(conf, layout)
+
+            if ret and output in outputs:
+                ret, error = False, "output {0:s} conflict with {1:s}".format(output, outputs.get(output))
+
+            if not ret:
+                summary.append({"conf": conf, "output": output, "result": False, "elapsed": 0.0, "error": error})
+                continue
+
+            outputs[output] = conf
+            tasks.append((conf, layout, output, options))
+
+        if tasks and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        import shutil
+        import tempfile
+        import multiprocessing
+        temp_dir = None
+        try:
+
+            # Hash shared components once before workers start, make_firmware doesn't use cache with sidecar files
+            cache = options.get("cache")
+            cacheable = not any(options.get(name) for name in ("page_size", "incremental", "manifest", "compress"))
+            if cache is None and cacheable and tasks:
+                from fwcache import BuildCache
+                temp_dir = tempfile.mkdtemp(prefix=".cache-", dir=output_dir)
+                cache = BuildCache(temp_dir)
+                options = dict(options, cache=cache)
+                tasks = [(conf, layout, output, options) for conf, layout, output, _ in tasks]
+
+            first, duplicates, keys = list(tasks), list(), set()
+            if cache is not None:
+                shared = dict((partition.path, partition) for _, layout, _, _ in tasks for partition in layout)
+                for path, partition in shared.items():
+                    cache.file_digest(path, partition.stat)
+                cache.flush()
+
+            # Same firmware is built by the first task, others wait and hit cache
+            if cache is not None and cacheable:
+                first = list()
+                for task in tasks:
+                    key = cache.build_key(task[1], options.get("fill_byte", FirmwareMaker.DEF_FILL_BYTE),
+                                          options.get("sparse", False))
+                    (duplicates if key in keys else first).append(task)
+                    keys.add(key)
+
+            results = list()
+            workers = min(workers or multiprocessing.cpu_count(), max(len(first), 1))
+            for group in (first, duplicates):
+                if workers > 1 and len(group) > 1:
+                    pool = multiprocessing.Pool(workers)
+                    try:
+                        results.extend(pool.map(_batch_worker, group))
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    results.extend(map(_batch_worker, group))
+
+        finally:
+
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        summary.extend(results)
+        summary.sort(key=lambda item: item.get("conf"))
+
+        if verbose:
+            for item in summary:
+                print "{0:s} ===> {1:s}: {2:s}".format(item.get("conf"), item.get("output"),
+                                                      item.get("md5") or item.get("error"))
+
+        if os.path.isdir(output_dir):
+            with open(os.path.join(output_dir, FirmwareMaker.BATCH_SUMMARY_FILE), "w") as fp:
+                json.dump(summary, fp, indent=4)
+
+        return all(item.get("result") for item in summary) and len(summary) > 0, summary
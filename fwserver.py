@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""Local build server, several users and CI runners on one host share one component digest cache
+
+Server listens on localhost TCP ("127.0.0.1:8091") or a Unix socket ("unix:/path/to/socket") and speaks
+HTTP with json bodies, so it could also be used by curl:
+
+    POST /build     {"settings": [...], "cwd": "/client/dir", "output": "name.bin", "options": {...}}
+                    ===> {"result", "output", "md5", "components": {name: sha256}, "cached", "elapsed", "error"}
+    GET  /status    ===> {"workers", "pending", "builds", "failures", "cache": {...}}
+
+Relative component paths are resolved against request cwd. Firmware is built into a temporary file of server
+output directory, then renamed to <output name>-<md5>.bin (output is a file name, directory part and extension
+are dropped, default is "firmware"), a returned path always holds the firmware of that request, the same path
+means the same content. Client clones (or copies) it to its own output. Builds run on a bounded thread pool,
+requests exceeding workers + queue size are rejected (HTTP 503) instead of piling up. Component digests and
+built firmware are cached by fwcache.BuildCache, digests are kept in memory, so an unchanged rootfs is hashed
+only once.
+"""
+
+import os
+import json
+import time
+import socket
+import httplib
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from fwmaker import FirmwareMaker, Layout, Partition, BuildStats
+from fwcache import BuildCache
+from fastcopy import copy_file
+
+
+__all__ = ['DEF_ADDRESS', 'BuildServer', 'build_remote', 'server_status']
+
+DEF_ADDRESS = "127.0.0.1:8091"
+DEF_QUEUE_SIZE = 16
+DEF_TIMEOUT = 3600
+UNIX_PREFIX = "unix:"
+BUILD_OPTIONS = ("fill_byte", "sparse", "copy_method", "buffer_size")
+
+
+def parse_address(address):
+    """Parse server address
+
+    :param address: "host:port", ":port" or "unix:path"
+    :return: (socket family, address)
+    """
+    if address.startswith(UNIX_PREFIX):
+        return socket.AF_UNIX, address[len(UNIX_PREFIX):]
+
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=DEF_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Stale socket of a killed server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "FirmwareMaker"
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def log_message(self, fmt, *args):
+        if self.server.builder.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def __reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.__reply(200, self.server.builder.status())
+        else:
+            self.__reply(404, {"result": False, "error": "Unknown path: {0:s}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/build":
+            self.__reply(404, {"result": False, "error": "Unknown path: {0:s}".format(self.path)})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+        except ValueError, e:
+            self.__reply(400, {"result": False, "error": "Invalid request: {0:s}".format(e)})
+            return
+
+        response = self.server.builder.submit(request)
+        self.__reply(503 if response.get("busy") else 200, response)
+
+
+class BuildServer(object):
+    """Build server, see module document"""
+
+    def __init__(self, address=DEF_ADDRESS, output_dir=".", workers=None, queue_size=DEF_QUEUE_SIZE,
+                 cache=None, verbose=False):
+        """Build server
+
+        :param address: "host:port" or "unix:path", see parse_address
+        :param output_dir: firmware output directory
+        :param workers: build thread pool size, default is cpu count
+        :param queue_size: max queued requests when all workers are busy
+        :param cache: fwcache.BuildCache instance, default is BuildCache()
+        :param verbose: debug output options
+        :return:
+        """
+        self.address = address
+        self.output_dir = os.path.abspath(output_dir)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.cache = cache or BuildCache()
+        self.verbose = verbose
+        self.pool = ThreadPool(self.workers)
+        self.lock = threading.Lock()
+        self.counters = {"pending": 0, "builds": 0, "failures": 0, "rejected": 0}
+
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        family, server_address = parse_address(address)
+        server_class = _ThreadingUnixHTTPServer if family == socket.AF_UNIX else _ThreadingHTTPServer
+        self.server = server_class(server_address, _RequestHandler)
+        self.server.builder = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def build(self, request):
+        """Build firmware of request in current thread
+
+        :param request: see module document
+        :return: response dict
+        """
+        start = time.time()
+        cwd = request.get("cwd") or os.getcwd()
+        options = {key: value for key, value in (request.get("options") or dict()).items() if key in BUILD_OPTIONS}
+
+        try:
+
+            layout = Layout.compile(request.get("settings"))
+            layout = Layout([Partition(partition.name, partition.offset, partition.size,
+                                       os.path.join(cwd, partition.path), partition.decompress)
+                             for partition in layout])
+
+            errors = FirmwareMaker.validate_layout(layout)
+            if errors:
+                raise ValueError("\n".join(errors))
+
+            # Concurrent requests never write the same file, renamed file of the same name has the same content
+            stem = os.path.splitext(os.path.basename(request.get("output") or ""))[0] or "firmware"
+            fd, temp = tempfile.mkstemp(prefix=".build-", suffix=".bin", dir=self.output_dir)
+            os.close(fd)
+
+            try:
+
+                stats = BuildStats()
+                ret, err_or_md5 = FirmwareMaker.make_firmware(layout, temp, cache=self.cache, stats=stats, **options)
+                if not ret:
+                    raise ValueError(err_or_md5)
+
+                output = os.path.join(self.output_dir, "{0:s}-{1:s}.bin".format(stem, err_or_md5))
+                os.rename(temp, output)
+
+            finally:
+
+                if os.path.exists(temp):
+                    os.remove(temp)
+
+            # Cached firmware is cloned to output, nothing is written
+            cached = not any(record.get("stage") == "write" for record in stats.stages())
+
+            components = {partition.name: self.cache.file_digest(partition.path, partition.stat)
+                          for partition in layout}
+            self.cache.flush()
+
+            return {"result": True, "output": output, "md5": err_or_md5, "components": components,
+                    "cached": cached, "elapsed": time.time() - start}
+
+        except (IOError, ValueError, TypeError, OSError), e:
+            return {"result": False, "error": "{0:s}".format(e), "elapsed": time.time() - start}
+
+    def submit(self, request):
+        """Build firmware on worker pool, called by request handler threads
+
+        :param request: see module document
+        :return: response dict, {"result": False, "busy": True} if queue is full
+        """
+        with self.lock:
+            if self.counters.get("pending") >= self.workers + self.queue_size:
+                self.counters["rejected"] += 1
+                return {"result": False, "busy": True, "error": "Server is busy, {0:d} pending builds".
+                        format(self.counters.get("pending"))}
+
+            self.counters["pending"] += 1
+
+        try:
+            response = self.pool.apply(self.build, (request,))
+        finally:
+            with self.lock:
+                self.counters["pending"] -= 1
+
+        with self.lock:
+            self.counters["builds"] += 1
+            self.counters["failures"] += 0 if response.get("result") else 1
+
+        if self.verbose:
+            print "Build:{0:s}, {1:s}, {2:.3f}s".format(response.get("output", "-"),
+                                                        response.get("md5") or response.get("error"),
+                                                        response.get("elapsed"))
+
+        return response
+
+    def status(self):
+        with self.lock:
+            status = dict(self.counters)
+
+        status.update({"workers": self.workers, "queue_size": self.queue_size, "output_dir": self.output_dir,
+                       "cache": self.cache.stats()})
+        return status
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever(), called from another thread"""
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        self.pool.close()
+        self.pool.join()
+
+        family, server_address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(server_address):
+            os.remove(server_address)
+
+
+def _request(address, method, path, body=None, timeout=DEF_TIMEOUT):
+    family, server_address = parse_address(address)
+    if family == socket.AF_UNIX:
+        connection = _UnixHTTPConnection(server_address, timeout)
+    else:
+        connection = httplib.HTTPConnection(server_address[0], server_address[1], timeout=timeout)
+
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None,
+                           {"Content-Type": "application/json"})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def build_remote(address, settings, output=None, cwd=None, timeout=DEF_TIMEOUT, **options):
+    """Build firmware on server, thin client
+
+    :param address: server address, see parse_address
+    :param settings: settings list (or Layout)
+    :param output: if specified, firmware built by server is cloned (or copied) to it
+    :param cwd: directory relative component paths are resolved against, default is current directory
+    :param timeout: seconds to wait for build
+    :param options: make_firmware options, see BUILD_OPTIONS
+    :return: result, err_or_response
+    """
+    settings = settings.settings() if isinstance(settings, Layout) else settings
+    request = {"settings": settings, "cwd": os.path.abspath(cwd or os.getcwd()),
+               "output": os.path.basename(output) if output else None, "options": options}
+
+    try:
+
+        response = _request(address, "POST", "/build", request, timeout)
+        if not response.get("result"):
+            return False, response.get("error")
+
+        # Server and client share the file system
+        remote = response.get("output")
+        if output and os.path.abspath(output) != remote:
+            if os.path.lexists(output):
+                os.remove(output)
+
+            copy_file(remote, output)
+
+        return True, response
+
+    except (IOError, ValueError, OSError, socket.error, httplib.HTTPException), e:
+        return False, "Build server error:{0:s}".format(e)
+
+
+def server_status(address, timeout=10):
+    """Get server status
+
+    :return: result, err_or_status
+    """
+    try:
+        return True, _request(address, "GET", "/status", timeout=timeout)
+    except (IOError, ValueError, socket.error, httplib.HTTPException), e:
+        return False, "Build server error:{0:s}".format(e)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Android sparse image (simg) writer and expander
+
+Sparse image is a file header followed by chunks, integers are little endian:
+
+    file header     magic, version 1.0, header sizes, block size, total blocks, total chunks, checksum (0)
+    RAW chunk       chunk header + data of chunk blocks
+    FILL chunk      chunk header + 4 bytes fill value, chunk blocks are filled with it
+    DONT_CARE chunk chunk header, flasher skips chunk blocks
+    CRC32 chunk     chunk header + 4 bytes crc32 (only read)
+
+SparseWriter is written block by block as a file object, blocks filled with a single byte become FILL
+chunks, others are merged into RAW chunks, fill(dont_care=True) adds DONT_CARE blocks. Image size is rounded up to
+block size. Memory usage is one block.
+"""
+
+import os
+import struct
+
+
+__all__ = ['DEF_BLOCK_SIZE', 'SparseWriter', 'sparse_header', 'expand']
+
+SPARSE_MAGIC = 0xed26ff3a
+CHUNK_RAW = 0xcac1
+CHUNK_FILL = 0xcac2
+CHUNK_DONT_CARE = 0xcac3
+CHUNK_CRC32 = 0xcac4
+
+DEF_BLOCK_SIZE = 4096
+FILE_HEADER = struct.Struct("<IHHHHIIII")
+CHUNK_HEADER = struct.Struct("<HHII")
+EXPAND_BUFFER_SIZE = 1024 * 1024
+
+
+class SparseWriter(object):
+    """Sparse image writer, file like object"""
+
+    def __init__(self, path, block_size=DEF_BLOCK_SIZE, fill_byte=0x00):
+        """Sparse image writer
+
+        :param path: sparse image path
+        :param block_size: sparse block size, must be multiple of 4
+        :param fill_byte: byte used to pad last block and fill()
+        :return:
+        """
+        if block_size <= 0 or block_size % 4:
+            raise ValueError("Invalid sparse block size:{0:d}".format(block_size))
+
+        self.name = path
+        self.block_size = block_size
+        self.fill_byte = fill_byte
+        self.partial = bytearray()
+        self.chunk = None
+        self.chunk_blocks = 0
+        self.chunk_offset = 0
+        self.chunks = 0
+        self.size = 0
+        self.stats = {CHUNK_RAW: 0, CHUNK_FILL: 0, CHUNK_DONT_CARE: 0}
+        self.max_raw_blocks = (0xffffffff - CHUNK_HEADER.size) // block_size
+        self.fp = open(path, "wb")
+        self.fp.write("\0" * FILE_HEADER.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.fp.closed:
+            return
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.fp.close()
+
+    def __close_chunk(self):
+        if self.chunk is None:
+            return
+
+        chunk_type, value = self.chunk
+        if chunk_type == CHUNK_RAW:
+            end = self.fp.tell()
+            self.fp.seek(self.chunk_offset, os.SEEK_SET)
+            self.fp.write(CHUNK_HEADER.pack(CHUNK_RAW, 0, self.chunk_blocks,
+                                            CHUNK_HEADER.size + self.chunk_blocks * self.block_size))
+            self.fp.seek(end, os.SEEK_SET)
+        elif chunk_type == CHUNK_FILL:
+            self.fp.write(CHUNK_HEADER.pack(CHUNK_FILL, 0, self.chunk_blocks, CHUNK_HEADER.size + 4))
+            self.fp.write(chr(value) * 4)
+        else:
+            self.fp.write(CHUNK_HEADER.pack(CHUNK_DONT_CARE, 0, self.chunk_blocks, CHUNK_HEADER.size))
+
+        self.stats[chunk_type] += self.chunk_blocks
+        self.chunks += 1
+        self.chunk = None
+        self.chunk_blocks = 0
+
+    def __add_blocks(self, chunk_type, count, value=None):
+        if self.chunk != (chunk_type, value) or chunk_type == CHUNK_RAW and self.chunk_blocks >= self.max_raw_blocks:
+            self.__close_chunk()
+            self.chunk = (chunk_type, value)
+            if chunk_type == CHUNK_RAW:
+                self.chunk_offset = self.fp.tell()
+                self.fp.write("\0" * CHUNK_HEADER.size)
+
+        self.chunk_blocks += count
+
+    def __block(self, block):
+        if block.count(block[0]) == len(block):
+            self.__add_blocks(CHUNK_FILL, 1, ord(block[0]))
+        else:
+            self.__add_blocks(CHUNK_RAW, 1)
+            self.fp.write(block)
+
+    def write(self, data):
+        """Write data at current position
+
+        :param data: str, buffer or bytearray
+        :return: None
+        """
+        offset = 0
+        length = len(data)
+        self.size += length
+
+        if self.partial:
+            offset = min(self.block_size - len(self.partial), length)
+            self.partial.extend(buffer(data, 0, offset))
+            if len(self.partial) < self.block_size:
+                return
+
+            self.__block(str(self.partial))
+            self.partial = bytearray()
+
+        while length - offset >= self.block_size:
+            self.__block(str(buffer(data, offset, self.block_size)))
+            offset += self.block_size
+
+        self.partial.extend(buffer(data, offset))
+
+    def fill(self, length, dont_care=False):
+        """Write length bytes of fill byte, whole blocks are written as FILL (or DONT_CARE) chunk
+
+        :param length: fill length
+        :param dont_care: whole blocks are DONT_CARE, flasher doesn't write them
+        :return: None
+        """
+        if length <= 0:
+            return
+
+        head = min((self.block_size - len(self.partial)) % self.block_size, length)
+        self.write(chr(self.fill_byte) * head)
+        length -= head
+
+        blocks = length // self.block_size
+        if blocks:
+            if dont_care:
+                self.__add_blocks(CHUNK_DONT_CARE, blocks)
+            else:
+                self.__add_blocks(CHUNK_FILL, blocks, self.fill_byte)
+            self.size += blocks * self.block_size
+
+        self.write(chr(self.fill_byte) * (length - blocks * self.block_size))
+
+    def close(self):
+        """Pad last block, write file header
+
+        :return: {"size", "sparse_size", "blocks", "chunks", "raw_blocks", "fill_blocks", "dont_care_blocks"}
+        """
+        size = self.size
+        if self.partial:
+            self.fill(self.block_size - len(self.partial))
+
+        self.__close_chunk()
+        blocks = sum(self.stats.values())
+        self.fp.seek(0, os.SEEK_SET)
+        self.fp.write(FILE_HEADER.pack(SPARSE_MAGIC, 1, 0, FILE_HEADER.size, CHUNK_HEADER.size,
+                                       self.block_size, blocks, self.chunks, 0))
+        self.fp.seek(0, os.SEEK_END)
+        sparse_size = self.fp.tell()
+        self.fp.close()
+
+        return {"size": size, "sparse_size": sparse_size, "blocks": blocks, "chunks": self.chunks,
+                "raw_blocks": self.stats.get(CHUNK_RAW), "fill_blocks": self.stats.get(CHUNK_FILL),
+                "dont_care_blocks": self.stats.get(CHUNK_DONT_CARE)}
+
+
+def sparse_header(fp):
+    """Read sparse image file header
+
+    :param fp: sparse image file object
+    :return: (block size, total blocks, total chunks, chunk header size), raise ValueError if it is not
+    a sparse image
+    """
+    header = fp.read(FILE_HEADER.size)
+    if len(header) != FILE_HEADER.size:
+        raise ValueError("Invalid sparse image")
+
+    magic, major, _, header_size, chunk_header_size, block_size, blocks, chunks, _ = FILE_HEADER.unpack(header)
+    if magic != SPARSE_MAGIC or major != 1 or header_size < FILE_HEADER.size or \
+            chunk_header_size < CHUNK_HEADER.size:
+        raise ValueError("Invalid sparse image")
+
+    # Header may be extended by newer version
+    fp.seek(header_size - FILE_HEADER.size, os.SEEK_CUR)
+    return block_size, blocks, chunks, chunk_header_size
+
+
+def expand(path, output):
+    """Expand sparse image to raw image, streaming, DONT_CARE blocks are left as holes (zeros)
+
+    :param path: sparse image path
+    :param output: raw image path
+    :return: raw image size
+    """
+    buf = bytearray(EXPAND_BUFFER_SIZE)
+    with open(path, "rb") as fp, open(output, "wb") as fw:
+        block_size, blocks, chunks, chunk_header_size = sparse_header(fp)
+        position = 0
+
+        for _ in range(chunks):
+            header = fp.read(chunk_header_size)
+            if len(header) != chunk_header_size:
+                raise ValueError("Unexpected end of sparse image")
+
+            chunk_type, _, chunk_blocks, total_size = CHUNK_HEADER.unpack(header[:CHUNK_HEADER.size])
+            length = chunk_blocks * block_size
+            data_size = total_size - chunk_header_size
+
+            if chunk_type == CHUNK_RAW:
+                if data_size != length:
+                    raise ValueError("Invalid raw chunk size: {0:d}".format(total_size))
+
+                remain = length
+                while remain:
+                    chunk = fp.readinto(buf) if remain >= len(buf) else None
+                    data = buffer(buf, 0, chunk) if chunk is not None else fp.read(remain)
+                    if not len(data):
+                        raise ValueError("Unexpected end of sparse image")
+                    fw.write(data)
+                    remain -= len(data)
+            elif chunk_type == CHUNK_FILL:
+                if data_size != 4:
+                    raise ValueError("Invalid fill chunk size: {0:d}".format(total_size))
+
+                pattern = fp.read(4) * (min(length, len(buf)) // 4)
+                remain = length
+                while remain:
+                    fw.write(buffer(pattern, 0, min(remain, len(pattern))))
+                    remain -= min(remain, len(pattern))
+            elif chunk_type == CHUNK_DONT_CARE:
+                fw.seek(length, os.SEEK_CUR)
+            elif chunk_type == CHUNK_CRC32:
+                fp.seek(data_size, os.SEEK_CUR)
+                length = 0
+            else:
+                raise ValueError("Unknown chunk type: 0x{0:x}".format(chunk_type))
+
+            position += length
+
+        if position != blocks * block_size:
+            raise ValueError("Sparse image blocks mismatch: {0:d} != {1:d}".format(position // block_size, blocks))
+
+        fw.truncate(position)
+
+    return position
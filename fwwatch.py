@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Component file change watcher
+
+Linux inotify (through ctypes, no extra package) watches parent directories of the files, so files replaced by
+rename (most build tools and cp do so) are still detected. Elsewhere, or if inotify is not available, files are
+polled by stat (mtime, size, inode, ctime), the cost is one stat per file each interval.
+
+Bursts of changes (compiler writing a file in many chunks, several files installed at once) are debounced:
+wait() returns only after no change is seen for debounce seconds.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+__all__ = ['WATCH_INOTIFY', 'WATCH_POLL', 'DEF_INTERVAL', 'DEF_DEBOUNCE', 'ChangeWatcher', 'inotify_available']
+
+WATCH_INOTIFY = "inotify"
+WATCH_POLL = "poll"
+DEF_INTERVAL = 0.5
+DEF_DEBOUNCE = 0.2
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_BUFFER_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            _libc.inotify_init1.argtypes = [ctypes.c_int]
+            _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError):
+            _libc = False
+
+    return _libc
+
+
+def inotify_available():
+    return bool(_inotify())
+
+
+def signature(path):
+    """File signature, changed if file is written, replaced or removed
+
+    :return: (mtime, size, inode, ctime), None if file is not exist
+    """
+    try:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size, st.st_ino, st.st_ctime
+    except OSError:
+        return None
+
+
+class ChangeWatcher(object):
+    """Watch a set of files, see module document"""
+
+    def __init__(self, paths, interval=DEF_INTERVAL, debounce=DEF_DEBOUNCE, method=None):
+        """Watch files
+
+        :param paths: file paths
+        :param interval: stat polling interval
+        :param debounce: quiet time before changes are reported
+        :param method: WATCH_INOTIFY or WATCH_POLL, default is inotify if available
+        :return:
+        """
+        self.paths = {os.path.abspath(path): path for path in paths}
+        self.interval = interval
+        self.debounce = debounce
+        self.signatures = {path: signature(path) for path in self.paths}
+        self.fd = None
+        self.watches = dict()
+        self.method = WATCH_POLL
+
+        if method != WATCH_POLL and inotify_available():
+            self.__init_inotify()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __init_inotify(self):
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            wd = _libc.inotify_add_watch(fd, directory, WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                return
+
+            self.watches[wd] = directory
+
+        self.fd = fd
+        self.method = WATCH_INOTIFY
+
+    def __read_events(self, timeout):
+        """Read inotify events
+
+        :return: changed paths (abspath), all paths if event queue overflowed
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed = set()
+        position = 0
+        while position + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, position)
+            name = data[position + EVENT_HEADER.size:position + EVENT_HEADER.size + length].rstrip("\0")
+            position += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return set(self.paths)
+
+            path = os.path.join(self.watches.get(wd, ""), name)
+            if path in self.paths:
+                changed.add(path)
+
+        return changed
+
+    def __poll(self, timeout):
+        """Wait for the first change
+
+        :param timeout: seconds, None is forever
+        :return: changed paths (abspath)
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            remain = None if deadline is None else max(deadline - time.time(), 0)
+            if self.method == WATCH_INOTIFY:
+                candidates = self.__read_events(remain)
+            else:
+                time.sleep(self.interval if remain is None else min(self.interval, remain))
+                candidates = self.paths
+
+            # Events are confirmed by signature, e.g. a file opened for writing but not changed
+            changed = set()
+            for path in candidates:
+                current = signature(path)
+                if current != self.signatures.get(path):
+                    self.signatures[path] = current
+                    changed.add(path)
+
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def wait(self, timeout=None):
+        """Wait for changes, burst of changes are reported at once after debounce time
+
+        :param timeout: seconds to wait for the first change, None is forever
+        :return: changed paths (as specified to constructor), empty if timeout
+        """
+        changed = self.__poll(timeout)
+        while changed:
+            more = self.__poll(self.debounce)
+            if not more:
+                break
+
+            changed |= more
+
+        return set(self.paths.get(path) for path in changed)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None